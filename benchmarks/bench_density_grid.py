@@ -0,0 +1,62 @@
+import sys
+import os
+import time
+import argparse
+import numpy as np
+import torch
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import get_iso_permuted_dataset
+from utils import generate_grid
+from utils import gau2grid_density_kdtree
+from utils import gau2grid_density_batched
+
+# compare the per-shell loop in gau2grid_density_kdtree against the
+# batched (l, exponent) engine on the same grids and coefficients
+
+def main():
+    here = os.path.dirname(os.path.realpath(__file__))
+    parser = argparse.ArgumentParser(description='benchmark density evaluation on a grid')
+    parser.add_argument('--dataset', type=str, default=here + "/../tests/test_data_generation/testdata_w4.pkl")
+    parser.add_argument('--h_iso', type=str, default=here + "/../data/water/h_s_only_def2-universal-jfit-decontract_density.out")
+    parser.add_argument('--o_iso', type=str, default=here + "/../data/water/o_s_only_def2-universal-jfit-decontract_density.out")
+    parser.add_argument('--spacing', type=float, default=0.1)
+    parser.add_argument('--buffer', type=float, default=3.0)
+    parser.add_argument('--molecules', type=int, default=3)
+    args = parser.parse_args()
+
+    # def2 basis set max irreps
+    Rs = [(12, 0), (5, 1), (4, 2), (2, 3), (1, 4)]
+
+    dataset = get_iso_permuted_dataset(args.dataset, h_iso=args.h_iso, o_iso=args.o_iso)
+
+    torch.manual_seed(0)
+    loop_time = 0.0
+    batched_time = 0.0
+    max_diff = 0.0
+    for data in dataset[:args.molecules]:
+        # perturbed populations stand in for a model prediction
+        y_ml = data.y + 0.05*torch.randn_like(data.y)*(data.y != 0)
+        x, y, z, vol, x_spacing, y_spacing, z_spacing = generate_grid(data, spacing=args.spacing, buffer=args.buffer)
+        x, y, z = x.flatten(), y.flatten(), z.flatten()
+
+        start = time.perf_counter()
+        loop = gau2grid_density_kdtree(x, y, z, data, y_ml, Rs)
+        loop_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        batched = gau2grid_density_batched(x, y, z, data, y_ml, Rs)
+        batched_time += time.perf_counter() - start
+
+        for old, new in zip(loop, batched):
+            max_diff = max(max_diff, np.amax(np.abs(old - new)/np.maximum(np.abs(old), 1.0)))
+
+        print("atoms", data.pos.shape[0], "points", x.shape[0])
+
+    print("loop    ", f"{loop_time:.3f} s")
+    print("batched ", f"{batched_time:.3f} s")
+    print("speedup ", f"{loop_time/batched_time:.2f}x")
+    print("max rel diff", max_diff)
+
+
+if __name__ == '__main__':
+    main()
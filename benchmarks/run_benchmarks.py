@@ -0,0 +1,437 @@
+import sys
+import os
+import math
+import time
+import json
+import pickle
+import argparse
+import platform
+import tempfile
+from datetime import date
+import numpy as np
+import torch
+import torch_geometric
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import get_iso_permuted_dataset
+from utils import generate_grid
+from utils import gau2grid_density_kdtree
+from utils import get_scalar_density_comparisons
+from utils import DensityGridCache
+from utils import generate_becke_grid
+from utils import evaluate_density
+from utils import get_ml_full_coeffs
+from utils import e3nn_2_psi4_ordering
+from utils import compute_potential_field
+from density_network import DensityNetwork, export_density_network, radius_graph, PRESETS
+from neighbors import cell_list_radius_graph
+
+# throughput benchmarks for each stage of the density pipeline, run on
+# synthetic water clusters (built from the molecules in
+# tests/test_data_generation) and DNA-like fragments (built from the basis
+# and isolated atoms in ml-dna/data)
+#
+# python run_benchmarks.py --output results.json
+# python run_benchmarks.py --output new.json --compare results.json
+#
+# stages that need a missing package (gau2grid, psi4) are reported as skipped
+
+here = os.path.dirname(os.path.realpath(__file__))
+
+WATER_RS = [(12, 0), (5, 1), (4, 2), (2, 3), (1, 4)]
+DNA_RS = [(14, 0), (5, 1), (5, 2), (2, 3), (1, 4)]
+
+WATER_ISO = {
+    'h_iso': here + "/../data/water/h_s_only_def2-universal-jfit-decontract_density.out",
+    'o_iso': here + "/../data/water/o_s_only_def2-universal-jfit-decontract_density.out",
+}
+DNA_ISO = {
+    'h_iso': here + "/../ml-dna/data/h_s_only_augccpvdz_density.out",
+    'c_iso': here + "/../ml-dna/data/c_s_only_augccpvdz_density.out",
+    'n_iso': here + "/../ml-dna/data/n_s_only_augccpvdz_density.out",
+    'o_iso': here + "/../ml-dna/data/o_s_only_augccpvdz_density.out",
+    'p_iso': here + "/../ml-dna/data/p_s_only_augccpvdz_density.out",
+}
+DNA_BASIS = here + "/../ml-dna/data/def2-universal-jfit-dna.gbs"
+WATER_TEMPLATE = here + "/../tests/test_data_generation/testdata_w4.pkl"
+
+# model_kwargs of training/train_density.py and ml-dna/train_dna.py
+WATER_MODEL = PRESETS['water']
+DNA_MODEL = PRESETS['dna']
+
+# higher is better for all of these, the first one a stage has is compared
+THROUGHPUT_KEYS = ['points_per_s', 'atoms_per_s', 'molecules_per_s']
+
+
+def get_water_templates():
+    # coefficient, exponent and norm rows of an H and an O atom from the test data
+    molecule = pickle.load(open(WATER_TEMPLATE, "rb"))[0]
+    templates = {}
+    for i, z in enumerate(molecule['type'].tolist()):
+        templates.setdefault(int(z), (molecule['coefficients'][i], molecule['exponents'][i], molecule['norms'][i]))
+    return templates
+
+
+def get_dna_templates(rng):
+    # coefficient, exponent and norm rows for H, C, N, O and P laid out in
+    # DNA_RS, with the shells of the dna basis set and the s coefficients of
+    # the isolated atoms
+    numbers = {'H': 1, 'C': 6, 'N': 7, 'O': 8, 'P': 15}
+    shells = {}
+    with open(DNA_BASIS) as f:
+        lines = f.read().split('\n')
+    for i, line in enumerate(lines):
+        split = line.split()
+        if len(split) == 2 and split[0] in numbers:
+            symbol = split[0]
+            shells[symbol] = []
+        elif len(split) == 3 and split[0] in "SPDFGHI":
+            shells[symbol].append(("SPDFGHI".index(split[0]), float(lines[i+1].split()[0].replace('D', 'E'))))
+
+    def double_factorial(n):
+        return 1 if n <= 0 else n*double_factorial(n - 2)
+
+    coeff_dim = sum(mul*(2*l + 1) for mul, l in DNA_RS)
+    templates = {}
+    for symbol, element_shells in shells.items():
+        iso = np.loadtxt(DNA_ISO[symbol.lower() + '_iso'], skiprows=2, usecols=1).reshape(-1)
+        coeffs = torch.zeros(coeff_dim)
+        exps = torch.zeros(coeff_dim)
+        norms = torch.zeros(coeff_dim)
+        counter = 0
+        for mul, l in DNA_RS:
+            alphas = [alpha for shell_l, alpha in element_shells if shell_l == l][:mul]
+            for i, alpha in enumerate(alphas):
+                n = 2*l + 1
+                exps[counter + i*n:counter + (i + 1)*n] = alpha
+                norms[counter + i*n:counter + (i + 1)*n] = (2*alpha/math.pi)**0.75*math.sqrt((4*alpha)**l/double_factorial(2*l - 1))
+                if l == 0 and i < len(iso):
+                    coeffs[counter + i] = iso[i]
+                else:
+                    coeffs[counter + i*n:counter + (i + 1)*n] = torch.from_numpy(0.01*rng.standard_normal(n)).float()
+            counter += mul*(2*l + 1)
+        templates[numbers[symbol]] = (coeffs, exps, norms)
+    return templates
+
+
+def get_water_cluster(num_waters, templates, rng):
+    # waters with random orientations on a cubic lattice, 2.9 ang apart
+    angle = np.radians(104.5)
+    water = np.array([[0.0, 0.0, 0.0], [0.9572, 0.0, 0.0], [0.9572*np.cos(angle), 0.9572*np.sin(angle), 0.0]])
+    side = int(np.ceil(num_waters**(1/3)))
+    pos = []
+    for i in range(num_waters):
+        site = 2.9*np.array([i % side, (i//side) % side, i//(side*side)])
+        rotation, _ = np.linalg.qr(rng.standard_normal((3, 3)))
+        pos.append(water @ rotation.T + site)
+    pos = np.concatenate(pos)
+    types = np.tile([8, 1, 1], num_waters)
+    return get_molecule(pos, types, templates, [1, 8], rng)
+
+
+def get_dna_fragment(num_atoms, templates, rng):
+    # atoms on a jittered 1.5 ang lattice, with roughly the element fractions of DNA
+    side = int(np.ceil(num_atoms**(1/3)))
+    sites = np.array([[i % side, (i//side) % side, i//(side*side)] for i in range(num_atoms)], dtype=float)
+    pos = 1.5*sites + 0.15*rng.standard_normal(sites.shape)
+    types = rng.choice([1, 6, 7, 8, 15], size=num_atoms, p=[0.35, 0.30, 0.12, 0.20, 0.03])
+    return get_molecule(pos, types, templates, [1, 6, 7, 8, 15], rng)
+
+
+def get_molecule(pos, types, templates, elements, rng):
+    # molecule in the create_dataset.py format, with the template rows of each
+    # element and 5% noise on the coefficients
+    coefficients = torch.stack([templates[z][0] for z in types])
+    coefficients = coefficients*(1 + 0.05*torch.from_numpy(rng.standard_normal(coefficients.shape)).float())
+    onehot = torch.from_numpy((types[:, None] == np.array(elements)[None, :]).astype(np.float32))
+    return {
+        'type': torch.Tensor(types.astype(float)),
+        'pos': torch.Tensor(pos),
+        'onehot': onehot,
+        'coefficients': coefficients,
+        'exponents': torch.stack([templates[z][1] for z in types]),
+        'norms': torch.stack([templates[z][2] for z in types]),
+        'rs_max': WATER_RS if len(elements) == 2 else DNA_RS,
+    }
+
+
+def timed(fn, repeat):
+    # best of repeat runs
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, out
+
+
+def result(seconds, molecules=None, atoms=None, points=None, **extra):
+    out = {'seconds': seconds}
+    if molecules is not None:
+        out['molecules_per_s'] = molecules/seconds
+    if atoms is not None:
+        out['atoms_per_s'] = atoms/seconds
+    if points is not None:
+        out['points_per_s'] = points/seconds
+    out.update(extra)
+    return out
+
+
+def bench_dataset(name, molecules, atm_iso, args, results):
+    path = os.path.join(args.workdir, name + ".pkl")
+    with open(path, 'wb') as f:
+        pickle.dump(molecules, f)
+    atoms = sum(molecule['pos'].shape[0] for molecule in molecules)
+
+    # the other stages need the dataset, which is only timed with this stage
+    if 'dataset' not in args.stages:
+        return get_iso_permuted_dataset(path, **atm_iso)
+    seconds, dataset = timed(lambda: get_iso_permuted_dataset(path, **atm_iso), args.repeat)
+    results[name + "/get_iso_permuted_dataset"] = result(seconds, len(dataset), atoms)
+
+    def collate():
+        loader = torch_geometric.data.DataLoader(dataset, batch_size=args.batch_size, shuffle=False)
+        for data in loader:
+            pass
+    seconds, _ = timed(collate, args.repeat)
+    results[name + "/dataloader_collate"] = result(seconds, len(dataset), atoms, batch_size=args.batch_size)
+
+    seconds, _ = timed(lambda: [e3nn_2_psi4_ordering(data.full_c.numpy(), args.rs[name]) for data in dataset], args.repeat)
+    results[name + "/e3nn_2_psi4_ordering"] = result(seconds, len(dataset), atoms)
+
+    return dataset
+
+
+def bench_network(name, model_kwargs, dataset, sizes, args, results):
+    torch.manual_seed(0)
+    model = DensityNetwork(**model_kwargs)
+    # torchscript archive of inference/export_model.py, on the same inputs
+    exported, meta = export_density_network(model, os.path.join(args.workdir, name + "_exported.pt"), model_kwargs)
+    for size, data in zip(sizes, dataset):
+        atoms = data.pos.shape[0]
+        with torch.no_grad():
+            seconds, _ = timed(lambda: model(data), args.repeat)
+        results[name + "/network_forward/" + str(size)] = result(seconds, 1, atoms)
+
+        batch = torch.zeros(atoms, dtype=torch.long)
+        with torch.no_grad():
+            seconds, _ = timed(lambda: exported(data.pos_orig, data.x, batch), args.repeat)
+        results[name + "/network_forward_exported/" + str(size)] = result(seconds, 1, atoms, parity=meta["parity_max_abs_diff"])
+
+        def forward_backward():
+            model.zero_grad()
+            model(data).pow(2).mean().backward()
+        seconds, _ = timed(forward_backward, args.repeat)
+        results[name + "/network_forward_backward/" + str(size)] = result(seconds, 1, atoms)
+
+
+def bench_graph(name, get_pos, max_radius, args, results):
+    # radius graph of one large system: the cell list of neighbors.py against
+    # the distances of all pairs (density_network.radius_graph, only up to
+    # --dense_graph_atoms as it is O(N^2) in memory) and torch_cluster
+    for atoms in args.graph_sizes:
+        pos = get_pos(atoms)
+        atoms = pos.shape[0]
+        batch = torch.zeros(atoms, dtype=torch.long)
+        seconds, edge_index = timed(lambda: cell_list_radius_graph(pos, max_radius, batch), args.repeat)
+        results[name + "/radius_graph_cell_list/" + str(atoms)] = result(seconds, 1, atoms, edges=edge_index.shape[1], threads=torch.get_num_threads())
+        if atoms <= args.dense_graph_atoms:
+            seconds, dense = timed(lambda: radius_graph(pos, max_radius, batch), args.repeat)
+            results[name + "/radius_graph_dense/" + str(atoms)] = result(seconds, 1, atoms, same_edges=torch.equal(dense, edge_index))
+
+        def cluster():
+            from torch_cluster import radius_graph as cluster_radius_graph
+            return cluster_radius_graph(pos, max_radius, batch, max_num_neighbors=atoms)
+        run_optional(name + "/radius_graph_torch_cluster/" + str(atoms), cluster, args, results, molecules=1, atoms=atoms)
+
+
+def bench_density(name, dataset, args, results):
+    rs = args.rs[name]
+    torch.manual_seed(0)
+    molecules = dataset[:args.density_molecules]
+    y_mls = [data.y + 0.05*torch.randn_like(data.y)*(data.y != 0) for data in molecules]
+
+    seconds, grids = timed(lambda: [generate_grid(data, spacing=args.spacing, buffer=args.buffer) for data in molecules], args.repeat)
+    points = sum(grid[0].size for grid in grids)
+    results[name + "/generate_grid"] = result(seconds, len(molecules), points=points)
+
+    def kdtree():
+        for data, y_ml, grid in zip(molecules, y_mls, grids):
+            gau2grid_density_kdtree(grid[0].flatten(), grid[1].flatten(), grid[2].flatten(), data, y_ml, rs)
+    run_optional(name + "/gau2grid_density_kdtree", kdtree, args, results, molecules=len(molecules), points=points)
+
+    def comparisons():
+        for data, y_ml in zip(molecules, y_mls):
+            get_scalar_density_comparisons(data, y_ml, rs, spacing=args.spacing, buffer=args.buffer)
+    run_optional(name + "/get_scalar_density_comparisons", comparisons, args, results, molecules=len(molecules), points=points)
+
+    # a warm cache, as in every test epoch after the first
+    cache = DensityGridCache()
+    def cached_comparisons():
+        for data, y_ml in zip(molecules, y_mls):
+            get_scalar_density_comparisons(data, y_ml, rs, spacing=args.spacing, buffer=args.buffer, cache=cache)
+    run_optional(name + "/get_scalar_density_comparisons_cached", cached_comparisons, args, results, warmup=True, molecules=len(molecules), points=points)
+
+    # the ml density alone at the cube points, in random order
+    rng = np.random.default_rng(0)
+    shuffled = [rng.permutation(np.stack([grid[0].ravel(), grid[1].ravel(), grid[2].ravel()], axis=1)) for grid in grids]
+    def evaluate():
+        for data, y_ml, points in zip(molecules, y_mls, shuffled):
+            evaluate_density(points, get_ml_full_coeffs(data, y_ml), data.exp, data.norm, data.pos_orig, rs)
+    run_optional(name + "/evaluate_density", evaluate, args, results, molecules=len(molecules), points=points)
+
+    # atom-centered grids in place of the cube
+    seconds, grids = timed(lambda: [generate_becke_grid(data) for data in molecules], args.repeat)
+    becke_points = sum(grid[1].size for grid in grids)
+    results[name + "/generate_becke_grid"] = result(seconds, len(molecules), points=becke_points)
+
+    def becke_comparisons():
+        for data, y_ml in zip(molecules, y_mls):
+            get_scalar_density_comparisons(data, y_ml, rs, grid='becke', cache=cache)
+    run_optional(name + "/get_scalar_density_comparisons_becke_cached", becke_comparisons, args, results, warmup=True, molecules=len(molecules), points=becke_points)
+
+
+def bench_potential(name, dataset, args, results):
+    rs = args.rs[name]
+    data = dataset[0]
+    rng = np.random.default_rng(0)
+    directions = rng.standard_normal((args.potential_points, 3))
+    directions /= np.linalg.norm(directions, axis=1)[:, None]
+    # points on a sphere around the molecule
+    center = data.pos_orig.mean(dim=0).numpy()
+    radius = (data.pos_orig - data.pos_orig.mean(dim=0)).norm(dim=1).max().item() + 2.0
+    points = center + radius*directions
+    # psi4 integrals at every point are slow, so these only run on water
+    if name == 'water':
+        run_optional(name + "/compute_potential_field", lambda: compute_potential_field(points[:, 0], points[:, 1], points[:, 2], data, data.y, rs, workers=args.workers),
+            args, results, molecules=1, points=len(points))
+    run_optional(name + "/compute_potential_field_boys", lambda: compute_potential_field(points[:, 0], points[:, 1], points[:, 2], data, data.y, rs, workers=args.workers, integrals='boys'),
+        args, results, molecules=1, points=len(points))
+    # and on a sphere 8 ang further out, exact and with the multipole far field
+    outer = center + (radius + 8.0)*directions
+    run_optional(name + "/compute_potential_field_boys_outer", lambda: compute_potential_field(outer[:, 0], outer[:, 1], outer[:, 2], data, data.y, rs, workers=args.workers, integrals='boys'),
+        args, results, molecules=1, points=len(outer))
+    run_optional(name + "/compute_potential_field_boys_far", lambda: compute_potential_field(outer[:, 0], outer[:, 1], outer[:, 2], data, data.y, rs, workers=args.workers, integrals='boys', far_tol=args.far_tol),
+        args, results, molecules=1, points=len(outer))
+
+
+def run_optional(key, fn, args, results, warmup=False, **counts):
+    # stages that need gau2grid or psi4
+    try:
+        if warmup:
+            fn()
+        seconds, _ = timed(fn, args.repeat)
+    except ImportError as e:
+        results[key] = {'skipped': str(e)}
+        print(key, "skipped:", e)
+        return
+    results[key] = result(seconds, **counts)
+
+
+def compare(results, baseline, tolerance):
+    # throughput of every stage in both runs, flagging drops larger than tolerance
+    regressions = []
+    for key in sorted(results):
+        if key not in baseline or 'seconds' not in results[key] or 'seconds' not in baseline[key]:
+            continue
+        for metric in THROUGHPUT_KEYS:
+            if metric in results[key] and metric in baseline[key]:
+                ratio = results[key][metric]/baseline[key][metric]
+                flag = "REGRESSION" if ratio < 1 - tolerance else ""
+                print(f"{key:60s} {metric:16s} {baseline[key][metric]:14.2f} -> {results[key][metric]:14.2f} {ratio:6.2f}x {flag}")
+                if flag:
+                    regressions.append((key, metric, ratio))
+                break
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the density training and evaluation pipeline')
+    parser.add_argument('--output', type=str, default=None, help='write results as json')
+    parser.add_argument('--compare', type=str, default=None, help='baseline json to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed fractional throughput drop')
+    parser.add_argument('--stages', type=str, nargs='+', default=['dataset', 'network', 'graph', 'density', 'potential'])
+    parser.add_argument('--systems', type=str, nargs='+', default=['water', 'dna'])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--molecules', type=int, default=32, help='molecules in the synthetic datasets')
+    parser.add_argument('--water_sizes', type=int, nargs='+', default=[4, 16, 64], help='waters per cluster for the network stage')
+    parser.add_argument('--dna_sizes', type=int, nargs='+', default=[64, 256], help='atoms per fragment for the network stage')
+    parser.add_argument('--graph_sizes', type=int, nargs='+', default=[1000, 10000, 100000], help='atoms per system for the graph stage')
+    parser.add_argument('--dense_graph_atoms', type=int, default=10000, help='largest system of the graph stage for the all pairs radius graph')
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--spacing', type=float, default=0.2)
+    parser.add_argument('--buffer', type=float, default=3.0)
+    parser.add_argument('--density_molecules', type=int, default=2)
+    parser.add_argument('--potential_points', type=int, default=50)
+    parser.add_argument('--workers', type=int, default=1, help='processes for the potential stage')
+    parser.add_argument('--far_tol', type=float, default=1e-8, help='gaussian tail left out by the multipole far field of the potential stage')
+    args = parser.parse_args()
+    args.rs = {'water': WATER_RS, 'dna': DNA_RS}
+
+    torch.set_default_dtype(torch.float32)
+    rng = np.random.default_rng(0)
+
+    systems = {}
+    if 'water' in args.systems:
+        templates = get_water_templates()
+        systems['water'] = (
+            [get_water_cluster(4, templates, rng) for _ in range(args.molecules)],
+            [get_water_cluster(n, templates, rng) for n in args.water_sizes],
+            WATER_ISO, WATER_MODEL, args.water_sizes,
+            lambda atoms, templates=templates: get_water_cluster(atoms//3, templates, rng)['pos'])
+    if 'dna' in args.systems:
+        templates = get_dna_templates(rng)
+        systems['dna'] = (
+            [get_dna_fragment(32, templates, rng) for _ in range(args.molecules)],
+            [get_dna_fragment(n, templates, rng) for n in args.dna_sizes],
+            DNA_ISO, DNA_MODEL, args.dna_sizes,
+            lambda atoms, templates=templates: get_dna_fragment(atoms, templates, rng)['pos'])
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        args.workdir = workdir
+        for name, (molecules, sized, atm_iso, model_kwargs, sizes, get_pos) in systems.items():
+            dataset = bench_dataset(name, molecules, atm_iso, args, results)
+            if 'network' in args.stages:
+                with open(os.path.join(workdir, name + "_sizes.pkl"), 'wb') as f:
+                    pickle.dump(sized, f)
+                bench_network(name, model_kwargs, get_iso_permuted_dataset(os.path.join(workdir, name + "_sizes.pkl"), **atm_iso), sizes, args, results)
+            if 'graph' in args.stages:
+                bench_graph(name, get_pos, model_kwargs["max_radius"], args, results)
+            if 'density' in args.stages:
+                bench_density(name, dataset, args, results)
+            if 'potential' in args.stages:
+                bench_potential(name, dataset, args, results)
+
+    for key, value in results.items():
+        if 'seconds' in value:
+            rates = ", ".join(f"{metric} {value[metric]:.2f}" for metric in THROUGHPUT_KEYS if metric in value)
+            print(f"{key:60s} {value['seconds']:10.4f} s  {rates}")
+
+    report = {
+        'meta': {
+            'date': date.today().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'torch': torch.__version__,
+            'numpy': np.__version__,
+            'threads': torch.get_num_threads(),
+            'args': {key: value for key, value in vars(args).items() if key not in ('rs', 'workdir', 'output', 'compare')},
+        },
+        'results': results,
+    }
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(len(regressions), "regressions beyond", args.tolerance)
+            sys.exit(1)
+        print("no regressions")
+
+
+if __name__ == '__main__':
+    main()
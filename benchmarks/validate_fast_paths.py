@@ -0,0 +1,263 @@
+import sys
+import os
+import json
+import argparse
+import numpy as np
+import torch
+import torch_geometric
+from scipy import spatial
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import get_iso_permuted_dataset
+from utils import generate_grid
+from utils import gau2grid_density_kdtree
+from utils import gau2grid_density_torch
+from utils import get_scalar_density_comparisons
+from utils import DensityGridCache
+from utils import evaluate_density
+from utils import gau2grid_density_coeffs
+from utils import get_ml_full_coeffs
+from utils import compute_potential_field
+from utils import get_potential_integrals
+from utils import get_ele_potential_field
+from density_network import DensityNetwork, PRESETS, radius_graph, get_example_atoms, domain_decomposed_forward
+from neighbors import cell_list_radius_graph
+from e3nn import o3
+
+# regression checks of the fast paths of the pipeline against the reference
+# implementations they replace, each within the tolerance of its request
+# (or the screening error, where the request gives none), on the water
+# molecules in tests/test_data_generation. max_diff is the largest absolute
+# difference, or the largest relative one for checks marked relative
+#
+# python validate_fast_paths.py --output checks.json
+#
+# checks that need a missing package (gau2grid, psi4) are reported as
+# skipped, and the script exits with an error if any check fails
+
+here = os.path.dirname(os.path.realpath(__file__))
+
+WATER_RS = [(12, 0), (5, 1), (4, 2), (2, 3), (1, 4)]
+WATER_ISO = {
+    'h_iso': here + "/../data/water/h_s_only_def2-universal-jfit-decontract_density.out",
+    'o_iso': here + "/../data/water/o_s_only_def2-universal-jfit-decontract_density.out",
+}
+WATER_DATASET = here + "/../tests/test_data_generation/testdata_w4.pkl"
+
+
+def get_molecule(args, index=0):
+    # a water cluster with float64 positions, as the numpy paths would
+    # otherwise round the centers to float32, and a perturbed prediction
+    data = get_iso_permuted_dataset(WATER_DATASET, **WATER_ISO)[index]
+    data.pos_orig = data.pos_orig.double()
+    torch.manual_seed(index)
+    y_ml = data.y + 0.05*torch.randn_like(data.y)*(data.y != 0)
+    return data, y_ml
+
+
+def check_density_torch(args):
+    # torch collocation (gau2grid_density_torch) against gau2grid_density_kdtree
+    data, y_ml = get_molecule(args)
+    x, y, z, *_ = generate_grid(data, spacing=args.spacing, buffer=args.buffer)
+    x, y, z = x.flatten(), y.flatten(), z.flatten()
+    target, ml = gau2grid_density_kdtree(x, y, z, data, y_ml, WATER_RS)
+    points = torch.from_numpy(np.stack([x, y, z], axis=1))
+    torch_target, torch_ml = gau2grid_density_torch(points, data, y_ml.double(), WATER_RS, dtype=torch.float64, chunk_size=1024)
+    diff = max(np.abs(target - torch_target.numpy()).max(), np.abs(ml - torch_ml.numpy()).max())
+    return {'max_diff': float(diff), 'tolerance': 1e-6, 'points': len(x)}
+
+
+def check_evaluate_density(args):
+    # evaluate_density (screened, sorted and chunked over arbitrary points)
+    # against the kd tree engine of gau2grid_density_kdtree on the same
+    # coefficients, with the points in a random order
+    data, y_ml = get_molecule(args)
+    x, y, z, *_ = generate_grid(data, spacing=args.spacing, buffer=args.buffer)
+    points = np.stack([x.flatten(), y.flatten(), z.flatten()], axis=1)
+    points = points[np.random.default_rng(0).permutation(len(points))]
+    coeffs = get_ml_full_coeffs(data, y_ml)
+    (reference, _), = gau2grid_density_coeffs(points.T.copy(), spatial.cKDTree(points), data, [coeffs], WATER_RS)
+    density = evaluate_density(points, coeffs, data.exp, data.norm, data.pos_orig, WATER_RS, chunk_size=4096)
+    return {'max_diff': float(np.abs(density - reference).max()), 'tolerance': 1e-10, 'points': len(points)}
+
+
+def check_density_cache(args):
+    # metrics of get_scalar_density_comparisons from a DensityGridCache (on
+    # its second call, the one that reuses the grid) against those without
+    # the cache; the cached target density is screened by its own
+    # coefficients rather than by the larger of the target and the
+    # prediction, so the metrics agree to the screening error (relative)
+    data, y_ml = get_molecule(args)
+    reference = np.array(get_scalar_density_comparisons(data, y_ml, WATER_RS, spacing=args.spacing, buffer=args.buffer))
+    cache = DensityGridCache()
+    for _ in range(2):
+        cached = np.array(get_scalar_density_comparisons(data, y_ml, WATER_RS, spacing=args.spacing, buffer=args.buffer, cache=cache))
+    if cache.hits != 1:
+        raise ValueError("the second call did not reuse the cached grid")
+    return {'max_diff': float(np.abs(cached/reference - 1).max()), 'tolerance': 1e-4, 'relative': True, 'metrics': 'num_ele_target, num_ele_ml, bigI, ep'}
+
+
+def get_potential_points(data, num_points, seed=0):
+    # points (angstrom) around the molecule, none on a nucleus
+    rng = np.random.default_rng(seed)
+    center = data.pos_orig.numpy().mean(axis=0)
+    return center + 4.0*rng.standard_normal((num_points, 3))
+
+
+def check_potential_batched(args):
+    # batched psi4 engine of compute_potential_field against the per point
+    # loop it replaced (nuclei atom by atom, get_ele_potential_field per point)
+    import psi4
+    data, y_ml = get_molecule(args)
+    points = get_potential_points(data, args.potential_points)
+    batched = compute_potential_field(points[:, 0], points[:, 1], points[:, 2], data, y_ml, WATER_RS, block_size=16)
+
+    ints, results, nbf = get_potential_integrals(data)
+    coords = data.pos_orig.numpy()/psi4.constants.bohr2angstroms
+    Zs = data.z.numpy().reshape(-1)
+    reference = [[], [], [], []]
+    for point in points/psi4.constants.bohr2angstroms:
+        nuc_potential = 0.0
+        nuc_field = np.zeros(3)
+        for center, charge in zip(coords, Zs):
+            r = np.linalg.norm(point - center)
+            nuc_potential += charge/r
+            nuc_field += charge*(point - center)/r**3
+        target_potential, target_field, ml_potential, ml_field = get_ele_potential_field(point, ints, results, nbf, data, y_ml, WATER_RS)
+        for out, value in zip(reference, [nuc_potential + target_potential, nuc_field + target_field, nuc_potential + ml_potential, nuc_field + ml_field]):
+            out.append(value)
+    diff = max(float(np.abs(np.array(ref) - new).max()) for ref, new in zip(reference, batched))
+    return {'max_diff': diff, 'tolerance': 1e-10, 'points': len(points)}
+
+
+def check_potential_far_field(args):
+    # multipoles of get_potential_field_boys for the atoms beyond far_tol
+    # against the exact boys integrals at every atom, at points 2 to 12
+    # angstrom from the molecule; far_tol=1e-6 is stated to keep the
+    # potential within 1e-8 au (the field is reported, not checked)
+    data, y_ml = get_molecule(args)
+    rng = np.random.default_rng(0)
+    directions = rng.standard_normal((args.potential_points, 3))
+    directions /= np.linalg.norm(directions, axis=1)[:, None]
+    points = data.pos_orig.numpy().mean(axis=0) + directions*rng.uniform(2.0, 12.0, (args.potential_points, 1))
+    exact = compute_potential_field(points[:, 0], points[:, 1], points[:, 2], data, y_ml, WATER_RS, integrals='boys')
+    far = compute_potential_field(points[:, 0], points[:, 1], points[:, 2], data, y_ml, WATER_RS, integrals='boys', far_tol=1e-6)
+    potential = max(float(np.abs(exact[i] - far[i]).max()) for i in [0, 2])
+    field = max(float(np.abs(exact[i] - far[i]).max()) for i in [1, 3])
+    return {'max_diff': potential, 'tolerance': 1e-8, 'field_max_diff': field, 'points': len(points)}
+
+
+def check_batched_energy_force(args):
+    # energies and forces of a batch of molecules (train_energy_force.py with
+    # --batch_size) against those of each molecule on its own; Network of
+    # gate_points_2101 added self loops to batches of more than 25 atoms
+    torch.manual_seed(0)
+    model = DensityNetwork(
+        irreps_in="2x 0e", irreps_hidden=[(mul, (l, p)) for l, mul in enumerate([16, 8, 4, 2]) for p in [-1, 1]],
+        irreps_out="1x0e", irreps_node_attr=None, irreps_edge_attr=o3.Irreps.spherical_harmonics(3), layers=3, max_radius=3.5,
+        number_of_basis=10, radial_layers=1, radial_neurons=32, num_neighbors=12.2298, num_nodes=24, reduce_output=True)
+    molecules = get_iso_permuted_dataset(WATER_DATASET, **WATER_ISO)[:4]
+
+    def energy_force(data):
+        data.pos.requires_grad = True
+        energy = model(data).reshape(-1)
+        return energy.detach(), torch.autograd.grad(energy.sum(), data.pos)[0]
+
+    batch = torch_geometric.data.Batch.from_data_list(molecules)
+    energies, forces = energy_force(batch)
+    diff = 0.0
+    for i, data in enumerate(molecules):
+        energy, force = energy_force(torch_geometric.data.Batch.from_data_list([data]))
+        diff = max(diff, float((energies[i] - energy).abs().max()), float((forces[batch.batch == i] - force).abs().max()))
+    return {'max_diff': diff, 'tolerance': 1e-5, 'atoms': batch.pos.shape[0]}
+
+
+def check_cell_list_graph(args):
+    # radius graph of the cell list of neighbors.py against all the distances
+    # (density_network.radius_graph) on a batch of two overlapping random
+    # systems, and the outputs of DensityNetwork with either graph; the edges
+    # are the same in the same order, so the outputs are identical
+    first, second = get_example_atoms(args.graph_atoms, 2, seed=0), get_example_atoms(args.graph_atoms//3, 2, seed=1)
+    pos_orig = torch.cat([first[0], second[0]])
+    x = torch.cat([first[1], second[1]])
+    batch = torch.cat([first[2], second[2] + 1])
+    pos = pos_orig[:, [1, 2, 0]]
+    torch.manual_seed(0)
+    model = DensityNetwork(**PRESETS['tutorial'], cell_list_atoms=0).eval()
+    same_edges = torch.equal(cell_list_radius_graph(pos, model.max_radius, batch), radius_graph(pos, model.max_radius, batch))
+    with torch.no_grad():
+        cell_list = model({"pos": pos, "x": x, "batch": batch})
+        model.cell_list_atoms = pos.shape[0] + 1
+        dense = model({"pos": pos, "x": x, "batch": batch})
+    diff = float((cell_list - dense).abs().max()) if same_edges else float('inf')
+    return {'max_diff': diff, 'tolerance': 0.0, 'same_edges': same_edges, 'atoms': pos.shape[0]}
+
+
+def check_domain_forward(args):
+    # domain_decomposed_forward with the default halo (the receptive field)
+    # against one pass of the whole system, with blocks on one process and on
+    # two; the model is checked to be left in training mode. max_radius is
+    # shortened so that the blocks hold only part of the system
+    pos_orig, x, _ = get_example_atoms(args.graph_atoms, 2, seed=2)
+    pos = pos_orig[:, [1, 2, 0]]
+    torch.manual_seed(0)
+    model = DensityNetwork(**dict(PRESETS['tutorial'], max_radius=2.0))
+    with torch.no_grad():
+        whole = model.eval()({"pos": pos, "x": x})
+    model.train()
+    diff = 0.0
+    for workers in [1, 2]:
+        out, stats = domain_decomposed_forward(model, pos, x, block_size=args.block_size, workers=workers)
+        if not model.training:
+            raise ValueError("domain_decomposed_forward left the model in eval mode")
+        diff = max(diff, float((out - whole).abs().max()))
+    return {'max_diff': diff, 'tolerance': 1e-5, 'atoms': pos.shape[0], **stats}
+
+
+CHECKS = {
+    'density_torch': check_density_torch,
+    'density_cache': check_density_cache,
+    'evaluate_density': check_evaluate_density,
+    'potential_batched': check_potential_batched,
+    'potential_far_field': check_potential_far_field,
+    'batched_energy_force': check_batched_energy_force,
+    'cell_list_graph': check_cell_list_graph,
+    'domain_forward': check_domain_forward,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='check the fast paths against their reference implementations')
+    parser.add_argument('--checks', type=str, nargs='+', default=list(CHECKS))
+    parser.add_argument('--spacing', type=float, default=0.3)
+    parser.add_argument('--buffer', type=float, default=3.0)
+    parser.add_argument('--potential_points', type=int, default=50)
+    parser.add_argument('--graph_atoms', type=int, default=3000, help='atoms of the larger system of cell_list_graph and of domain_forward')
+    parser.add_argument('--block_size', type=float, default=10.0, help='side of the domains of domain_forward in angstrom')
+    parser.add_argument('--output', type=str, default=None, help='write results as json')
+    args = parser.parse_args()
+
+    results = {}
+    failed = []
+    for name in args.checks:
+        try:
+            result = CHECKS[name](args)
+        except ImportError as e:
+            results[name] = {'skipped': str(e)}
+            print(f"{name:30s} skipped: {e}")
+            continue
+        result['passed'] = bool(result['max_diff'] <= result['tolerance'])
+        results[name] = result
+        print(f"{name:30s} {result['max_diff']:12.3e} (tolerance {result['tolerance']:.1e}) {'ok' if result['passed'] else 'FAILED'}")
+        if not result['passed']:
+            failed.append(name)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    if failed:
+        print(len(failed), "checks failed")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,374 @@
+import os
+import json
+import math
+import pickle
+import numpy as np
+import torch
+import torch_geometric
+
+# one-time "compile" of a create_dataset.py pickle into contiguous
+# memory-mapped arrays. every per-atom array of every molecule is stored
+# back to back in one .npy file, and offsets.npy holds the first atom of
+# each molecule, so a molecule is a zero-copy slice of each array
+
+# per-atom fields and their trailing shapes; "coeff" is the coefficient width
+ATOM_FIELDS = {
+    'pos': (3,),
+    'pos_orig': (3,),
+    'z': (1,),
+    'x': ('onehot',),
+    'y': ('coeff',),
+    'c': ('coeff',),
+    'full_c': ('coeff',),
+    'iso_c': ('coeff',),
+    'exp': ('coeff',),
+    'norm': ('coeff',),
+}
+
+
+def get_onehot(z, elements):
+    # onehot over the dataset's ascending list of atomic numbers
+    z = np.asarray(z).reshape(-1)
+    return torch.from_numpy((z[:, None] == np.asarray(elements)[None, :]).astype(np.float32))
+
+
+def load_molecules(path):
+    # molecules of a create_dataset.py pickle, or of a shard folder written by
+    # create_dataset.py --shard_size, one shard in memory at a time
+    if not os.path.isdir(path):
+        yield from pickle.load(open(path, "rb"))
+        return
+
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    if meta.get('format') != 'density_shards':
+        raise ValueError(path + " is not a folder of dataset shards.")
+    for shard in meta['shards']:
+        for molecule in pickle.load(open(os.path.join(path, shard), "rb")):
+            # onehot over the elements of the whole dataset
+            molecule['onehot'] = get_onehot(molecule['type'].numpy(), meta['elements'])
+            yield molecule
+
+
+def find_iso_files(directory, prefix=""):
+    # isolated atom kwargs ({"h_iso": path, ...}) for every
+    # <prefix><element>_s_only_*_density.out file in directory
+    import glob
+    atm_iso = {}
+    for path in sorted(glob.glob(os.path.join(directory, prefix + "*_s_only_*_density.out"))):
+        element = os.path.basename(path)[len(prefix):].split("_s_only_")[0]
+        if "_" in element:
+            continue
+        atm_iso[element.lower() + "_iso"] = path
+    return atm_iso
+
+
+def get_iso_table(**atm_iso):
+    # isolated atom coefficients for every element given as <element>_iso=file,
+    # as one [max_z + 1, width] table indexed by atomic number, and a mask of
+    # the atomic numbers that have a reference
+    import periodictable as pt
+    iso_data = {}
+    for key, value in atm_iso.items():
+        symbol = key[:-len("_iso")].capitalize() if key.endswith("_iso") else ""
+        element = getattr(pt, symbol, None)
+        if not isinstance(element, pt.core.Element):
+            raise ValueError("Isolated atom type not found. Use kwargs \"h_iso\", \"c_iso\", etc.")
+        iso_data[element.number] = torch.Tensor(np.loadtxt(value,skiprows=2,usecols=1)).reshape(-1)
+
+    max_z = max(iso_data, default=0)
+    width = max((data.shape[0] for data in iso_data.values()), default=0)
+    iso_table = torch.zeros(max_z + 1, width)
+    supported = torch.zeros(max_z + 1, dtype=torch.bool)
+    for number, data in iso_data.items():
+        iso_table[number, :data.shape[0]] = data
+        supported[number] = True
+
+    return iso_table, supported
+
+
+def subtract_iso(c, z, iso_table, supported):
+    # gather the isolated atom coefficients of every atom (of one molecule or a
+    # whole batch) by atomic number and subtract them in one step
+    # returns the delta coefficients and the isolated atom coefficients
+    z = z.reshape(-1).long()
+    if z.numel() and (z.max() >= supported.shape[0] or not supported[z].all()):
+        raise ValueError("Isolated atom type not supported!")
+    if iso_table.shape[1] > c.shape[1]:
+        raise ValueError("Isolated atom reference has more coefficients than the dataset.")
+    iso_c = torch.zeros_like(c)
+    iso_c[:, :iso_table.shape[1]] = iso_table.to(device=c.device, dtype=c.dtype)[z]
+    return c - iso_c, iso_c
+
+
+def compile_dataset(picklefile, outdir, **atm_iso):
+    # same preprocessing as utils.get_iso_permuted_dataset (isolated atom
+    # subtraction, populations, yzx -> xyz permutation), written once to outdir
+    # picklefile can also be a shard folder from create_dataset.py --shard_size
+    # energies and forces are kept when the pickle has them, with forces
+    # converted like utils.get_iso_dataset
+    iso_table, supported = get_iso_table(**atm_iso)
+
+    # first pass for the array sizes, so shard folders are never held in memory
+    num_molecules = 0
+    num_atoms = 0
+    has_energy = True
+    for molecule in load_molecules(picklefile):
+        if num_molecules == 0:
+            coeff_dim = molecule['coefficients'].shape[1]
+            onehot_dim = molecule['onehot'].shape[1]
+            rs_max = molecule.get('rs_max', [])
+        num_molecules += 1
+        num_atoms += molecule['pos'].shape[0]
+        has_energy = has_energy and 'energy' in molecule
+    if num_molecules == 0:
+        raise ValueError("no molecules in " + str(picklefile))
+
+    os.makedirs(outdir, exist_ok=True)
+    dims = {'coeff': coeff_dim, 'onehot': onehot_dim}
+    arrays = {}
+    for name, shape in ATOM_FIELDS.items():
+        shape = tuple(dims.get(s, s) for s in shape)
+        arrays[name] = np.lib.format.open_memmap(os.path.join(outdir, name + '.npy'), mode='w+', dtype=np.float32, shape=(num_atoms,) + shape)
+    if has_energy:
+        arrays['forces'] = np.lib.format.open_memmap(os.path.join(outdir, 'forces.npy'), mode='w+', dtype=np.float32, shape=(num_atoms, 3))
+        energies = np.zeros(num_molecules, dtype=np.float32)
+
+    offsets = np.zeros(num_molecules + 1, dtype=np.int64)
+    for i, molecule in enumerate(load_molecules(picklefile)):
+        pos = molecule['pos']
+        z = molecule['type'].unsqueeze(1)
+        c = molecule['coefficients']
+        n = molecule['norms']
+        if c.shape[1] != coeff_dim:
+            raise ValueError("All molecules in a compiled dataset must share the same Rs_out.")
+
+        full_c = c.clone()
+        c, iso_c = subtract_iso(full_c, z, iso_table, supported)
+
+        pop = torch.where(n != 0, c*2*math.sqrt(2)/n, n)
+
+        start = offsets[i]
+        end = start + pos.shape[0]
+        offsets[i + 1] = end
+
+        # permute, yzx -> xyz
+        arrays['pos'][start:end] = pos[:, [1, 2, 0]].numpy()
+        arrays['pos_orig'][start:end] = pos.numpy()
+        arrays['z'][start:end] = z.numpy()
+        arrays['x'][start:end] = molecule['onehot'].numpy()
+        arrays['y'][start:end] = pop.numpy()
+        arrays['c'][start:end] = c.numpy()
+        arrays['full_c'][start:end] = full_c.numpy()
+        arrays['iso_c'][start:end] = iso_c.numpy()
+        arrays['exp'][start:end] = molecule['exponents'].numpy()
+        arrays['norm'][start:end] = n.numpy()
+
+        if has_energy:
+            # this is a gradient, not forces
+            # convert from hartree/bohr to kcal/mol/ang
+            bohr2ang = 0.529177
+            hartree2kcal = 627.5094740631
+            arrays['forces'][start:end] = (molecule['forces']*hartree2kcal/bohr2ang).numpy()
+            energies[i] = molecule['energy'].item()
+
+    for array in arrays.values():
+        array.flush()
+    np.save(os.path.join(outdir, 'offsets.npy'), offsets)
+    if has_energy:
+        np.save(os.path.join(outdir, 'energy.npy'), energies)
+
+    meta = {
+        'source': os.path.abspath(picklefile),
+        'num_molecules': num_molecules,
+        'num_atoms': int(num_atoms),
+        'coeff_dim': int(coeff_dim),
+        'onehot_dim': int(onehot_dim),
+        'has_energy': has_energy,
+        'rs_max': [list(rs) for rs in rs_max],
+    }
+    with open(os.path.join(outdir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=1)
+
+    return outdir
+
+
+class MemmapDensityDataset(torch.utils.data.Dataset):
+    # serves torch_geometric Data objects whose tensors are views into the
+    # memory-mapped arrays written by compile_dataset, so opening a dataset
+    # costs a few file maps and memory use does not grow with its size
+    # permuted=False gives pos in the original ordering, like get_iso_dataset
+
+    def __init__(self, path, permuted=True):
+        self.path = path
+        self.permuted = permuted
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'))
+
+        # copy-on-write maps are writable, so torch can wrap them without a copy
+        names = list(ATOM_FIELDS)
+        if self.meta['has_energy']:
+            names += ['forces', 'energy']
+        self.arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='c') for name in names}
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        fields = {name: torch.from_numpy(self.arrays[name][start:end]) for name in ATOM_FIELDS}
+        if not self.permuted:
+            fields['pos'] = fields['pos_orig']
+        if self.meta['has_energy']:
+            fields['forces'] = torch.from_numpy(self.arrays['forces'][start:end])
+            fields['energy'] = torch.from_numpy(self.arrays['energy'][idx:idx + 1]).reshape(())
+        return torch_geometric.data.Data(**fields)
+
+
+def get_num_atoms(dataset):
+    # number of atoms of every molecule in a dataset, without loading the
+    # molecules of a compiled dataset
+    if isinstance(dataset, torch.utils.data.Subset):
+        return get_num_atoms(dataset.dataset)[np.asarray(dataset.indices, dtype=np.int64)]
+    if isinstance(dataset, MemmapDensityDataset):
+        return np.diff(dataset.offsets)
+    return np.array([data.num_nodes for data in dataset], dtype=np.int64)
+
+
+class SizeBucketSampler(torch.utils.data.Sampler):
+    # batch sampler that groups molecules of similar size
+    # the shuffled dataset is cut into buckets of bucket_size batches, each
+    # bucket is sorted by number of atoms and split into batches of batch_size
+    # molecules, or of up to max_atoms atoms when max_atoms is given (a single
+    # molecule larger than max_atoms gets a batch of its own), and the order of
+    # the batches is shuffled again
+    # use as torch_geometric.data.DataLoader(dataset, batch_sampler=sampler)
+
+    def __init__(self, num_atoms, batch_size=1, max_atoms=None, bucket_size=50, shuffle=True):
+        self.num_atoms = np.asarray(num_atoms)
+        self.batch_size = batch_size
+        self.max_atoms = max_atoms
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.batches = self.get_batches()
+
+    def get_batches(self):
+        indices = np.random.permutation(len(self.num_atoms)) if self.shuffle else np.arange(len(self.num_atoms))
+
+        if self.max_atoms is None:
+            bucket = self.bucket_size*self.batch_size
+        else:
+            bucket = max(1, self.bucket_size*self.max_atoms//max(1, int(self.num_atoms.mean())))
+
+        batches = []
+        for start in range(0, len(indices), bucket):
+            chunk = indices[start:start + bucket]
+            chunk = chunk[np.argsort(self.num_atoms[chunk], kind='stable')]
+            batch = []
+            batch_atoms = 0
+            for i in chunk.tolist():
+                if self.max_atoms is None:
+                    full = len(batch) == self.batch_size
+                else:
+                    full = batch_atoms + self.num_atoms[i] > self.max_atoms
+                if batch and full:
+                    batches.append(batch)
+                    batch = []
+                    batch_atoms = 0
+                batch.append(i)
+                batch_atoms += self.num_atoms[i]
+            if batch:
+                batches.append(batch)
+
+        if self.shuffle:
+            random_order = np.random.permutation(len(batches))
+            batches = [batches[i] for i in random_order]
+        return batches
+
+    def __iter__(self):
+        batches = self.batches
+        # new buckets for the next epoch
+        self.batches = self.get_batches()
+        return iter(batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def get_graph_sum(x, batch, num_graphs):
+    # sum of every row of x over the atoms of each graph in a batch, [num_graphs]
+    return torch.zeros(num_graphs, dtype=x.dtype, device=x.device).index_add_(0, batch, x.reshape(x.shape[0], -1).sum(dim=1))
+
+
+def get_graph_mse(err, batch, num_graphs):
+    # mean squared error of each graph in a batch, [num_graphs]
+    # equal to err.pow(2).mean() of every molecule on its own
+    counts = torch.bincount(batch, minlength=num_graphs).to(err.dtype)
+    return get_graph_sum(err.pow(2), batch, num_graphs)/(counts*err[0].numel())
+
+
+def get_standardization_stats(dataset, Rs):
+    # mean and std of the targets y for every element (onehot column) and
+    # every shell (each of the mul copies of a (mul, l) in Rs), over all the
+    # coefficients of that shell on the atoms of that element
+    # one pass over the dataset: the sums of each molecule are merged into
+    # running welford statistics, so the molecules are never kept in memory
+    # returns means and stds [num_elements, num_coeffs] (float64), with every
+    # column of a shell holding the statistics of its shell
+    sizes = torch.tensor([2*l + 1 for mul, l in Rs for i in range(mul)], dtype=torch.float64)
+    shell = torch.repeat_interleave(torch.arange(len(sizes)), sizes.long())
+
+    count = mean = m2 = None
+    for i in range(len(dataset)):
+        data = dataset[i]
+        x = data.x.to(torch.float64)
+        y = data.y.to(torch.float64)
+        if count is None:
+            count = torch.zeros(x.shape[1], len(sizes), dtype=torch.float64)
+            mean = torch.zeros_like(count)
+            m2 = torch.zeros_like(count)
+
+        # statistics of this molecule, [num_elements, num_shells]
+        n = x.sum(0)[:, None]*sizes[None, :]
+        total = torch.zeros_like(count).index_add_(1, shell, x.T @ y)
+        molecule_mean = torch.where(n > 0, total/n.clamp(min=1), 0)
+        err = y - (x @ molecule_mean)[:, shell]
+        molecule_m2 = torch.zeros_like(count).index_add_(1, shell, x.T @ err.pow(2))
+
+        # chan et al. merge of the two sets of statistics
+        merged = count + n
+        delta = molecule_mean - mean
+        weight = torch.where(merged > 0, n/merged.clamp(min=1), 0)
+        mean = mean + delta*weight
+        m2 = m2 + molecule_m2 + delta.pow(2)*count*weight
+        count = merged
+
+    stds = torch.where(count > 0, m2/count.clamp(min=1), 0).sqrt()
+    return mean[:, shell], stds[:, shell]
+
+
+class Standardizer(torch.nn.Module):
+    # per element standardization of the targets, (y - mean)/std, with the
+    # statistics of get_standardization_stats gathered for every atom from
+    # its onehot x, so whole batches are done at once on any device
+    # columns with a zero std (padding) are standardized to zero
+    # means and stds are buffers, so they follow .to(device) and are in
+    # state_dict; Standardizer(**torch.load(path)) restores a saved one
+
+    def __init__(self, means, stds):
+        super().__init__()
+        self.register_buffer('means', torch.as_tensor(means, dtype=torch.float64).clone())
+        self.register_buffer('stds', torch.as_tensor(stds, dtype=torch.float64).clone())
+
+    def get_atom_stats(self, x, dtype):
+        x = x.to(self.means.dtype)
+        return (x @ self.means).to(dtype), (x @ self.stds).to(dtype)
+
+    def forward(self, y, x):
+        means, stds = self.get_atom_stats(x, y.dtype)
+        return torch.where(stds != 0, (y - means)/torch.where(stds != 0, stds, torch.ones_like(stds)), torch.zeros_like(y))
+
+    def inverse(self, y, x):
+        means, stds = self.get_atom_stats(x, y.dtype)
+        return y*stds + means
@@ -0,0 +1,358 @@
+import torch
+from e3nn import o3
+from e3nn.math import soft_one_hot_linspace
+from e3nn.nn.models.gate_points_2101 import Network, smooth_cutoff, scatter
+from neighbors import batched_periodic_radius_graph, cell_list_radius_graph
+
+# the gate_points_2101 Network used by the training scripts, with a forward
+# that can run under torch.autocast (bfloat16 on cpu, float16 or bfloat16 on
+# gpu) for mixed precision training
+#
+# numerically sensitive parts stay in float32 whatever the autocast state:
+# - the edge geometry: edge vectors and lengths, spherical harmonics, radial
+#   basis and smooth cutoff
+# - the output, which is cast back to float32 so that masks, losses and the
+#   density metrics are computed in float32
+# the convolutions and gates (the tensor products and radial networks, nearly
+# all of the time) run in the autocast dtype
+
+
+def get_autocast(device, precision):
+    # autocast context of --precision: 'fp32' (disabled), 'bf16' or 'fp16'
+    dtypes = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+    if precision not in dtypes:
+        raise ValueError("unknown precision " + str(precision))
+    device_type = device.type if hasattr(device, 'type') else str(device)
+    return torch.autocast(device_type=device_type, dtype=dtypes[precision], enabled=precision != 'fp32')
+
+
+def set_tf32(enabled):
+    # tensor float 32 matmuls and convolutions on ampere and later gpus
+    # (float32 inputs and outputs, 10 bit mantissa products)
+    torch.backends.cuda.matmul.allow_tf32 = enabled
+    torch.backends.cudnn.allow_tf32 = enabled
+
+
+# model_kwargs of tutorials/e3nnMLDFT.ipynb, training/train_density.py and
+# ml-dna/train_dna.py, for the scripts that build these models
+PRESETS = {
+    "tutorial": {
+        "irreps_in": "2x 0e",
+        "irreps_hidden": [(mul, (l, p)) for l, mul in enumerate([10,3,2,1]) for p in [-1, 1]],
+        "irreps_out": "12x0e + 5x1o + 4x2e + 2x3o + 1x4e",
+        "irreps_node_attr": None,
+        "irreps_edge_attr": o3.Irreps.spherical_harmonics(3),
+        "layers": 2,
+        "max_radius": 4.0,
+        "number_of_basis": 8,
+        "radial_layers": 1,
+        "radial_neurons": 64,
+        "num_neighbors": 12.2298,
+        "num_nodes": 24,
+        "reduce_output": False,
+    },
+    "water": {
+        "irreps_in": "2x 0e",
+        "irreps_hidden": [(mul, (l, p)) for l, mul in enumerate([125,40,25,15]) for p in [-1, 1]],
+        "irreps_out": "12x0e + 5x1o + 4x2e + 2x3o + 1x4e",
+        "irreps_node_attr": None,
+        "irreps_edge_attr": o3.Irreps.spherical_harmonics(3),
+        "layers": 3,
+        "max_radius": 3.5,
+        "number_of_basis": 10,
+        "radial_layers": 1,
+        "radial_neurons": 128,
+        "num_neighbors": 12.2298,
+        "num_nodes": 24,
+        "reduce_output": False,
+    },
+    "dna": {
+        "irreps_in": "5x 0e",
+        "irreps_hidden": [(mul, (l, p)) for l, mul in enumerate([200,67,40,29]) for p in [-1, 1]],
+        "irreps_out": "14x0e + 5x1o + 5x2e + 2x3o + 1x4e",
+        "irreps_node_attr": None,
+        "irreps_edge_attr": o3.Irreps.spherical_harmonics(3),
+        "layers": 5,
+        "max_radius": 3.5,
+        "num_neighbors": 12.666666,
+        "number_of_basis": 10,
+        "radial_layers": 1,
+        "radial_neurons": 128,
+        "num_nodes": 24,
+        "reduce_output": False,
+    },
+}
+
+
+def radius_graph(pos, r_max, batch):
+    # edge_index [2, E] of the atoms of the same graph closer than r_max, like
+    # the one of gate_points_2101 but with exact distances: above 25 points
+    # cdist switches to a matrix product, whose rounding leaves some self
+    # distances above 0, so r > 0 added self loops to batches of molecules
+    r = torch.cdist(pos, pos, compute_mode='donot_use_mm_for_euclid_dist')
+    index = ((r < r_max) & (batch[:, None] == batch[None, :])).nonzero().T
+    return index[:, index[0] != index[1]]
+
+
+class DensityNetwork(Network):
+    # same constructor and state_dict as Network, so weights of either load
+    # into the other
+    # batches of at least cell_list_atoms atoms get their radius graph from
+    # the O(N) cell list of neighbors.py instead of all the distances, which
+    # gives the same edges (in the same order); traced exports keep
+    # radius_graph, as the cell list is not traceable
+    # the default is the crossover of the graph stage of
+    # benchmarks/run_benchmarks.py (one thread, max_radius 3.5): the cell
+    # list is faster from 1000-1500 atoms of water and 2000-2500 of dna, and
+    # about 2x slower at 1000 atoms of dna
+
+    def __init__(self, *args, cell_list_atoms=2500, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cell_list_atoms = cell_list_atoms
+
+    def get_edges(self, data, batch):
+        # edge_src, edge_dst, edge_attr and edge_length_embedded of the graph
+        # of the atoms within max_radius, in float32
+        # data["edge_index"], when given, is used as the graph (a neighbor
+        # list of neighbors.py) instead of building it, with the lattice
+        # shifts data["edge_shift"] of its edges if it is periodic
+        # with data["cell"] (lattice vectors as rows, in the frame of pos,
+        # [3, 3] or one per graph) the graph is periodic
+        pos = data["pos"].float()
+        edge_shift = None
+        if "edge_index" in data:
+            edge_index = data["edge_index"]
+            if "edge_shift" in data:
+                edge_shift = data["edge_shift"]
+        elif "cell" in data:
+            edge_index, edge_shift = batched_periodic_radius_graph(pos, self.max_radius, data["cell"].float(), batch)
+        elif not torch.jit.is_tracing() and pos.shape[0] >= self.cell_list_atoms:
+            edge_index = cell_list_radius_graph(pos, self.max_radius, batch)
+        else:
+            edge_index = radius_graph(pos, self.max_radius, batch)
+        edge_src = edge_index[0]
+        edge_dst = edge_index[1]
+        edge_vec = pos[edge_src] - pos[edge_dst]
+        if edge_shift is not None:
+            edge_vec = edge_vec + edge_shift.float()
+        edge_sh = o3.spherical_harmonics(self.irreps_edge_attr, edge_vec, True, normalization="component")
+        edge_length = edge_vec.norm(dim=1)
+        edge_length_embedded = soft_one_hot_linspace(
+            x=edge_length, start=0.0, end=self.max_radius, number=self.number_of_basis, basis="gaussian", cutoff=False
+        ).mul(self.number_of_basis**0.5)
+        edge_attr = smooth_cutoff(edge_length / self.max_radius)[:, None] * edge_sh
+        return edge_src, edge_dst, edge_attr, edge_length_embedded
+
+    def forward(self, data):
+        if "batch" in data:
+            batch = data["batch"]
+        else:
+            batch = data["pos"].new_zeros(data["pos"].shape[0], dtype=torch.long)
+
+        device_type = data["pos"].device.type
+        with torch.autocast(device_type=device_type, enabled=False):
+            edge_src, edge_dst, edge_attr, edge_length_embedded = self.get_edges(data, batch)
+
+        if self.input_has_node_in and "x" in data:
+            assert self.irreps_in is not None
+            x = data["x"]
+        else:
+            assert self.irreps_in is None
+            x = data["pos"].new_ones((data["pos"].shape[0], 1))
+
+        if self.input_has_node_attr and "z" in data:
+            z = data["z"]
+        else:
+            assert self.irreps_node_attr == o3.Irreps("0e")
+            z = data["pos"].new_ones((data["pos"].shape[0], 1))
+
+        for lay in self.layers:
+            x = lay(x, z, edge_src, edge_dst, edge_attr, edge_length_embedded)
+
+        x = x.float()
+        if self.reduce_output:
+            return scatter(x, batch, dim_size=int(batch.max()) + 1).div(self.num_nodes**0.5)
+        return x
+
+
+class ExportedDensityNetwork(torch.nn.Module):
+    # inference entry point of an exported DensityNetwork: atoms as in
+    # create_dataset.py (pos_orig in angstrom), their onehot x and the graph
+    # of every atom in a batch, to the network outputs [N, num_coeffs]
+    # the radius graph is built inside, so nothing else is needed to predict
+
+    def __init__(self, network):
+        super().__init__()
+        self.network = network
+
+    def forward(self, pos_orig, x, batch):
+        # yzx -> xyz, as in get_iso_permuted_dataset
+        pos = pos_orig[:, [1, 2, 0]]
+        return self.network({"pos": pos, "x": x, "batch": batch})
+
+
+def get_example_atoms(num_atoms, num_elements, seed=0, density=0.1):
+    # random atoms (pos_orig, onehot, batch) at about the number density of
+    # liquid water (atoms per cubic angstrom), for tracing and parity checks
+    generator = torch.Generator().manual_seed(seed)
+    side = (num_atoms/density)**(1/3)
+    pos = torch.rand(num_atoms, 3, generator=generator)*side
+    x = torch.nn.functional.one_hot(torch.randint(num_elements, (num_atoms,), generator=generator), num_elements).float()
+    return pos, x, torch.zeros(num_atoms, dtype=torch.long)
+
+
+def get_serializable_kwargs(model_kwargs):
+    # model_kwargs with irreps as strings, for json
+    out = {}
+    for key, value in model_kwargs.items():
+        if key.startswith("irreps_") and value is not None:
+            value = str(o3.Irreps(value))
+        out[key] = value
+    return out
+
+
+def export_density_network(model, path, model_kwargs, sizes=(3, 12, 48, 150), atol=1e-5):
+    # torchscript archive of model (a DensityNetwork) with its radius graph,
+    # loadable with torch.jit.load alone (no e3nn or repository code)
+    # the trace is checked against the eager model on random molecules of
+    # every size in sizes and on a batch of two of them, and a ValueError is
+    # raised if any output differs by more than atol
+    # the model_kwargs and the parity are stored in the archive as meta.json
+    import copy
+    import json
+    from e3nn.util import jit
+
+    model = copy.deepcopy(model).cpu().eval()
+    num_elements = o3.Irreps(model_kwargs["irreps_in"]).dim
+    wrapper = ExportedDensityNetwork(jit.compile(copy.deepcopy(model)))
+    eager = ExportedDensityNetwork(model)
+
+    examples = [get_example_atoms(size, num_elements, seed=size) for size in sizes]
+    # the two molecules of the batch overlap in space, and each is compared
+    # with its own eager prediction
+    pos = torch.cat([examples[0][0], examples[-1][0]])
+    x = torch.cat([examples[0][1], examples[-1][1]])
+    batch = torch.cat([examples[0][2], examples[-1][2] + 1])
+    with torch.no_grad():
+        references = [eager(*example) for example in examples]
+        references.append(torch.cat([references[0], references[-1]]))
+    examples.append((pos, x, batch))
+
+    with torch.no_grad():
+        traced = torch.jit.trace(wrapper, examples[1], check_trace=False)
+    meta = {
+        "model_kwargs": get_serializable_kwargs(model_kwargs),
+        "inputs": "pos_orig [N, 3] angstrom float32, x onehot [N, E] float32, batch [N] int64",
+        "parity_sizes": list(sizes),
+        "torch": torch.__version__,
+    }
+    torch.jit.save(traced, path, _extra_files={"meta.json": json.dumps(meta)})
+
+    # parity of the archive as it will be loaded
+    loaded = torch.jit.load(path)
+    with torch.no_grad():
+        parity = max(float((loaded(*example) - reference).abs().max()) for example, reference in zip(examples, references))
+    if not parity <= atol:
+        raise ValueError("exported model differs from the eager model by " + str(parity))
+    meta["parity_max_abs_diff"] = parity
+    torch.jit.save(traced, path, _extra_files={"meta.json": json.dumps(meta)})
+    return loaded, meta
+
+
+def load_exported_network(path, device="cpu"):
+    # an archive of export_density_network and its meta.json
+    import json
+    extra = {"meta.json": ""}
+    module = torch.jit.load(path, map_location=device, _extra_files=extra)
+    return module.eval(), json.loads(extra["meta.json"])
+
+
+def get_receptive_field(network):
+    # distance from an atom beyond which atoms do not change its output:
+    # every convolution of network.layers (the gated ones and the last one)
+    # reaches max_radius further
+    return len(network.layers)*network.max_radius
+
+
+def get_domains(pos, block_size, halo):
+    # (core, block) of the cubic domains of side block_size that tile the
+    # atoms: block [B] are the atoms (ascending) within halo of the domain in
+    # every coordinate, and core the atoms of the domain, as indices into block
+    # domains without atoms are left out
+    lo = pos.min(dim=0).values
+    cells = torch.floor((pos - lo)/block_size).long()
+    keys, domain = torch.unique(cells, dim=0, return_inverse=True)
+    domains = []
+    for i, key in enumerate(keys):
+        start = lo + key*block_size
+        inside = ((pos >= start - halo) & (pos < start + block_size + halo)).all(dim=1)
+        block = torch.nonzero(inside).reshape(-1)
+        core = torch.nonzero(domain == i).reshape(-1)
+        domains.append((torch.searchsorted(block, core), block))
+    return domains
+
+
+domain_worker = {}
+
+def init_domain_worker(network, threads=None):
+    domain_worker.clear()
+    domain_worker['network'] = network.eval()
+    if threads is not None:
+        torch.set_num_threads(threads)
+
+
+def predict_domain(pos, x, core):
+    # outputs of the core atoms of one block, from the network of the worker
+    with torch.no_grad():
+        return domain_worker['network']({"pos": pos, "x": x})[core]
+
+
+def domain_decomposed_forward(network, pos, x, block_size=20.0, halo=None, workers=1):
+    # outputs [N, num_coeffs] of network for one system too large for a
+    # single pass (pos [N, 3] in the frame of the network, onehot x [N, E]),
+    # computed block by block (get_domains): each block holds a domain and the
+    # atoms within halo of it, and only the outputs of the domain's atoms
+    # are kept
+    # with halo at least the receptive field (the default), every atom a core
+    # output depends on is in its block, with the same edges in the same
+    # order, so the result agrees with the one of the whole system to float
+    # tolerance (the sums over the atoms of a block run in another order),
+    # and the memory is that of the largest block ((block_size + 2*halo)**3
+    # of atoms)
+    # with workers == 1 the blocks run on the device of network, and with
+    # workers > 1 on a process pool, each process with its own cpu copy of
+    # the network and torch.get_num_threads()//workers threads
+    # network is left in its mode and on its device; the outputs are on the
+    # device of pos
+    # returns the outputs and the statistics of the decomposition, as
+    # {'domains': number of blocks, 'largest_block': atoms of the largest}
+    import copy
+    from concurrent import futures
+    if halo is None:
+        halo = get_receptive_field(network)
+    device = next(network.parameters()).device
+    domains = get_domains(pos.cpu(), block_size, halo)
+    stats = {'domains': len(domains), 'largest_block': max(block.shape[0] for _, block in domains)}
+    training = network.training
+    if workers == 1:
+        # one block at a time on the device
+        init_domain_worker(network)
+        outputs = (predict_domain(pos[block].to(device), x[block].to(device), core.to(device)) for core, block in domains)
+    else:
+        pos_cpu, x_cpu = pos.cpu(), x.cpu()
+        tasks = [(pos_cpu[block], x_cpu[block], core) for core, block in domains]
+        pool = futures.ProcessPoolExecutor(max_workers=workers, initializer=init_domain_worker,
+                                           initargs=(copy.deepcopy(network).cpu(), max(torch.get_num_threads()//workers, 1)))
+        outputs = pool.map(predict_domain, *zip(*tasks))
+    out = None
+    try:
+        for (core, block), y in zip(domains, outputs):
+            if out is None:
+                out = torch.zeros(pos.shape[0], y.shape[1], dtype=y.dtype, device=pos.device)
+            out[block[core].to(pos.device)] = y.to(pos.device)
+    finally:
+        if workers != 1:
+            pool.shutdown()
+        network.train(training)
+        domain_worker.clear()
+    return out, stats
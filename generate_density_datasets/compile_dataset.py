@@ -0,0 +1,30 @@
+import sys
+import os
+import argparse
+
+# get the density_dataset.py module in the path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from density_dataset import compile_dataset
+
+# one-time conversion of a create_dataset.py pickle into the memory-mapped
+# format read by density_dataset.MemmapDensityDataset
+#
+# example:
+# python compile_dataset.py water_density_dataset.pkl water_density_dataset \
+#     --iso h_iso=../data/water/h_s_only_def2-universal-jfit-decontract_density.out \
+#           o_iso=../data/water/o_s_only_def2-universal-jfit-decontract_density.out
+
+def main():
+    parser = argparse.ArgumentParser(description='compile a density dataset into memory-mapped arrays')
+    parser.add_argument('dataset', type=str)
+    parser.add_argument('outdir', type=str)
+    parser.add_argument('--iso', type=str, nargs='+', default=[], help='isolated atom files as h_iso=path o_iso=path ...')
+    args = parser.parse_args()
+
+    atm_iso = dict(item.split('=', 1) for item in args.iso)
+    compile_dataset(args.dataset, args.outdir, **atm_iso)
+    print("compiled", args.dataset, "->", args.outdir)
+
+
+if __name__ == '__main__':
+    main()
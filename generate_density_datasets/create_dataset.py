@@ -2,7 +2,9 @@
 
 import sys
 import os
+import re
 import pickle
+import json
 import time
 import numpy as np
 import torch
@@ -10,7 +12,8 @@ import torch
 #sys.path.append("../")
 # get the utils.py module in the path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from utils import flatten_list
+from utils import permute_coeffs
+from density_dataset import get_onehot
 from itertools import zip_longest
 import periodictable as pt
 
@@ -22,78 +25,48 @@ def get_densities(filepath,dens_file,elements,num_atoms):
     - number of atoms
     
     returns:
-    - shape [N, X] list of basis function coefficients, where X is the number of basis functions per atom
+    - per atom arrays of basis function coefficients (e3nn ordering), exponents and norms, and the Rs of each atom
     """
     ## get density coefficients for each atom
     ## ordered in ascending l order
     ## also get Rs_out for each atom
     dens_file = filepath + "/" + dens_file
 
+    # one pass over the file, sorting each atom's functions by l
+    # (in file order within each l)
+    atom_functions = []
+    remaining = 0
+    with open (dens_file,"r") as density_file:
+        for line in density_file:
+            if (remaining > 0):
+                split = line.split()
+                l = int(split[0])
+                functions = atom_functions[-1].setdefault(l,([],[],[]))
+                functions[0].append(float(split[1]))
+                functions[1].append(float(split[2]))
+                functions[2].append(float(split[3]))
+                remaining -= 1
+            elif ("functions" in line):
+                remaining = int(line.split()[3])
+                atom_functions.append({})
+
     basis_coeffs = []
     basis_exponents = []
     basis_norms = []
-    num_basis_func = []
     Rs_outs = []
-    for l in range(0,20):
-        flag = 0
-        atom_index = -1
-        counter = 0
-        multiplicity = 0
-        with open (dens_file,"r") as density_file:
-            for line in density_file:
-                if (flag == 1):
-                    split = line.split()
-                    if (int(split[0])==l):
-                        basis_coeffs[atom_index].append(float(split[1]))
-                        basis_exponents[atom_index].append(float(split[2]))
-                        basis_norms[atom_index].append(float(split[3]))
-                        multiplicity += 1
-                    counter += 1
-                    if (counter == num_lines):
-                        flag = 0
-                        if (multiplicity != 0): 
-                            Rs_outs[atom_index].append((multiplicity//(2*l+1),l))
-                if ("functions" in line):
-                    num_lines = int(line.split()[3])
-                    num_basis_func.append(num_lines)
-                    counter = 0
-                    multiplicity = 0
-                    flag = 1
-                    atom_index += 1
-                    if (l == 0):
-                        basis_coeffs.append([])
-                        basis_exponents.append([])
-                        basis_norms.append([])
-                        Rs_outs.append([])
-
-
-    # break coefficients list up into l-based vectors
-    newbasis_coeffs = []
-    newbasis_exponents = []
-    newbasis_norms = []
-    atom_index = -1
-    for atom in Rs_outs:
-        atom_index += 1
-        counter = 0
-        newbasis_coeffs.append([])
-        newbasis_exponents.append([])
-        newbasis_norms.append([])
-        for Rs in atom:
-            number = Rs[0]
-            l = Rs[1]
-            for i in range(0,number):
-                newbasis_coeffs[atom_index].append(basis_coeffs[atom_index][counter:counter+(2*l+1)])
-                newbasis_exponents[atom_index].append(basis_exponents[atom_index][counter:counter+(2*l+1)])
-                newbasis_norms[atom_index].append(basis_norms[atom_index][counter:counter+(2*l+1)])
-                counter += 2*l+1
-    
-    Rs_out_list = []
-    elementdict = {}
-    for i, elem in enumerate(elements):
-        if elem not in elementdict:
-            elementdict[elem] = Rs_outs[i]
-            Rs_out_list.append(Rs_outs[i])
-    
+    for functions in atom_functions:
+        basis_coeffs.append([])
+        basis_exponents.append([])
+        basis_norms.append([])
+        Rs_outs.append([])
+        for l in sorted(functions):
+            coeffs, exponents, norms = functions[l]
+            basis_coeffs[-1].extend(coeffs)
+            basis_exponents[-1].extend(exponents)
+            basis_norms[-1].extend(norms)
+            Rs_outs[-1].append((len(coeffs)//(2*l+1),l))
+
+
     '''
     #psi4
     S: 0	
@@ -113,28 +86,12 @@ def get_densities(filepath,dens_file,elements,num_atoms):
     H: -5, -4, -3, -2, -1, 0, +1, +2, +3, +4, +5
     I: -6, -5, -4, -3, -2, -1, 0, +1, +2, +3, +4, +5, +6
     '''
-    
-    ##              s     p         d             f                 g                      h                           i
-    psi4_2_e3nn = [[0],[2,0,1],[4,2,0,1,3],[6,4,2,0,1,3,5],[8,6,4,2,0,1,3,5,7],[10,8,6,4,2,0,1,3,5,7,9],[12,10,8,6,4,2,0,1,3,5,7,9,11]]
-    
-    '''
-    test = [[0],[0, +1, -1],[0, +1, -1, +2, -2],[0, +1, -1, +2, -2, +3, -3],	
-            [0, +1, -1, +2, -2, +3, -3, +4, -4]]
-    for i, item in enumerate(test):
-        l = (len(item)-1)//2
-        print (l)
-        test[i] = [item[i] for i in psi4_2_e3nn[l]]
-    '''        
-
-
-    #change convention from psi4 to e3nn
-    for i, atom in enumerate(newbasis_coeffs):
-        for j, item in enumerate(atom):
-            l = (len(item)-1)//2
-            if l > 6:
-                raise ValueError('L is too high. Currently only supports L<7')
-            newbasis_coeffs[i][j] = [item[k] for k in psi4_2_e3nn[l]]
 
+    #change convention from psi4 to e3nn, one permutation per atom
+    #exponents and norms are the same for every m of a shell
+    newbasis_coeffs = [permute_coeffs(np.array(coeffs), Rs, to='e3nn') for coeffs, Rs in zip(basis_coeffs, Rs_outs)]
+    newbasis_exponents = [np.array(exponents) for exponents in basis_exponents]
+    newbasis_norms = [np.array(norms) for norms in basis_norms]
 
     return newbasis_coeffs, newbasis_exponents, newbasis_norms, Rs_outs
 
@@ -163,6 +120,68 @@ def get_energy_force(filepath,out_file,num_atoms):
 
 
 
+def read_xyz(inputfile):
+    """
+    reads an xyz file (a path, or the lines of one)
+
+    returns:
+    -shape [N, 3] numpy array of points
+    -shape [N] list of atomic numbers
+    -shape [N] numpy array of element symbols
+    """
+    if not isinstance(inputfile, str):
+        inputfile = list(inputfile)
+    points = np.loadtxt(inputfile, skiprows=2, usecols=range(1,4), ndmin=2)
+    elements = np.genfromtxt(inputfile, skip_header=2, usecols=0, dtype='str', ndmin=1)
+    element_types = [getattr(pt, i, None) for i in elements]
+    if not all(isinstance(i, pt.core.Element) for i in element_types):
+        raise ValueError("unknown element in " + str(elements.tolist()))
+    atomic_numbers = [i.number for i in element_types]
+    return points, atomic_numbers, elements
+
+
+def read_lattice(inputfile):
+    """
+    reads the lattice vectors of an extended xyz file (a path, or the lines
+    of one), given as Lattice="ax ay az bx by bz cx cy cz" on the comment line
+
+    returns:
+    -shape [3, 3] numpy array with the lattice vectors as rows, or None
+    """
+    if isinstance(inputfile, str):
+        with open(inputfile) as f:
+            lines = [f.readline(), f.readline()]
+    else:
+        lines = list(inputfile)
+    match = re.search(r'Lattice\s*=\s*"([^"]*)"', lines[1] if len(lines) > 1 else "")
+    if match is None:
+        return None
+    values = np.array(match.group(1).split(), dtype=float)
+    if values.size != 9:
+        raise ValueError("Lattice needs 9 numbers, not " + match.group(1))
+    return values.reshape(3, 3)
+
+
+def iter_xyz_frames(inputfile):
+    """
+    reads the frames of a multi-frame xyz file (a trajectory) one at a time
+
+    yields read_xyz of each frame, with the read_lattice of the frame
+    """
+    with open(inputfile) as f:
+        while True:
+            line = f.readline()
+            if not line:
+                return
+            if not line.strip():
+                continue
+            num_atoms = int(line.split()[0])
+            lines = [line, f.readline()] + [f.readline() for i in range(num_atoms)]
+            if not lines[-1].strip():
+                raise ValueError("truncated frame in " + inputfile)
+            yield read_xyz(lines) + (read_lattice(lines),)
+
+
 def get_coordinates(filepath,inputfile):
     """
     reads in coordinates and atomic number from psi4 input file
@@ -178,10 +197,8 @@ def get_coordinates(filepath,inputfile):
     if not os.path.exists(inputfile):
         inputfile = inputfile + ".xyz"
 
-    points = np.loadtxt(inputfile, skiprows=2, usecols=range(1,4))
+    points, atomic_numbers, elements = read_xyz(inputfile)
     numatoms = len(points)
-    elements = np.genfromtxt(inputfile, skip_header=2, usecols=0,dtype='str')
-    atomic_numbers = [getattr(pt,i).number for i in elements]
     unique_elements = len(np.unique(atomic_numbers))
     onehot = np.zeros((numatoms,unique_elements))
 
@@ -202,169 +219,355 @@ def get_coordinates(filepath,inputfile):
     return points, numatoms, atomic_numbers, elements, weighted_onehot
 
 
-def get_dataset(filepath):
-    dataset = []
-
-    #coeff_by_type_list = []
-    for filename in sorted(os.listdir(filepath)):
-        if filename.endswith("density.out"):
-            # read in stuff
-            densityfile = filename
-            split = filename.split("_")
-            xyzfile = split[0] + "_" + split[1]
-            print(xyzfile)
-            doforces = True
-            outfile = "output_" + xyzfile + ".dat" 
-            if not os.path.exists(filepath + outfile):
-                outfile = "output_" + xyzfile + ".xyz.dat"
-                if not os.path.exists(filepath + outfile):
-                    outfile = xyzfile + "_output.dat"
-                    if not os.path.exists(filepath + outfile):
-                        outfile = xyzfile + ".xyz_output.dat"
-                        if not os.path.exists(filepath + outfile):
-                            doforces = False
-                            print("No energies or forces because ", outfile, "does not exist")
-
-            # read in xyz file
-            # get number of atoms
-            # get onehot encoding
-            points, num_atoms, atomic_numbers, elements, weighted_onehot = get_coordinates(filepath,xyzfile)
-            N = num_atoms
-
-            # construct one hot encoding
-            onehot = weighted_onehot
-            # replace all nonzero values with 1
-            onehot[onehot > 0.001] = 1
-
-
-            # read in density file
-            coefficients, exponents, norms, Rs_out_list = get_densities(filepath,densityfile,elements,N)
-            
-            if doforces:
-                energy, forces = get_energy_force(filepath,outfile,N)
+def get_rs_out_max(Rs_out_list):
+    # compute Rs_out_max
+    # this is necessary because O and H have different Rs_out
+    # to deal with this, I set the global Rs_out to be the maximum
+    # basically, for each L, 
+    # i take whichever entry that has the higher multiplicity
+    a = list(zip_longest(*Rs_out_list))
+    # remove Nones
+    b = [[v if v is not None else (0,0) for v in nested] for nested in a]
 
-            # compute Rs_out_max
-            # this is necessary because O and H have different Rs_out
-            # to deal with this, I set the global Rs_out to be the maximum
-            # basically, for each L, 
-            # i take whichever entry that has the higher multiplicity
+    Rs_out_max = []
+    for rss in b:
+        Rs_out_max.append(max(rss))
 
-            from itertools import zip_longest
+    return Rs_out_max
 
-            #print(Rs_out_list)
 
-            a = list(zip_longest(*Rs_out_list))
-            # remove Nones
-            b = [[v if v is not None else (0,0) for v in nested] for nested in a]
+def get_density_files(filepath):
+    return [filename for filename in sorted(os.listdir(filepath)) if filename.endswith("density.out")]
 
-            Rs_out_max = []
-            for rss in b:
-                Rs_out_max.append(max(rss))
 
-            ## now construct coefficient, exponent and norm arrays
-            ## from Rs_out_max
-            ## pad with zeros
+def get_input_files(filepath,densityfile):
+    # names of the xyz file and the psi4 output file that go with a density
+    # file, with outfile None if there is no output file
+    split = densityfile.split("_")
+    xyzfile = split[0] + "_" + split[1]
+    outfile = "output_" + xyzfile + ".dat" 
+    if not os.path.exists(os.path.join(filepath, outfile)):
+        outfile = "output_" + xyzfile + ".xyz.dat"
+        if not os.path.exists(os.path.join(filepath, outfile)):
+            outfile = xyzfile + "_output.dat"
+            if not os.path.exists(os.path.join(filepath, outfile)):
+                outfile = xyzfile + ".xyz_output.dat"
+                if not os.path.exists(os.path.join(filepath, outfile)):
+                    outfile = None
+    return xyzfile, outfile
 
-            coeff_dim = 0
-            for mul, l in Rs_out_max:
-                coeff_dim += mul*((2*l) + 1)
-            
-            rect_coeffs = torch.zeros(len(Rs_out_list),coeff_dim)
-            rect_expos = torch.zeros(len(Rs_out_list),coeff_dim)
-            rect_norms = torch.zeros(len(Rs_out_list),coeff_dim)
 
-            for i, (atom, coeff_list, expo_list, norm_list) in enumerate(zip(Rs_out_list, coefficients, exponents, norms)):
-                counter = 0
-                list_counter = 0
-                for (mul, l), (max_mul, max_l) in zip(atom, Rs_out_max):
-                    n = mul*((2*l) + 1)
-                    rect_coeffs[i,counter:counter+n] = torch.Tensor(list(flatten_list(coeff_list[list_counter:list_counter+mul])))
-                    rect_expos[i,counter:counter+n] = torch.Tensor(list(flatten_list(expo_list[list_counter:list_counter+mul])))
-                    rect_norms[i,counter:counter+n] = torch.Tensor(list(flatten_list(norm_list[list_counter:list_counter+mul])))
-                    list_counter += mul
-                    max_n = max_mul*((2*max_l)+1)
-                    counter += max_n
-
-            if doforces:
-                cluster_dict = {
-                    'type' : torch.Tensor(atomic_numbers),
-                    'pos' : torch.Tensor(points),
-                    'onehot' : torch.Tensor(onehot),
-                    'coefficients' : rect_coeffs,
-                    'exponents' : rect_expos,
-                    'norms' : rect_norms,
-                    'rs_max' : Rs_out_max,
-                    'energy' : torch.Tensor(energy),
-                    'forces' : torch.Tensor(forces),
-                }
-            else:
-                cluster_dict = {
-                    'type' : torch.Tensor(atomic_numbers),
-                    'pos' : torch.Tensor(points),
-                    'onehot' : torch.Tensor(onehot),
-                    'coefficients' : rect_coeffs,
-                    'exponents' : rect_expos,
-                    'norms' : rect_norms,
-                    'rs_max' : Rs_out_max,
-                }
-
-            dataset.append(cluster_dict)
+def get_molecule(filepath,densityfile):
+    # read in stuff
+    xyzfile, outfile = get_input_files(filepath,densityfile)
+    print(xyzfile)
+    doforces = outfile is not None
+    if not doforces:
+        print("No energies or forces because ", xyzfile + ".xyz_output.dat", "does not exist")
+
+    # read in xyz file
+    # get number of atoms
+    # get onehot encoding
+    points, num_atoms, atomic_numbers, elements, weighted_onehot = get_coordinates(filepath,xyzfile)
+    N = num_atoms
+
+    # construct one hot encoding
+    onehot = weighted_onehot
+    # replace all nonzero values with 1
+    onehot[onehot > 0.001] = 1
+
+
+    # read in density file
+    coefficients, exponents, norms, Rs_out_list = get_densities(filepath,densityfile,elements,N)
+    
+    if doforces:
+        energy, forces = get_energy_force(filepath,outfile,N)
+
+    Rs_out_max = get_rs_out_max(Rs_out_list)
+
+    ## now construct coefficient, exponent and norm arrays
+    ## from Rs_out_max
+    ## pad with zeros
+
+    coeff_dim = 0
+    for mul, l in Rs_out_max:
+        coeff_dim += mul*((2*l) + 1)
+    
+    rect_coeffs = torch.zeros(len(Rs_out_list),coeff_dim)
+    rect_expos = torch.zeros(len(Rs_out_list),coeff_dim)
+    rect_norms = torch.zeros(len(Rs_out_list),coeff_dim)
+
+    for i, (atom, atom_coeffs, atom_expos, atom_norms) in enumerate(zip(Rs_out_list, coefficients, exponents, norms)):
+        counter = 0
+        atom_counter = 0
+        for (mul, l), (max_mul, max_l) in zip(atom, Rs_out_max):
+            n = mul*((2*l) + 1)
+            rect_coeffs[i,counter:counter+n] = torch.from_numpy(atom_coeffs[atom_counter:atom_counter+n])
+            rect_expos[i,counter:counter+n] = torch.from_numpy(atom_expos[atom_counter:atom_counter+n])
+            rect_norms[i,counter:counter+n] = torch.from_numpy(atom_norms[atom_counter:atom_counter+n])
+            atom_counter += n
+            max_n = max_mul*((2*max_l)+1)
+            counter += max_n
+
+    cluster_dict = {
+        'type' : torch.Tensor(atomic_numbers),
+        'pos' : torch.Tensor(points),
+        'onehot' : torch.Tensor(onehot),
+        'coefficients' : rect_coeffs,
+        'exponents' : rect_expos,
+        'norms' : rect_norms,
+        'rs_max' : Rs_out_max,
+    }
+    if doforces:
+        cluster_dict['energy'] = torch.Tensor(energy)
+        cluster_dict['forces'] = torch.Tensor(forces)
+
+    return cluster_dict
+
+
+def parse_molecules(filepath,densityfiles,workers=1):
+    # molecules in the order of densityfiles, parsed by a process pool
+    # and yielded as they complete
+    if workers <= 1:
+        for densityfile in densityfiles:
+            yield get_molecule(filepath,densityfile)
+        return
+
+    from multiprocessing import Pool
+    from functools import partial
+    with Pool(workers) as pool:
+        yield from pool.imap(partial(get_molecule,filepath),densityfiles)
+
+
+def get_dataset(filepath,workers=1):
+    dataset = list(parse_molecules(filepath,get_density_files(filepath),workers))
 
     # reset onehot based on whole dataset
     # need list of unique atomic numbers, in ascending order
     # then iterate through atoms
     # onehot[i, index_of_matching_atom_in_unique_elements] = 1
-    # look up how to get index- np.where
-   
     all_anum = []
     for item in dataset:
-        anum = item["type"]
-        all_anum.extend(anum)
+        all_anum.extend(item["type"].tolist())
     
     unique_elements = np.unique(all_anum)
-    num_unique_elements = len(unique_elements)
-
     for item in dataset:
-        numatoms = item['pos'].shape[0]
-        onehot = np.zeros((numatoms,num_unique_elements))
-        for i, num in enumerate(item["type"]):
-            n = num.item()
-            index = np.where(unique_elements == n)
-            onehot[i, index] = 1
-        item['onehot'] = torch.Tensor(onehot)
-
+        item['onehot'] = get_onehot(item['type'],unique_elements)
 
     # now get Rs_out_max for whole dataset
-    all_rs = []
-    for item in dataset:
-        rs = item["rs_max"]
-        all_rs.append(rs)
-    
-    #print(all_rs)
+    Rs_out_max = get_rs_out_max([item["rs_max"] for item in dataset])
+    print("irreps_out",Rs_out_max)
 
-    a = list(zip_longest(*all_rs))
-    # remove Nones
-    b = [[v if v is not None else (0,0) for v in nested] for nested in a]
+    return dataset
 
-    Rs_out_max = []
-    for rss in b:
-        Rs_out_max.append(max(rss))
-    
+
+def write_shard(filepath,outdir,shard,densityfiles):
+    # parse one shard of density files and write it atomically,
+    # returning the summary that goes in the shard's .json file
+    molecules = [get_molecule(filepath,densityfile) for densityfile in densityfiles]
+
+    summary = {
+        'files' : densityfiles,
+        'num_molecules' : len(molecules),
+        'num_atoms' : sum(molecule['pos'].shape[0] for molecule in molecules),
+        'elements' : sorted(set(z for molecule in molecules for z in molecule['type'].tolist())),
+        'rs_max' : get_rs_out_max([molecule['rs_max'] for molecule in molecules]),
+    }
+
+    name = os.path.join(outdir, shard)
+    with open(name + ".pkl.tmp", 'wb') as f:
+        pickle.dump(molecules,f)
+    os.replace(name + ".pkl.tmp", name + ".pkl")
+    with open(name + ".json.tmp", 'w') as f:
+        json.dump(summary,f)
+    os.replace(name + ".json.tmp", name + ".json")
+
+    return shard, summary
+
+
+def write_shard_task(task):
+    return write_shard(*task)
+
+
+def read_shard_summary(outdir,shard,densityfiles):
+    # summary of a shard that is already written for the same density files,
+    # or None if the shard has to be (re)built
+    name = os.path.join(outdir, shard)
+    if not (os.path.exists(name + ".pkl") and os.path.exists(name + ".json")):
+        return None
+    with open(name + ".json") as f:
+        summary = json.load(f)
+    if summary['files'] != densityfiles:
+        return None
+    return summary
+
+
+def write_meta(outdir,summaries):
+    # global element table and Rs_out_max over all shards
+    elements = sorted(set(z for summary in summaries.values() for z in summary['elements']))
+    Rs_out_max = get_rs_out_max([[tuple(rs) for rs in summary['rs_max']] for summary in summaries.values()])
+
+    meta = {
+        'format' : 'density_shards',
+        'shards' : [shard + ".pkl" for shard in sorted(summaries)],
+        'num_molecules' : sum(summary['num_molecules'] for summary in summaries.values()),
+        'num_atoms' : sum(summary['num_atoms'] for summary in summaries.values()),
+        'elements' : elements,
+        'rs_max' : [list(rs) for rs in Rs_out_max],
+    }
+    with open(os.path.join(outdir, "meta.json.tmp"), 'w') as f:
+        json.dump(meta,f,indent=1)
+    os.replace(os.path.join(outdir, "meta.json.tmp"), os.path.join(outdir, "meta.json"))
     print("irreps_out",Rs_out_max)
 
-    return dataset
+    return meta
+
+
+def get_fingerprint(path,previous=None,hash=True):
+    # size, mtime and sha256 of a file. the hash is only computed when the
+    # size or mtime differ from the previous fingerprint, and not at all with
+    # hash=False (sha256 is then None)
+    stat = os.stat(path)
+    if previous is not None and previous['size'] == stat.st_size and previous['mtime'] == stat.st_mtime_ns:
+        return previous
+    if not hash:
+        return {'size' : stat.st_size, 'mtime' : stat.st_mtime_ns, 'sha256' : None}
+
+    import hashlib
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return {'size' : stat.st_size, 'mtime' : stat.st_mtime_ns, 'sha256' : sha.hexdigest()}
+
+
+def get_fingerprints(filepath,densityfile,previous=None,hash=True):
+    # fingerprints of every input file of one molecule
+    previous = previous or {}
+    xyzfile, outfile = get_input_files(filepath,densityfile)
+    if not os.path.exists(os.path.join(filepath, xyzfile)):
+        xyzfile = xyzfile + ".xyz"
+    names = [densityfile, xyzfile] + ([outfile] if outfile is not None else [])
+    return {name: get_fingerprint(os.path.join(filepath, name), previous.get(name), hash) for name in names}
+
+
+def same_inputs(a,b):
+    # same files with the same sha256, or the same size and mtime for files
+    # fingerprinted without a hash
+    def key(f):
+        return f['sha256'] if f['sha256'] is not None else (f['size'], f['mtime'])
+    return {name: key(f) for name, f in a.items()} == {name: key(f) for name, f in b.items()}
+
+
+def get_sharded_dataset(filepath,outdir,shard_size=1000,workers=1,append=False):
+    # streaming version of get_dataset for large folders
+    # density files are split into shards of shard_size molecules, and each
+    # shard is parsed by a worker and written as soon as it is done, so memory
+    # use is bounded by the shards in flight. shards already written for the
+    # same files are skipped, so an interrupted build can be rerun to resume.
+    # the global onehot is applied on load (density_dataset.load_molecules)
+    # from the element table in meta.json
+    #
+    # manifest.json records the input files of every molecule (size, mtime,
+    # sha256) and its shard. with append=True only molecules that are new or
+    # whose inputs changed are parsed: shards with changed or deleted molecules
+    # are rewritten, new molecules go to new shards, and the other shards and
+    # their summaries are reused as they are
+    # files are only hashed with append=True, and then only those whose size
+    # or mtime changed; a build without it records size and mtime alone
+    os.makedirs(outdir, exist_ok=True)
+    manifest_file = os.path.join(outdir, "manifest.json")
+    manifest = {}
+    if append and os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+
+    shards = {}
+    changed = set()
+    new_files = []
+    fingerprints = {}
+    for densityfile in get_density_files(filepath):
+        entry = manifest.get(densityfile)
+        fingerprints[densityfile] = get_fingerprints(filepath,densityfile,entry['inputs'] if entry else None,hash=append)
+        if entry is None:
+            new_files.append(densityfile)
+            continue
+        shards.setdefault(entry['shard'], []).append(densityfile)
+        if not same_inputs(entry['inputs'],fingerprints[densityfile]):
+            changed.add(entry['shard'])
+
+    # shards that lost molecules
+    for densityfile, entry in manifest.items():
+        if densityfile not in fingerprints:
+            changed.add(entry['shard'])
+            shards.setdefault(entry['shard'], [])
+
+    # new molecules go to new shards, numbered after the existing ones
+    first = max((int(shard.split("_")[-1]) + 1 for shard in shards), default=0)
+    for i in range(0,len(new_files),shard_size):
+        shards["shard_{:06d}".format(first + i//shard_size)] = new_files[i:i+shard_size]
+
+    summaries = {}
+    todo = []
+    for shard, files in sorted(shards.items()):
+        if not files:
+            for ext in (".pkl", ".json"):
+                if os.path.exists(os.path.join(outdir, shard + ext)):
+                    os.remove(os.path.join(outdir, shard + ext))
+            continue
+        summary = None if shard in changed else read_shard_summary(outdir,shard,files)
+        if summary is None:
+            todo.append((filepath,outdir,shard,files))
+        else:
+            summaries[shard] = summary
+    print("shards", len(summaries) + len(todo), "already written", len(summaries), "to build", len(todo))
+
+    if workers <= 1:
+        for task in todo:
+            shard, summary = write_shard(*task)
+            summaries[shard] = summary
+            print("wrote", shard)
+    else:
+        from multiprocessing import Pool
+        with Pool(workers) as pool:
+            for shard, summary in pool.imap_unordered(write_shard_task, todo):
+                summaries[shard] = summary
+                print("wrote", shard)
+
+    meta = write_meta(outdir,summaries)
+
+    manifest = {}
+    for shard, summary in summaries.items():
+        for densityfile in summary['files']:
+            manifest[densityfile] = {'shard' : shard, 'inputs' : fingerprints[densityfile]}
+    with open(manifest_file + ".tmp", 'w') as f:
+        json.dump(manifest,f)
+    os.replace(manifest_file + ".tmp", manifest_file)
+
+    return meta
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='create a density dataset from psi4 outputs')
+    parser.add_argument('datapath', type=str)
+    parser.add_argument('output', type=str, help='pickle file, or output folder with --shard_size')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--shard_size', type=int, default=0, help='write shards of this many molecules to the output folder')
+    parser.add_argument('--append', action='store_true', help='only parse new or changed files into an existing shard folder')
+    args = parser.parse_args()
+
+    if args.shard_size > 0:
+        get_sharded_dataset(args.datapath,args.output,args.shard_size,args.workers,args.append)
+    else:
+        dataset = get_dataset(args.datapath,args.workers)
+        pickle_file = open(args.output, 'wb')
+        pickle.dump(dataset,pickle_file)
+
 
 ###############################
 # Start Program
 ##############################
 
-
-datapath = sys.argv[1]
-picklename = sys.argv[2]
-dataset = get_dataset(datapath)
-
-#print("TACO")
-#print(dataset[0])
-
-pickle_file = open(picklename, 'wb')
-pickle.dump(dataset,pickle_file)
+if __name__ == '__main__':
+    main()
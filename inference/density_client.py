@@ -0,0 +1,74 @@
+import json
+import time
+import argparse
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# client of density_server.py: the coefficients of xyz files, or with
+# --concurrency > 1 a load test of the warm server (latency percentiles and
+# molecules and atoms per second)
+#
+# python density_client.py --url http://localhost:8000 --output coefficients.json ../tests/test_data_generation/w4_00
+# python density_client.py --url http://localhost:8000 --concurrency 16 --repeat 8 ../tests/test_data_generation/w4_0*
+
+
+def request_density(url, xyz, timeout=600):
+    # result of the server for one xyz text, or a list of results for a list
+    body = xyz.encode() if isinstance(xyz, str) else json.dumps({'xyz': xyz}).encode()
+    request = urllib.request.Request(url.rstrip("/") + "/predict", data=body, method="POST")
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            result = json.loads(response.read())
+    except urllib.error.HTTPError as error:
+        raise ValueError(json.loads(error.read()).get('error', str(error)))
+    return result if isinstance(xyz, str) else result['molecules']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='query a density_server.py')
+    parser.add_argument('xyz', type=str, nargs='+', help='xyz files')
+    parser.add_argument('--url', type=str, default="http://127.0.0.1:8000")
+    parser.add_argument('--concurrency', type=int, default=1, help='requests in flight')
+    parser.add_argument('--repeat', type=int, default=1, help='times each file is sent')
+    parser.add_argument('--output', type=str, default=None, help='write the results (of the last repeat) as json')
+    args = parser.parse_args()
+
+    texts = []
+    for path in args.xyz:
+        with open(path) as f:
+            texts.append(f.read())
+
+    def timed(text):
+        start = time.perf_counter()
+        result = request_density(args.url, text)
+        return time.perf_counter() - start, result
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        answers = list(pool.map(timed, texts*args.repeat))
+    seconds = time.perf_counter() - start
+
+    latency = np.array([answer[0] for answer in answers])
+    atoms = sum(answer[1]['atoms'] for answer in answers)
+    summary = {
+        'requests': len(answers),
+        'concurrency': args.concurrency,
+        'seconds': seconds,
+        'molecules_per_s': len(answers)/seconds,
+        'atoms_per_s': atoms/seconds,
+        'latency_p50': float(np.percentile(latency, 50)),
+        'latency_p95': float(np.percentile(latency, 95)),
+        'mean_batch_molecules': float(np.mean([answer[1]['batch_molecules'] for answer in answers])),
+    }
+    print(json.dumps(summary, indent=1))
+
+    if args.output is not None:
+        results = {path: result for path, (_, result) in zip(args.xyz, answers[-len(texts):])}
+        with open(args.output, 'w') as f:
+            json.dump(results, f)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+import sys
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import torch
+import periodictable as pt
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "generate_density_datasets"))
+from utils import get_ml_psi4_coeffs
+from density_dataset import get_onehot
+from create_dataset import read_xyz
+from inference_setup import get_rs, load_network, add_model_arguments, load_references, get_atom_tables
+
+# long lived http server for ml densities of xyz structures
+# the model is loaded once (an archive of export_model.py, or weights and
+# model_kwargs), concurrent requests are batched together up to --max_atoms
+# and every molecule gets back its full coefficients (isolated atoms added
+# back) in psi4 ordering, with the exponents and norms of its basis
+# the basis, the elements and the isolated atoms are read as described in
+# inference_setup.py
+#
+# python density_server.py --model water.pt --reference ../tests/test_data_generation/testdata_w4.pkl --iso_dir ../data/water --port 8000
+# curl --data-binary @w4_00.xyz localhost:8000/predict
+# python density_client.py --url http://localhost:8000 ../tests/test_data_generation/w4_0*.xyz
+
+
+def load_model(args, device):
+    # (module, model_kwargs): module(pos_orig, x, batch) returns the network
+    # outputs of every atom
+    if args.model is not None:
+        extra = {"meta.json": ""}
+        module = torch.jit.load(args.model, map_location=device, _extra_files=extra)
+        return module.eval(), json.loads(extra["meta.json"])["model_kwargs"]
+
+    from density_network import ExportedDensityNetwork
+    network, model_kwargs = load_network(args.weights, args.model_kwargs, args.preset)
+    return ExportedDensityNetwork(network).to(device).eval(), model_kwargs
+
+
+class DensityPredictor:
+    # xyz text to molecules, and batches of molecules to full coefficients
+    # in psi4 ordering (utils.get_ml_psi4_coeffs, with the standardizer of
+    # train_density.py --standardize if there is one)
+
+    def __init__(self, model, rs, elements, exp_table, norm_table, iso_table, supported, standardizer=None, device="cpu"):
+        self.model = model
+        self.rs = rs
+        self.elements = elements
+        self.device = torch.device(device)
+        self.exp_table = exp_table
+        self.norm_table = norm_table.to(self.device)
+        self.iso_table = iso_table
+        self.supported = supported.clone()
+        self.supported[:] = False
+        for z in elements:
+            if z < supported.shape[0] and supported[z]:
+                self.supported[z] = True
+        self.standardizer = standardizer.to(self.device) if standardizer is not None else None
+        coeff_dim = sum(mul*(2*l + 1) for mul, l in rs)
+        if norm_table.shape[1] != coeff_dim:
+            raise ValueError("reference basis has " + str(norm_table.shape[1]) + " coefficients per atom, the model " + str(coeff_dim))
+
+    def get_molecule(self, text):
+        # an xyz structure (as read by create_dataset.py) as pos [N, 3],
+        # atomic numbers [N] and onehot [N, E]
+        points, atomic_numbers, elements = read_xyz(text.strip().splitlines())
+        z = torch.tensor(atomic_numbers, dtype=torch.long)
+        if z.numel() == 0:
+            raise ValueError("no atoms in the xyz structure")
+        if z.max() >= self.supported.shape[0] or not self.supported[z].all():
+            raise ValueError("elements " + str(sorted(set(elements.tolist()))) + " are not all supported, the model has "
+                             + str(self.elements) + " with isolated atoms for " + str(self.supported.nonzero().reshape(-1).tolist()))
+        return {
+            'pos': torch.tensor(points, dtype=torch.float32),
+            'z': z,
+            'onehot': get_onehot(atomic_numbers, self.elements),
+        }
+
+    def predict(self, molecules):
+        # one forward pass over all molecules, results in request order
+        counts = [molecule['z'].shape[0] for molecule in molecules]
+        pos = torch.cat([molecule['pos'] for molecule in molecules]).to(self.device)
+        x = torch.cat([molecule['onehot'] for molecule in molecules]).to(self.device)
+        z = torch.cat([molecule['z'] for molecule in molecules])
+        batch = torch.repeat_interleave(torch.arange(len(molecules)), torch.tensor(counts)).to(self.device)
+
+        # every batch has a new number of atoms, and the profiling executor
+        # of torchscript would stall to respecialize the archive for each
+        with torch.no_grad(), torch.jit.optimized_execution(False):
+            y = self.model(pos, x, batch)
+            norms, iso_c = get_atom_tables(z, self.norm_table, self.iso_table, self.supported)
+            coeffs = get_ml_psi4_coeffs(y, x, norms, iso_c, self.rs, self.standardizer).double().cpu().numpy()
+        exps = self.exp_table[z].numpy()
+        norms = norms.cpu().numpy()
+
+        results = []
+        for molecule, start, count in zip(molecules, np.cumsum([0] + counts[:-1]), counts):
+            atoms = slice(start, start + count)
+            results.append({
+                'atoms': count,
+                'atomic_numbers': molecule['z'].tolist(),
+                'rs': self.rs,
+                'ordering': 'psi4',
+                'coefficients': coeffs[atoms].tolist(),
+                'exponents': exps[atoms].tolist(),
+                'norms': norms[atoms].tolist(),
+            })
+        return results
+
+
+class DynamicBatcher:
+    # one worker thread that runs the predictor on everything submitted
+    # while it was busy (or within max_wait seconds of the first request),
+    # up to max_atoms atoms per batch; a molecule larger than max_atoms runs
+    # alone
+
+    def __init__(self, predictor, max_atoms=2048, max_wait=0.005):
+        self.predictor = predictor
+        self.max_atoms = max_atoms
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.stats = {'batches': 0, 'molecules': 0, 'atoms': 0, 'model_seconds': 0.0}
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, molecule):
+        future = Future()
+        self.requests.put((molecule, future))
+        return future
+
+    def get_batch(self, first):
+        batch = [first]
+        atoms = first[0]['z'].shape[0]
+        deadline = time.perf_counter() + self.max_wait
+        while atoms < self.max_atoms:
+            try:
+                item = self.requests.get(timeout=max(deadline - time.perf_counter(), 0))
+            except queue.Empty:
+                return batch, None
+            if atoms + item[0]['z'].shape[0] > self.max_atoms:
+                return batch, item
+            batch.append(item)
+            atoms += item[0]['z'].shape[0]
+        return batch, None
+
+    def run(self):
+        left = None
+        while True:
+            batch, left = self.get_batch(left if left is not None else self.requests.get())
+            start = time.perf_counter()
+            try:
+                results = self.predictor.predict([molecule for molecule, _ in batch])
+            except Exception as error:
+                for _, future in batch:
+                    future.set_exception(error)
+                continue
+            seconds = time.perf_counter() - start
+            self.stats['batches'] += 1
+            self.stats['molecules'] += len(batch)
+            self.stats['atoms'] += sum(result['atoms'] for result in results)
+            self.stats['model_seconds'] += seconds
+            for (_, future), result in zip(batch, results):
+                result['batch_molecules'] = len(batch)
+                result['batch_seconds'] = seconds
+                future.set_result(result)
+
+
+class DensityRequestHandler(BaseHTTPRequestHandler):
+    # POST /predict with an xyz file as the body, or json {"xyz": text} or
+    # {"xyz": [text, ...]}; GET /health for the model and batching stats
+    batcher = None
+    info = {}
+    verbose = False
+
+    def send_json(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip("/") != "/health":
+            return self.send_json(404, {'error': "unknown path " + self.path})
+        self.send_json(200, dict(self.info, status='ok', **self.batcher.stats))
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/predict":
+            return self.send_json(404, {'error': "unknown path " + self.path})
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+        try:
+            texts = json.loads(body)["xyz"] if body.lstrip().startswith("{") else body
+            single = isinstance(texts, str)
+            molecules = [self.batcher.predictor.get_molecule(text) for text in ([texts] if single else texts)]
+        except (ValueError, KeyError, TypeError, IndexError) as error:
+            return self.send_json(400, {'error': str(error)})
+        futures = [self.batcher.submit(molecule) for molecule in molecules]
+        try:
+            results = [future.result() for future in futures]
+        except Exception as error:
+            return self.send_json(500, {'error': str(error)})
+        self.send_json(200, results[0] if single else {'molecules': results})
+
+    def log_message(self, format, *args):
+        if self.verbose:
+            super().log_message(format, *args)
+
+
+def get_server(predictor, host="127.0.0.1", port=8000, max_atoms=2048, max_wait=0.005, info=None, verbose=False):
+    # ThreadingHTTPServer for predictor, call serve_forever() to run it
+    # (port 0 picks a free port, see server.server_address)
+    handler = type("Handler", (DensityRequestHandler,), {
+        'batcher': DynamicBatcher(predictor, max_atoms=max_atoms, max_wait=max_wait),
+        'info': info or {},
+        'verbose': verbose,
+    })
+    # the default listen backlog of 5 drops the connections of concurrent
+    # clients beyond it, which then retry a second later
+    server_class = type("Server", (ThreadingHTTPServer,), {'request_queue_size': 256, 'daemon_threads': True})
+    return server_class((host, port), handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='serve ml densities of xyz structures over http')
+    parser.add_argument('--model', type=str, default=None, help='torchscript archive of export_model.py, instead of --weights')
+    add_model_arguments(parser)
+    parser.add_argument('--host', type=str, default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max_atoms', type=int, default=2048, help='atoms per batch')
+    parser.add_argument('--max_wait_ms', type=float, default=5.0, help='time to wait for more requests after the first one of a batch')
+    parser.add_argument('--device', type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument('--threads', type=int, default=None, help='torch threads')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+    if (args.model is None) == (args.weights is None):
+        parser.error("give one of --model and --weights")
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    model, model_kwargs = load_model(args, args.device)
+    elements, exp_table, norm_table, iso_table, supported, standardizer = load_references(args)
+    predictor = DensityPredictor(model, get_rs(model_kwargs["irreps_out"]), elements, exp_table, norm_table,
+                                 iso_table, supported, standardizer=standardizer, device=args.device)
+
+    # the first passes (tracing, allocator) are slow, so warm up before serving
+    # on a row of one atom of every supported element
+    symbols = [pt.elements[z].symbol for z in predictor.supported.nonzero().reshape(-1).tolist()]
+    warm = str(len(symbols)) + "\n\n" + "".join(symbol + " %.1f 0.0 0.0\n" % (1.2*i) for i, symbol in enumerate(symbols))
+    for _ in range(3):
+        predictor.predict([predictor.get_molecule(warm)])
+
+    info = {'model': args.model or args.weights, 'elements': elements, 'rs': predictor.rs, 'device': args.device,
+            'max_atoms': args.max_atoms, 'max_wait_ms': args.max_wait_ms}
+    server = get_server(predictor, args.host, args.port, args.max_atoms, args.max_wait_ms/1000, info, args.verbose)
+    print("serving", json.dumps(info), "on http://%s:%d" % server.server_address[:2], flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+import sys
+import os
+import json
+import time
+import argparse
+import numpy as np
+import torch
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "generate_density_datasets"))
+from utils import get_ml_psi4_coeffs
+from density_dataset import get_onehot
+from density_network import domain_decomposed_forward, get_receptive_field
+from create_dataset import read_xyz
+from inference_setup import get_rs, load_network, add_model_arguments, load_references, get_atom_tables
+
+# ml density of one system too large for a single forward pass (a solvated
+# nucleosome), by spatial domain decomposition: the atoms are split into
+# cubic domains of --block_size, each run with the atoms within --halo of it
+# (the receptive field of the network by default, so the outputs agree with
+# those of the whole system to float tolerance) and only the outputs of the
+# domain's atoms are kept
+# peak memory is that of one block, and --workers runs blocks in processes
+# the full coefficients (psi4 ordering, isolated atoms added back), the
+# positions, atomic numbers, exponents and norms are written to --output as
+# .npy files with a meta.json
+#
+# python domain_inference.py system.xyz --output system_density --weights model_weights_epoch_500.pt --model_kwargs model_kwargs.json --reference ../tests/test_data_generation/testdata_w4.pkl --iso_dir ../data/water --block_size 30 --workers 4
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ml density of a large system, block by block')
+    parser.add_argument('xyz', type=str, help='xyz file of the system')
+    parser.add_argument('--output', type=str, help='folder for the coefficients')
+    add_model_arguments(parser)
+    parser.add_argument('--block_size', type=float, default=30.0, help='side of the domains in angstrom')
+    parser.add_argument('--halo', type=float, default=None, help='angstrom around each domain, the receptive field of the network by default')
+    parser.add_argument('--workers', type=int, default=1, help='processes running blocks')
+    parser.add_argument('--threads', type=int, default=None, help='torch threads')
+    parser.add_argument('--check', action='store_true', help='also run the whole system at once and report the largest difference')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    network, model_kwargs = load_network(args.weights, args.model_kwargs, args.preset)
+    rs = get_rs(model_kwargs["irreps_out"])
+    elements, exp_table, norm_table, iso_table, supported, standardizer = load_references(args)
+
+    with open(args.xyz) as f:
+        points, atomic_numbers, _ = read_xyz(f.read().strip().splitlines())
+    z = torch.tensor(atomic_numbers, dtype=torch.long)
+    if z.numel() == 0:
+        raise ValueError("no atoms in " + args.xyz)
+    if z.max() >= supported.shape[0] or not supported[z].all() or not np.isin(atomic_numbers, elements).all():
+        raise ValueError("elements " + str(sorted(set(atomic_numbers))) + " are not all supported, the model has " + str(elements))
+    # yzx -> xyz, as in get_iso_permuted_dataset
+    pos = torch.tensor(np.array(points), dtype=torch.float32)[:, [1, 2, 0]]
+    x = get_onehot(atomic_numbers, elements)
+    halo = args.halo if args.halo is not None else get_receptive_field(network)
+
+    start = time.perf_counter()
+    y, stats = domain_decomposed_forward(network, pos, x, args.block_size, halo, args.workers)
+    seconds = time.perf_counter() - start
+    meta = {'xyz': args.xyz, 'atoms': len(atomic_numbers), 'rs': rs, 'ordering': 'psi4', 'block_size': args.block_size, 'halo': halo,
+            **stats, 'seconds': seconds}
+    if args.check:
+        with torch.no_grad():
+            meta['whole_system_max_abs_diff'] = float((network({"pos": pos, "x": x}) - y).abs().max())
+
+    with torch.no_grad():
+        norms, iso_c = get_atom_tables(z, norm_table, iso_table, supported)
+        coeffs = get_ml_psi4_coeffs(y, x, norms, iso_c, rs, standardizer).numpy()
+
+    os.makedirs(args.output, exist_ok=True)
+    arrays = {'coefficients': coeffs, 'positions': np.array(points, dtype=np.float32), 'atomic_numbers': z.numpy(),
+              'exponents': exp_table[z].numpy(), 'norms': norms.numpy()}
+    for name, array in arrays.items():
+        np.save(os.path.join(args.output, name + ".npy"), array)
+    with open(os.path.join(args.output, "meta.json"), 'w') as f:
+        json.dump(meta, f, indent=1)
+    print(json.dumps(meta))
+
+
+if __name__ == '__main__':
+    main()
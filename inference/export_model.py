@@ -0,0 +1,48 @@
+import sys
+import os
+import json
+import argparse
+import torch
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from density_network import DensityNetwork, export_density_network, PRESETS
+
+# export of a trained density model to a standalone torchscript archive
+# the archive holds the network and its radius graph, takes the atoms as in
+# create_dataset.py (pos_orig in angstrom, onehot elements, batch) and returns
+# the density coefficients (e3nn ordering); it is checked against the eager
+# model before it is written, and loads with torch.jit.load alone:
+#
+#   extra = {"meta.json": ""}
+#   model = torch.jit.load("water.pt", _extra_files=extra)
+#   y = model(pos_orig, x, batch)
+#
+# python export_model.py --weights model_weights_epoch_500.pt --model_kwargs model_kwargs.json --output water.pt
+# python export_model.py --weights ../data/water/checkpoint500.pth --preset tutorial --output tutorial.pt
+
+
+def main():
+    parser = argparse.ArgumentParser(description='export a trained density model to torchscript')
+    parser.add_argument('--weights', type=str, help='state_dict of the trained model')
+    parser.add_argument('--output', type=str, help='torchscript archive to write')
+    parser.add_argument('--preset', type=str, default='water', choices=sorted(PRESETS))
+    parser.add_argument('--model_kwargs', type=str, default=None, help='json of the model_kwargs (model_kwargs.json of train_density.py), instead of --preset')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[3, 12, 48, 150], help='atoms of the random molecules of the parity check')
+    parser.add_argument('--atol', type=float, default=1e-5, help='largest difference from the eager model')
+    args = parser.parse_args()
+
+    if args.model_kwargs is not None:
+        with open(args.model_kwargs) as f:
+            model_kwargs = json.load(f)
+    else:
+        model_kwargs = PRESETS[args.preset]
+
+    model = DensityNetwork(**model_kwargs)
+    model.load_state_dict(torch.load(args.weights, map_location='cpu'))
+
+    _, meta = export_density_network(model, args.output, model_kwargs, sizes=args.sizes, atol=args.atol)
+    print(json.dumps(meta, indent=1))
+    print("wrote", args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import sys
+import os
+import json
+import torch
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from density_dataset import load_molecules, get_iso_table, subtract_iso, find_iso_files, Standardizer
+
+# model and reference loading shared by density_server.py,
+# trajectory_inference.py and domain_inference.py; the network outputs become
+# full coefficients with utils.get_ml_psi4_coeffs
+#
+# the exponents and norms of each element and the onehot (ascending atomic
+# numbers) come from --reference, a create_dataset.py pickle or shard folder
+# with the basis set of the training data, and the isolated atoms from the
+# <element>_s_only_*_density.out files in --iso_dir
+
+
+def get_rs(irreps):
+    # [(mul, l), ...] of an irreps string such as "12x0e + 5x1o"
+    rs = []
+    for term in str(irreps).replace(" ", "").split("+"):
+        mul, ir = term.split("x") if "x" in term else (1, term)
+        rs.append((int(mul), int(ir[:-1])))
+    return rs
+
+
+def get_basis_tables(reference):
+    # elements (ascending atomic numbers) of a reference dataset and the
+    # exponent and norm rows of each of them, as [max_z + 1, width] tables
+    # indexed by atomic number like get_iso_table
+    rows = {}
+    for molecule in load_molecules(reference):
+        for z, exps, norms in zip(molecule['type'].long().tolist(), molecule['exponents'], molecule['norms']):
+            if z not in rows:
+                rows[z] = (exps.float(), norms.float())
+    elements = sorted(rows)
+    width = max(exps.shape[0] for exps, _ in rows.values())
+    exp_table = torch.zeros(elements[-1] + 1, width)
+    norm_table = torch.zeros(elements[-1] + 1, width)
+    for z, (exps, norms) in rows.items():
+        exp_table[z, :exps.shape[0]] = exps
+        norm_table[z, :norms.shape[0]] = norms
+    return elements, exp_table, norm_table
+
+
+def load_network(weights, model_kwargs=None, preset='water'):
+    # (DensityNetwork, model_kwargs) of saved weights, with the model_kwargs
+    # of a json file (model_kwargs.json of train_density.py) or of a preset
+    # of density_network.py
+    from density_network import DensityNetwork, get_serializable_kwargs, PRESETS
+    if model_kwargs is not None:
+        with open(model_kwargs) as f:
+            model_kwargs = json.load(f)
+    else:
+        model_kwargs = get_serializable_kwargs(PRESETS[preset])
+    network = DensityNetwork(**model_kwargs)
+    network.load_state_dict(torch.load(weights, map_location='cpu'))
+    return network.eval(), model_kwargs
+
+
+def add_model_arguments(parser):
+    # the arguments read by load_network and load_references
+    parser.add_argument('--weights', type=str, default=None, help='state_dict of a trained model')
+    parser.add_argument('--model_kwargs', type=str, default=None, help='json of the model_kwargs of --weights')
+    parser.add_argument('--preset', type=str, default='water', help='model_kwargs of density_network.PRESETS for --weights without --model_kwargs')
+    parser.add_argument('--standardization', type=str, default=None, help='standardization.pt of a model trained with --standardize')
+    parser.add_argument('--reference', type=str, help='dataset (pickle or shard folder) with the basis set and elements of the training data')
+    parser.add_argument('--iso_dir', type=str, help='folder with the <element>_s_only_*_density.out files')
+    parser.add_argument('--iso_prefix', type=str, default="")
+
+
+def load_references(args):
+    # (elements, exp_table, norm_table, iso_table, supported, standardizer)
+    # of the arguments of add_model_arguments, standardizer None without
+    # --standardization
+    elements, exp_table, norm_table = get_basis_tables(args.reference)
+    iso_table, supported = get_iso_table(**find_iso_files(args.iso_dir, args.iso_prefix))
+    standardizer = Standardizer(**torch.load(args.standardization, map_location='cpu')) if args.standardization is not None else None
+    return elements, exp_table, norm_table, iso_table, supported, standardizer
+
+
+def get_atom_tables(z, norm_table, iso_table, supported):
+    # norms [N, C] and isolated atom coefficients [N, C] of the atoms with
+    # atomic numbers z [N], on the device of norm_table
+    norms = norm_table[z.to(norm_table.device)]
+    _, iso_c = subtract_iso(torch.zeros_like(norms), z, iso_table, supported)
+    return norms, iso_c
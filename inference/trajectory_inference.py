@@ -0,0 +1,208 @@
+import sys
+import os
+import json
+import time
+import argparse
+import numpy as np
+import torch
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "generate_density_datasets"))
+from utils import get_ml_psi4_coeffs
+from density_dataset import get_onehot
+from neighbors import VerletList
+from create_dataset import iter_xyz_frames
+from inference_setup import get_rs, load_network, add_model_arguments, load_references, get_atom_tables
+
+# ml densities of every frame of a trajectory (a multi-frame xyz file)
+# frames are streamed in groups of --batch_frames, which run as one batch
+# the atoms are the same in every frame, so their onehot, norms, exponents
+# and isolated atom coefficients are gathered once and stay on the device,
+# and the radius graph comes from a verlet list (neighbors.py) that is only
+# rebuilt once an atom has moved more than --skin/2
+# frames with a Lattice="..." (extended xyz), or all frames with --cell, are
+# periodic: their graph has the edges to the periodic images of the atoms
+# the full coefficients (psi4 ordering, isolated atoms added back) and the
+# positions are written to --output in chunks of --chunk_frames frames, with
+# meta.json rewritten after every chunk, so memory stays bounded and a
+# stopped run keeps the frames it has written; read them with
+# iter_density_trajectory
+#
+# python trajectory_inference.py md.xyz --output md_density --weights model_weights_epoch_500.pt --model_kwargs model_kwargs.json --reference ../tests/test_data_generation/testdata_w4.pkl --iso_dir ../data/water
+
+
+class ChunkedTrajectoryWriter:
+    # per frame arrays (positions [F, N, 3], coefficients [F, N, C] and the
+    # cells [F, 3, 3] of periodic trajectories) appended in any number of
+    # frames at a time and written every chunk_frames frames as
+    # <name>_<chunk>.npy, with the per atom arrays of static (atomic numbers,
+    # exponents, norms) written once
+
+    def __init__(self, outdir, chunk_frames, static, meta):
+        os.makedirs(outdir, exist_ok=True)
+        self.outdir = outdir
+        self.chunk_frames = chunk_frames
+        self.arrays = {}
+        self.buffered = 0
+        self.meta = dict(meta, format='density_trajectory', frames=0, chunk_frames=chunk_frames, chunks=[], static={})
+        for name, array in static.items():
+            np.save(os.path.join(outdir, name + ".npy"), array)
+            self.meta['static'][name] = name + ".npy"
+
+    def append(self, **arrays):
+        for name, array in arrays.items():
+            self.arrays.setdefault(name, []).append(array)
+        self.buffered += arrays['positions'].shape[0]
+        while self.buffered >= self.chunk_frames:
+            self.flush(self.chunk_frames)
+
+    def flush(self, frames):
+        chunk = {'frames': frames}
+        for name, arrays in self.arrays.items():
+            array = np.concatenate(arrays)
+            chunk[name] = name + "_%05d.npy" % len(self.meta['chunks'])
+            np.save(os.path.join(self.outdir, chunk[name]), array[:frames])
+            self.arrays[name] = [array[frames:]]
+        self.buffered -= frames
+        self.meta['chunks'].append(chunk)
+        self.meta['frames'] += frames
+        self.write_meta()
+
+    def write_meta(self):
+        with open(os.path.join(self.outdir, "meta.json"), 'w') as f:
+            json.dump(self.meta, f, indent=1)
+
+    def close(self, **meta):
+        if self.buffered:
+            self.flush(self.buffered)
+        self.meta.update(meta)
+        self.write_meta()
+        return self.meta
+
+
+def iter_density_trajectory(outdir):
+    # (positions [N, 3], coefficients [N, C]) of every frame written by
+    # trajectory_inference.py, memory mapped one chunk at a time, with the
+    # cell [3, 3] of the frame for periodic trajectories
+    with open(os.path.join(outdir, "meta.json")) as f:
+        meta = json.load(f)
+    if meta.get('format') != 'density_trajectory':
+        raise ValueError(outdir + " is not a density trajectory.")
+    for chunk in meta['chunks']:
+        positions = np.load(os.path.join(outdir, chunk['positions']), mmap_mode='r')
+        coefficients = np.load(os.path.join(outdir, chunk['coefficients']), mmap_mode='r')
+        if 'cells' in chunk:
+            yield from zip(positions, coefficients, np.load(os.path.join(outdir, chunk['cells'])))
+        else:
+            yield from zip(positions, coefficients)
+
+
+class TrajectoryPredictor:
+    # the network and the static data of the atoms of one trajectory
+    # predict takes frames [F, N, 3] (pos_orig, angstrom), and their cells
+    # [F, 3, 3] (lattice vectors as rows) if they are periodic, and returns
+    # the full coefficients [F, N, C] in psi4 ordering
+
+    def __init__(self, network, rs, atomic_numbers, elements, norm_table, iso_table, supported, skin=1.0, standardizer=None, device="cpu"):
+        self.network = network.to(device)
+        self.rs = rs
+        self.device = torch.device(device)
+        z = torch.tensor(atomic_numbers, dtype=torch.long)
+        if z.max() >= supported.shape[0] or not supported[z].all() or not np.isin(atomic_numbers, elements).all():
+            raise ValueError("elements " + str(sorted(set(atomic_numbers))) + " are not all supported, the model has " + str(elements))
+        self.x = get_onehot(atomic_numbers, elements).to(self.device)
+        self.norms, self.iso_c = get_atom_tables(z, norm_table.to(self.device), iso_table, supported)
+        self.standardizer = standardizer.to(self.device) if standardizer is not None else None
+        self.neighbors = VerletList(network.max_radius, skin)
+
+    def predict(self, frames, cells=None):
+        num_frames, num_atoms = frames.shape[:2]
+        # yzx -> xyz, as in get_iso_permuted_dataset (for the cells as well)
+        pos = torch.from_numpy(frames).float().to(self.device)[:, :, [1, 2, 0]]
+        if cells is not None:
+            cells = torch.from_numpy(cells).float().to(self.device)[:, :, [1, 2, 0]]
+        edge_index, edge_shift = [], []
+        for i, frame in enumerate(pos):
+            frame_index, frame_shift = self.neighbors.get_edges(frame, None if cells is None else cells[i])
+            edge_index.append(frame_index + i*num_atoms)
+            edge_shift.append(frame_shift)
+        data = {
+            'pos': pos.reshape(-1, 3),
+            'x': self.x.repeat(num_frames, 1),
+            'batch': torch.arange(num_frames, device=self.device).repeat_interleave(num_atoms),
+            'edge_index': torch.cat(edge_index, dim=1),
+        }
+        if cells is not None:
+            data['edge_shift'] = torch.cat(edge_shift)
+        with torch.no_grad():
+            y = self.network(data).reshape(num_frames, num_atoms, -1)
+            return get_ml_psi4_coeffs(y, self.x, self.norms, self.iso_c, self.rs, self.standardizer).cpu().numpy()
+
+
+def iter_frame_batches(path, batch_frames, max_frames=None, cell=None):
+    # (atomic numbers, frames [F, N, 3], cells [F, 3, 3] or None) of up to
+    # batch_frames frames at a time; the cells are the Lattice of the frames
+    # (extended xyz), or cell for all of them
+    atomic_numbers, frames, cells = None, [], []
+    for i, (points, frame_numbers, _, lattice) in enumerate(iter_xyz_frames(path)):
+        if max_frames is not None and i >= max_frames:
+            break
+        if atomic_numbers is None:
+            atomic_numbers = frame_numbers
+            periodic = cell is not None or lattice is not None
+        elif frame_numbers != atomic_numbers:
+            raise ValueError("frame " + str(i) + " of " + path + " does not have the atoms of the first frame")
+        if cell is None and periodic != (lattice is not None):
+            raise ValueError("frame " + str(i) + " of " + path + " has a Lattice where the first frame does not, or the other way around")
+        frames.append(points)
+        cells.append(cell if cell is not None else lattice)
+        if len(frames) == batch_frames:
+            yield atomic_numbers, np.stack(frames), np.stack(cells) if periodic else None
+            frames, cells = [], []
+    if frames:
+        yield atomic_numbers, np.stack(frames), np.stack(cells) if periodic else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ml densities of the frames of a trajectory')
+    parser.add_argument('trajectory', type=str, help='multi-frame xyz file')
+    parser.add_argument('--output', type=str, help='folder for the chunked coefficients')
+    add_model_arguments(parser)
+    parser.add_argument('--skin', type=float, default=1.0, help='verlet skin in angstrom')
+    parser.add_argument('--cell', type=float, nargs=9, default=None, help='lattice vectors (ax ay az bx by bz cx cy cz) of a periodic trajectory without Lattice in its frames')
+    parser.add_argument('--batch_frames', type=int, default=16, help='frames per forward pass')
+    parser.add_argument('--chunk_frames', type=int, default=1000, help='frames per output chunk')
+    parser.add_argument('--max_frames', type=int, default=None)
+    parser.add_argument('--device', type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument('--threads', type=int, default=None, help='torch threads')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    network, model_kwargs = load_network(args.weights, args.model_kwargs, args.preset)
+    rs = get_rs(model_kwargs["irreps_out"])
+    elements, exp_table, norm_table, iso_table, supported, standardizer = load_references(args)
+
+    predictor, writer = None, None
+    start = time.perf_counter()
+    cell = np.array(args.cell).reshape(3, 3) if args.cell is not None else None
+    for atomic_numbers, frames, cells in iter_frame_batches(args.trajectory, args.batch_frames, args.max_frames, cell):
+        if predictor is None:
+            predictor = TrajectoryPredictor(network, rs, atomic_numbers, elements, norm_table, iso_table, supported,
+                                            skin=args.skin, standardizer=standardizer, device=args.device)
+            z = np.array(atomic_numbers)
+            static = {'atomic_numbers': z, 'exponents': exp_table[z].numpy(), 'norms': norm_table[z].numpy()}
+            meta = {'trajectory': args.trajectory, 'atoms': len(z), 'rs': rs, 'ordering': 'psi4', 'skin': args.skin, 'periodic': cells is not None}
+            writer = ChunkedTrajectoryWriter(args.output, args.chunk_frames, static, meta)
+        arrays = {'positions': frames.astype(np.float32), 'coefficients': predictor.predict(frames, cells)}
+        if cells is not None:
+            arrays['cells'] = cells
+        writer.append(**arrays)
+    if writer is None:
+        raise ValueError("no frames in " + args.trajectory)
+    seconds = time.perf_counter() - start
+    meta = writer.close(neighbor_list_builds=predictor.neighbors.builds, seconds=seconds)
+    print(json.dumps({key: meta[key] for key in ['frames', 'atoms', 'neighbor_list_builds', 'seconds']}), "frames/s", meta['frames']/seconds)
+
+
+if __name__ == '__main__':
+    main()
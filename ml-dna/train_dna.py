@@ -1,12 +1,15 @@
+import sys
+import os
 import math
 import numpy as np
 import torch
 import torch_geometric
 from torch_cluster import radius_graph
 from torch_scatter import scatter
-from utils import get_iso_permuted_dataset
 from utils import get_scalar_density_comparisons
-from e3nn.nn.models.gate_points_2101 import Network
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from density_dataset import compile_dataset, MemmapDensityDataset, SizeBucketSampler, get_num_atoms, get_graph_sum, get_graph_mse
+from density_network import DensityNetwork
 from e3nn import o3
 import wandb
 import random
@@ -39,14 +42,26 @@ train_datasets = ["1at-400.pkl",
 
 print(train_datasets)
 
+# compile each pickle once into memory-mapped arrays next to it,
+# later runs and epochs only map the files
+def get_compiled_dataset(datafile):
+    compiled = os.path.splitext(datafile)[0] + "_compiled"
+    if not os.path.exists(os.path.join(compiled, "meta.json")):
+        compile_dataset(datafile,compiled,h_iso=hhh,c_iso=ccc,n_iso=nnn,o_iso=ooo,p_iso=ppp)
+    return MemmapDensityDataset(compiled)
+
+train_datasets = {data_file: get_compiled_dataset(data_file) for data_file in train_datasets}
+
 test_datafile = "2mer-test.pkl"
-test_dataset = get_iso_permuted_dataset(test_datafile,h_iso=hhh,c_iso=ccc,n_iso=nnn,o_iso=ooo,p_iso=ppp)
-random.shuffle(test_dataset)
+test_dataset = get_compiled_dataset(test_datafile)
 
+# molecules per batch, or set max_atoms to batch by total number of atoms
 b = 1
+max_atoms = None
 train_split = [100]
 
-test_loader = torch_geometric.data.DataLoader(test_dataset, batch_size=b, shuffle=True)
+test_sampler = SizeBucketSampler(get_num_atoms(test_dataset), batch_size=b, max_atoms=max_atoms)
+test_loader = torch_geometric.data.DataLoader(test_dataset, batch_sampler=test_sampler)
 num_epochs = 251
 
 # second, check if num_ele is correct
@@ -72,7 +87,7 @@ for train_size in train_split:
             "reduce_output": False,
     }
 
-    model = Network(**model_kwargs)
+    model = DensityNetwork(**model_kwargs)
 
     optim = torch.optim.Adam(model.parameters(), lr=1e-2)
     optim.zero_grad()
@@ -102,26 +117,33 @@ for train_size in train_split:
 
             print("Data file: ", data_file)
 
-            train_dataset = get_iso_permuted_dataset(data_file,h_iso=hhh,c_iso=ccc,n_iso=nnn,o_iso=ooo,p_iso=ppp)
-            random.shuffle(train_dataset)
-            train_loader = torch_geometric.data.DataLoader(train_dataset[:train_size], batch_size=b, shuffle=True)
+            train_dataset = train_datasets[data_file]
+            indices = list(range(len(train_dataset)))
+            random.shuffle(indices)
+            train_subset = torch.utils.data.Subset(train_dataset, indices[:train_size])
+            train_sampler = SizeBucketSampler(get_num_atoms(train_subset), batch_size=b, max_atoms=max_atoms)
+            train_loader = torch_geometric.data.DataLoader(train_subset, batch_sampler=train_sampler)
 
             for step, data in enumerate(train_loader):
+                data = data.to(device)
                 mask = torch.where(data.y == 0, torch.zeros_like(data.y), torch.ones_like(data.y)).detach()
-                y_ml = model(data.to(device))*mask.to(device)
-                err = (y_ml - data.y.to(device))
+                y_ml = model(data)*mask
+                err = (y_ml - data.y)
 
+                # number of electrons of each molecule
                 for mul, l in Rs:
                     if l == 0:
-                        num_ele = sum(sum(y_ml[:,:mul])).detach()
+                        num_ele = get_graph_sum(y_ml[:,:mul], data.batch, data.num_graphs).detach()
                 
-                train_num_ele.append(num_ele.item())
+                train_num_ele.extend(num_ele.tolist())
                 
-                mue_cum += num_ele
-                mae_cum += abs(num_ele)
+                mue_cum += num_ele.sum()
+                mae_cum += num_ele.abs().sum()
  
-                loss_cum += err.pow(2).mean().detach().abs()
-                err.pow(2).mean().backward()
+                # mean of the per molecule losses
+                loss = get_graph_mse(err, data.batch, data.num_graphs)
+                loss_cum += loss.sum().detach().abs()
+                loss.mean().backward()
                 optim.step()
                 optim.zero_grad()
         
@@ -141,26 +163,29 @@ for train_size in train_split:
                 eps_cum = 0.0
                 ele_diff_cum = 0.0
                 for step, data in enumerate(testset):
+                    data = data.to(device)
                     mask = torch.where(data.y == 0, torch.zeros_like(data.y), torch.ones_like(data.y)).detach()
-                    y_ml = model(data.to(device))*mask.to(device)
-                    err = (y_ml - data.y.to(device))
+                    y_ml = model(data)*mask
+                    err = (y_ml - data.y)
 
                     for mul, l in Rs:
                         if l == 0:
-                            num_ele = sum(sum(y_ml[:,:mul])).detach()
+                            num_ele = get_graph_sum(y_ml[:,:mul], data.batch, data.num_graphs).detach()
 
-                    test_num_ele.append(num_ele.item())
+                    test_num_ele.extend(num_ele.tolist())
 
-                    test_mue_cum += num_ele
-                    test_mae_cum += abs(num_ele)
-                    test_loss_cum += err.pow(2).mean().detach().abs()
+                    test_mue_cum += num_ele.sum()
+                    test_mae_cum += num_ele.abs().sum()
+                    test_loss_cum += get_graph_mse(err, data.batch, data.num_graphs).sum().detach().abs()
 
                     if (epoch != 0 and epoch%10==0):
-                        num_ele_target, num_ele_ml, bigI, ep = get_scalar_density_comparisons(data, y_ml, Rs, spacing=0.2, buffer=4.0)
-                        n_ele = np.sum(data.z.cpu().detach().numpy())
-                        ele_diff_cum += np.abs(n_ele-num_ele_target)
-                        bigIs_cum += bigI
-                        eps_cum += ep
+                        # density comparisons are done one molecule at a time
+                        for g, molecule in enumerate(data.to_data_list()):
+                            num_ele_target, num_ele_ml, bigI, ep = get_scalar_density_comparisons(molecule, y_ml[data.batch == g], Rs, spacing=0.2, buffer=4.0)
+                            n_ele = np.sum(molecule.z.cpu().detach().numpy())
+                            ele_diff_cum += np.abs(n_ele-num_ele_target)
+                            bigIs_cum += bigI
+                            eps_cum += ep
 
                         ele_diff_cum_save = ele_diff_cum
                         bigIs_cum_save = bigIs_cum
@@ -183,14 +208,14 @@ for train_size in train_split:
             "Train_STDEV": train_stdev,
             "Train_tot": train_tot,
 
-            "test_Loss": float(metrics[0][0].item())/len(test_loader),
-            "test_MAE": metrics[0][1].item()/len(test_loader),
-            "test_MUE": metrics[0][2].item()/len(test_loader),
+            "test_Loss": float(metrics[0][0].item())/len(test_dataset),
+            "test_MAE": metrics[0][1].item()/len(test_dataset),
+            "test_MUE": metrics[0][2].item()/len(test_dataset),
             "test_STDEV": test_stdev,
 
-            "test electron difference": ele_diff_cum/len(test_loader),
-            "test big I": bigIs_cum/len(test_loader),
-            "test epsilon": eps_cum/len(test_loader),
+            "test electron difference": ele_diff_cum/len(test_dataset),
+            "test big I": bigIs_cum/len(test_dataset),
+            "test epsilon": eps_cum/len(test_dataset),
 
         })
 
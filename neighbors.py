@@ -0,0 +1,206 @@
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+import torch
+
+# neighbor lists for the radius graph of DensityNetwork, for inputs that
+# change a little at a time (frames of a trajectory) and for periodic cells
+#
+# a periodic graph has an edge_shift [E, 3] next to its edge_index: the edge
+# vector of an edge is pos[src] - pos[dst] + edge_shift, so edges between
+# periodic images (and between an atom and its own images, in cells smaller
+# than the cutoff) are all there. cells are [3, 3], with the lattice vectors
+# as rows, in the frame of pos
+
+
+def get_cell_heights(cell):
+    # distances between the opposite faces of a cell
+    volume = torch.det(cell).abs()
+    areas = torch.stack([torch.linalg.cross(cell[1], cell[2]).norm(), torch.linalg.cross(cell[2], cell[0]).norm(), torch.linalg.cross(cell[0], cell[1]).norm()])
+    return volume/areas
+
+
+def periodic_radius_graph(pos, r_max, cell):
+    # (edge_index [2, E], edge_shift [E, 3]) of the atoms of a periodic cell
+    # closer than r_max, in the order of density_network.radius_graph
+    # (sorted by source, then destination) and without the self pairs
+    # the atoms are wrapped into the cell and binned on a grid of the cell
+    # with bins at least r_max wide (between opposite faces), so each atom
+    # only sees the atoms of the bins next to its own and the cost is O(N);
+    # bins past a face wrap around to the other side with a lattice shift
+    cell = cell.to(pos.dtype)
+    frac = pos @ torch.linalg.inv(cell)
+    wrap = torch.floor(frac)
+    frac = frac - wrap
+    wrapped = frac @ cell
+
+    heights = get_cell_heights(cell)
+    nbins = torch.clamp(torch.floor(heights/r_max), min=1).long()
+    # a cell thinner than r_max needs more than one bin (image) each way
+    reach = torch.ceil(r_max*nbins/heights).long().tolist()
+    bins = torch.minimum((frac*nbins).long(), nbins - 1)
+
+    def get_bin_id(bins):
+        return (bins[:, 0]*nbins[1] + bins[:, 1])*nbins[2] + bins[:, 2]
+
+    bin_id = get_bin_id(bins)
+    order = torch.argsort(bin_id)
+    counts = torch.bincount(bin_id, minlength=int(nbins.prod()))
+    starts = torch.cumsum(counts, 0) - counts
+
+    num_atoms = pos.shape[0]
+    edge_src, edge_dst, edge_image = [], [], []
+    for offset in itertools.product(*[range(-r, r + 1) for r in reach]):
+        # the atoms of the bin at offset from the bin of every atom (dst)
+        target = bins + torch.tensor(offset, device=pos.device)
+        image = torch.div(target, nbins, rounding_mode='floor')
+        target_id = get_bin_id(target - image*nbins)
+        target_counts = counts[target_id]
+        dst = torch.repeat_interleave(torch.arange(num_atoms, device=pos.device), target_counts)
+        first = torch.cumsum(target_counts, 0) - target_counts
+        within = torch.arange(dst.shape[0], device=pos.device) - first[dst]
+        src = order[starts[target_id][dst] + within]
+        image = image[dst]
+
+        edge_vec = wrapped[src] + image.to(pos.dtype) @ cell - wrapped[dst]
+        keep = (edge_vec.norm(dim=1) < r_max) & ((src != dst) | (image != 0).any(dim=1))
+        edge_src.append(src[keep])
+        edge_dst.append(dst[keep])
+        edge_image.append(image[keep])
+
+    edge_src = torch.cat(edge_src)
+    edge_dst = torch.cat(edge_dst)
+    # lattice shift of the edge for the unwrapped positions
+    edge_image = torch.cat(edge_image) - wrap[edge_src].long() + wrap[edge_dst].long()
+    order = torch.argsort(edge_src*num_atoms + edge_dst, stable=True)
+    return torch.stack([edge_src[order], edge_dst[order]]), edge_image[order].to(pos.dtype) @ cell
+
+
+def cell_list_radius_graph(pos, r_max, batch=None, num_threads=None, chunk_atoms=16384):
+    # edge_index [2, E] of the atoms of the same graph closer than r_max, the
+    # edges of density_network.radius_graph (in its order) in O(N) time and
+    # memory instead of the O(N^2) of all the distances
+    # atoms are hashed to cubic bins of side r_max, keyed by graph and bin, and
+    # each atom only sees the atoms of the 27 bins around its own; the bins
+    # are looked up by binary search in the sorted keys of the occupied bins,
+    # so sparse atoms (or batches of molecules far apart) cost nothing extra
+    # the atoms run in chunks of chunk_atoms, which bounds the memory of the
+    # candidate pairs, on num_threads threads (torch.get_num_threads() by
+    # default) that run in parallel as torch releases the gil in its ops
+    num_atoms = pos.shape[0]
+    if batch is None:
+        batch = torch.zeros(num_atoms, dtype=torch.long, device=pos.device)
+    if num_atoms == 0:
+        return torch.zeros(2, 0, dtype=torch.long, device=pos.device)
+    # bins start at 1 and the grid has an empty layer on every side, so the
+    # key of a neighboring bin is the key of the bin plus that of the offset
+    bins = torch.floor((pos - pos.min(dim=0).values)/r_max).long() + 1
+    dims = (bins.max(dim=0).values + 2).tolist()
+    key = ((batch*dims[0] + bins[:, 0])*dims[1] + bins[:, 1])*dims[2] + bins[:, 2]
+    sorted_key, order = torch.sort(key)
+    occupied, counts = torch.unique_consecutive(sorted_key, return_counts=True)
+    starts = torch.cumsum(counts, 0) - counts
+    offsets = torch.tensor(list(itertools.product(range(-1, 2), repeat=3)), device=pos.device)
+    offsets = (offsets[:, 0]*dims[1] + offsets[:, 1])*dims[2] + offsets[:, 2]
+
+    def get_chunk_edges(first_atom):
+        # the atoms (dst) of the 27 bins around the bin of every atom (src) of
+        # the chunk, grouped by src
+        src_atoms = torch.arange(first_atom, min(first_atom + chunk_atoms, num_atoms), device=pos.device)
+        target = (key[src_atoms, None] + offsets).reshape(-1)
+        slot = torch.searchsorted(occupied, target).clamp(max=occupied.shape[0] - 1)
+        target_counts = torch.where(occupied[slot] == target, counts[slot], 0)
+        candidate = torch.repeat_interleave(torch.arange(target.shape[0], device=pos.device), target_counts)
+        first = torch.cumsum(target_counts, 0) - target_counts
+        dst = order[starts[slot][candidate] + torch.arange(candidate.shape[0], device=pos.device) - first[candidate]]
+        src = src_atoms[torch.div(candidate, offsets.shape[0], rounding_mode='floor')]
+        keep = ((pos[src] - pos[dst]).norm(dim=1) < r_max) & (src != dst)
+        src, dst = src[keep], dst[keep]
+        # src is already sorted, so this only sorts the dst of every src
+        order_in_chunk = torch.argsort(src*num_atoms + dst)
+        return torch.stack([src[order_in_chunk], dst[order_in_chunk]])
+
+    chunks = range(0, num_atoms, chunk_atoms)
+    num_threads = min(torch.get_num_threads() if num_threads is None else num_threads, len(chunks))
+    if num_threads > 1:
+        with ThreadPoolExecutor(num_threads) as pool:
+            edges = list(pool.map(get_chunk_edges, chunks))
+    else:
+        edges = [get_chunk_edges(first_atom) for first_atom in chunks]
+    return torch.cat(edges, dim=1)
+
+
+def batched_periodic_radius_graph(pos, r_max, cell, batch):
+    # periodic_radius_graph of every graph of a batch, with cell [3, 3] for
+    # all of them or [num_graphs, 3, 3]
+    num_graphs = int(batch.max()) + 1 if batch.numel() else 0
+    if cell.dim() == 2:
+        cell = cell.expand(num_graphs, 3, 3)
+    edge_index, edge_shift = [], []
+    for graph in range(num_graphs):
+        atoms = torch.nonzero(batch == graph).reshape(-1)
+        graph_index, graph_shift = periodic_radius_graph(pos[atoms], r_max, cell[graph])
+        edge_index.append(atoms[graph_index])
+        edge_shift.append(graph_shift)
+    return torch.cat(edge_index, dim=1), torch.cat(edge_shift)
+
+
+class VerletList:
+    # edge_index of the atom pairs closer than cutoff, reused across frames
+    # the list holds the pairs within cutoff + skin of the positions it was
+    # built at, and is only rebuilt once an atom has moved more than skin/2
+    # since then (or the cell has changed); in between, a frame only filters
+    # the listed pairs by distance, so every pair within cutoff is found while
+    # the list is valid
+    # the pairs are in the order of density_network.radius_graph (sorted by
+    # source, then destination), so the edges are the same as its edges
+    # with a cell the pairs are those of periodic_radius_graph, and the
+    # displacements are taken to the nearest image, so atoms wrapped back into
+    # the cell by the trajectory keep the list (their jump goes to the shifts)
+
+    def __init__(self, cutoff, skin=1.0):
+        self.cutoff = cutoff
+        self.skin = skin
+        self.reference = None
+        self.cell = None
+        self.pairs = None
+        self.shifts = None
+        self.builds = 0
+
+    def build(self, pos, cell=None):
+        if cell is None:
+            r = torch.cdist(pos, pos, compute_mode='donot_use_mm_for_euclid_dist')
+            index = (r < self.cutoff + self.skin).nonzero().T
+            self.pairs = index[:, index[0] != index[1]]
+            self.shifts = None
+        else:
+            self.pairs, self.shifts = periodic_radius_graph(pos, self.cutoff + self.skin, cell)
+        self.reference = pos.clone()
+        self.cell = None if cell is None else cell.clone()
+        self.builds += 1
+
+    def get_jumps(self, pos):
+        # lattice vectors that take pos to the image nearest to the positions
+        # the list was built at
+        if self.cell is None:
+            return torch.zeros_like(pos)
+        frac = (self.reference - pos) @ torch.linalg.inv(self.cell)
+        return torch.round(frac) @ self.cell
+
+    def is_valid(self, pos, cell=None):
+        if self.reference is None or self.reference.shape != pos.shape:
+            return False
+        if (cell is None) != (self.cell is None) or (cell is not None and not torch.equal(cell, self.cell)):
+            return False
+        return float((pos + self.get_jumps(pos) - self.reference).norm(dim=1).max()) <= self.skin/2
+
+    def get_edges(self, pos, cell=None):
+        # (edge_index [2, E], edge_shift [E, 3] or None) of one frame, pos [N, 3]
+        if not self.is_valid(pos, cell):
+            self.build(pos, cell)
+        edge_vec = pos[self.pairs[0]] - pos[self.pairs[1]]
+        if self.shifts is None:
+            return self.pairs[:, edge_vec.norm(dim=1) < self.cutoff], None
+        jumps = self.get_jumps(pos)
+        shifts = self.shifts + jumps[self.pairs[0]] - jumps[self.pairs[1]]
+        keep = (edge_vec + shifts).norm(dim=1) < self.cutoff
+        return self.pairs[:, keep], shifts[keep]
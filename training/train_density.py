@@ -8,34 +8,32 @@ from torch_cluster import radius_graph
 from torch_scatter import scatter
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from utils import get_iso_permuted_dataset
-from e3nn.nn.models.gate_points_2101 import Network
+from density_dataset import MemmapDensityDataset, SizeBucketSampler, get_num_atoms, get_graph_sum, get_graph_mse
+from density_dataset import get_standardization_stats, Standardizer
+from density_network import DensityNetwork, get_autocast, set_tf32, get_serializable_kwargs, PRESETS
 from e3nn import o3
-from utils import get_scalar_density_comparisons
+from utils import get_scalar_density_comparisons, DensityGridCache, get_moment_comparisons
 import wandb
 import random
 from datetime import date
 import argparse
 import os
+import json
 
 
-def lossPerChannel(y_ml, y_target,
+def lossPerChannel(y_ml, y_target, batch, num_graphs,
     Rs = [(12, 0), (5, 1), (4, 2), (2, 3), (1, 4)]):
  
+    # per channel share of the loss of each molecule, summed over the graphs
     err = y_ml - y_target
-    pct_dev = torch.div(err.abs(),y_target)
     loss_perChannel_list = np.zeros(len(Rs))
-    normalization = err.sum()/err.mean()
+    normalization = torch.bincount(batch, minlength=num_graphs)*err.shape[1]
 
     counter = 0
     for mul, l in Rs:  
-        if l==0:
-            temp_loss = err[:,:mul].pow(2).sum().abs()/normalization
-        else:
-            temp_loss = err[:,counter:counter+mul*(2*l+1)].pow(2).sum().abs()/normalization
+        temp_loss = get_graph_sum(err[:,counter:counter+mul*(2*l+1)].pow(2), batch, num_graphs)/normalization
  
- 
-        loss_perChannel_list[l]+=temp_loss.detach().cpu().numpy()
-        pct_deviation_list[l]+=temp_pct_deviation.detach().cpu().numpy()
+        loss_perChannel_list[l]+=temp_loss.sum().detach().cpu().numpy()
        
         counter += mul*(2*l+1)
  
@@ -48,6 +46,13 @@ def main():
     parser.add_argument('--split', type=int)
     parser.add_argument('--epochs', type=int, default=300)
     parser.add_argument('--qm', type=str, default="pbe0")
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--max_atoms', type=int, default=None, help='batch by total number of atoms instead of --batch_size')
+    parser.add_argument('--density_cache_mb', type=int, default=2048, help='memory for test grids and target densities kept between epochs')
+    parser.add_argument('--density_grid', type=str, default='cube', choices=['cube', 'becke'], help='uniform cube or atom-centered becke grids for the test density metrics')
+    parser.add_argument('--standardize', action='store_true', help='train on targets standardized per element and shell')
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'], help='autocast dtype of the convolutions, fp16 uses gradient scaling')
+    parser.add_argument('--tf32', action='store_true', help='allow tf32 matmuls on gpu')
     parser.add_argument('ldep',type=bool, default=False)
     args = parser.parse_args()
 
@@ -55,6 +60,7 @@ def main():
     print ("What device am I using?", device)
 
     torch.set_default_dtype(torch.float32)
+    set_tf32(args.tf32)
 
     if args.qm == 'ccsd':
         hhh = os.path.dirname(os.path.realpath(__file__)) + "/../data/ccsd_h_s_only_def2-universal-jfit-decontract_density.out"
@@ -71,43 +77,57 @@ def main():
     # WARNING. this is currently hard-coded for def2_universal
     Rs = [(12, 0), (5, 1), (4, 2), (2, 3), (1, 4)]
 
-    test_dataset = get_iso_permuted_dataset(args.testset,o_iso=ooo,h_iso=hhh)
+    # a directory is a dataset compiled with generate_density_datasets/compile_dataset.py
+    if os.path.isdir(args.testset):
+        test_dataset = MemmapDensityDataset(args.testset)
+    else:
+        test_dataset = get_iso_permuted_dataset(args.testset,o_iso=ooo,h_iso=hhh)
 
     split = args.split
     data_file = args.dataset
     lr = 1e-2
     density_spacing = 0.1
     save_interval = 5
-    model_kwargs = {
-        "irreps_in": "2x 0e", #irreps_in 
-        "irreps_hidden": [(mul, (l, p)) for l, mul in enumerate([125,40,25,15]) for p in [-1, 1]], #irreps_hidden
-        "irreps_out": "12x0e + 5x1o + 4x2e + 2x3o + 1x4e", #irreps_out
-        "irreps_node_attr": None, #irreps_node_attr
-        "irreps_edge_attr": o3.Irreps.spherical_harmonics(3), #irreps_edge_attr
-        "layers": 3,
-        "max_radius": 3.5,
-        "number_of_basis": 10,
-        "radial_layers": 1,
-        "radial_neurons": 128,
-        "num_neighbors": 12.2298,
-        "num_nodes": 24,
-        "reduce_output": False,
-    }
-
-    dataset = get_iso_permuted_dataset(data_file,o_iso=ooo,h_iso=hhh)
-    random.shuffle(dataset)
+    # copied, as the training settings are added to it for wandb
+    model_kwargs = dict(PRESETS['water'])
+
+    if os.path.isdir(data_file):
+        dataset = MemmapDensityDataset(data_file)
+        indices = list(range(len(dataset)))
+        random.shuffle(indices)
+        train_dataset = torch.utils.data.Subset(dataset, indices[:split])
+    else:
+        dataset = get_iso_permuted_dataset(data_file,o_iso=ooo,h_iso=hhh)
+        random.shuffle(dataset)
+        train_dataset = dataset[:split]
     if split > len(dataset):
         raise ValueError('Split is too large for the dataset.')
     
-    b = 1
-    train_loader = torch_geometric.data.DataLoader(dataset[:split], batch_size=b, shuffle=True)
-
-    test_loader = torch_geometric.data.DataLoader(test_dataset, batch_size=b, shuffle=True)
-
-    model = Network(**model_kwargs)
+    # batches of molecules of similar size
+    b = args.batch_size
+    train_sampler = SizeBucketSampler(get_num_atoms(train_dataset), batch_size=b, max_atoms=args.max_atoms)
+    train_loader = torch_geometric.data.DataLoader(train_dataset, batch_sampler=train_sampler)
+    num_train = len(train_dataset)
+
+    test_sampler = SizeBucketSampler(get_num_atoms(test_dataset), batch_size=b, max_atoms=args.max_atoms)
+    test_loader = torch_geometric.data.DataLoader(test_dataset, batch_sampler=test_sampler)
+    num_test = len(test_dataset)
+
+    model = DensityNetwork(**model_kwargs)
+    network_kwargs = get_serializable_kwargs(model_kwargs)
+
+    # per element statistics of the training targets, computed in one pass
+    # the model then predicts standardized targets, and its predictions are
+    # mapped back for the electron counts and density metrics
+    standardizer = None
+    if args.standardize:
+        means, stds = get_standardization_stats(train_dataset, Rs)
+        standardizer = Standardizer(means, stds).to(device)
 
     optim = torch.optim.Adam(model.parameters(), lr=lr)
     optim.zero_grad()
+    # float16 gradients underflow without scaling, bfloat16 has the range of float32
+    scaler = torch.amp.GradScaler(device.type, enabled=args.precision == 'fp16')
 
     model.to(device)
 
@@ -115,34 +135,62 @@ def main():
     model_kwargs["train_dataset_size"] = split
     model_kwargs["lr"] = lr
     model_kwargs["density_spacing"] = density_spacing
+    model_kwargs["density_grid"] = args.density_grid
+    model_kwargs["standardize"] = args.standardize
+    model_kwargs["precision"] = args.precision
+    model_kwargs["tf32"] = args.tf32
     wandb.init(config=model_kwargs, reinit=True)
     wandb.run.name = 'DATASET_' + args.dataset + '_SPLIT_' + str(args.split) + '_' + date.today().strftime("%b-%d-%Y")
     wandb.watch(model)
 
+    # saved next to the model weights, for inference/export_model.py --model_kwargs
+    with open(os.path.join(wandb.run.dir, "model_kwargs.json"), 'w') as f:
+        json.dump(network_kwargs, f, indent=1)
+    wandb.save("model_kwargs.json")
+
+    # saved next to the model weights, load with Standardizer(**torch.load(path))
+    if standardizer is not None:
+        torch.save(standardizer.state_dict(), os.path.join(wandb.run.dir, "standardization.pt"))
+        wandb.save("standardization.pt")
+
+    # test grids, kd trees and target densities are built once
+    density_cache = DensityGridCache(max_bytes=args.density_cache_mb*2**20)
+
     for epoch in range(num_epochs):
         loss_cum = 0.0
         loss_perchannel_cum = np.zeros(len(Rs))
         mae_cum = 0.0
         mue_cum = 0.0
         for step, data in enumerate(train_loader):
+            data = data.to(device)
             mask = torch.where(data.y == 0, torch.zeros_like(data.y), torch.ones_like(data.y)).detach()
-            y_ml = model(data.to(device))*mask.to(device)
-            err = (y_ml - data.y.to(device))
+            # the model returns float32, so the loss is reduced in float32
+            with get_autocast(device, args.precision):
+                y_out = model(data)*mask
+            if standardizer is None:
+                y_target, y_ml = data.y, y_out
+            else:
+                y_target, y_ml = standardizer(data.y, data.x), standardizer.inverse(y_out, data.x)*mask
+            err = (y_out - y_target)
             
+            # number of electrons of each molecule
             for mul, l in Rs:
                 if l == 0:
-                    num_ele = sum(sum(y_ml[:,:mul])).detach()
+                    num_ele = get_graph_sum(y_ml[:,:mul], data.batch, data.num_graphs).detach()
             
-            mue_cum += num_ele
-            mae_cum += abs(num_ele)
+            mue_cum += num_ele.sum()
+            mae_cum += num_ele.abs().sum()
             
             #compute loss per channel
             if ldep_bool:
-                loss_perchannel_cum += lossPerChannel(y_ml,data.y.to(device), Rs)
-
-            loss_cum += err.pow(2).mean().detach().abs()
-            err.pow(2).mean().backward()
-            optim.step()
+                loss_perchannel_cum += lossPerChannel(y_out,y_target, data.batch, data.num_graphs, Rs)
+
+            # mean of the per molecule losses
+            loss = get_graph_mse(err, data.batch, data.num_graphs)
+            loss_cum += loss.sum().detach().abs()
+            scaler.scale(loss.mean()).backward()
+            scaler.step(optim)
+            scaler.update()
             optim.zero_grad()
         
         # now the test loop
@@ -157,91 +205,113 @@ def main():
                 ep_per_l_cum = np.zeros(len(Rs))
 
                 ele_diff_cum = 0.0
+                moment_ele_cum = 0.0
+                dipole_cum = 0.0
                 for step, data in enumerate(testset):
+                    data = data.to(device)
                     mask = torch.where(data.y == 0, torch.zeros_like(data.y), torch.ones_like(data.y)).detach()
-                    y_ml = model(data.to(device))*mask.to(device)
-                    err = (y_ml - data.y.to(device))
+                    with get_autocast(device, args.precision):
+                        y_out = model(data)*mask
+                    if standardizer is None:
+                        y_target, y_ml = data.y, y_out
+                    else:
+                        y_target, y_ml = standardizer(data.y, data.x), standardizer.inverse(y_out, data.x)*mask
+                    err = (y_out - y_target)
 
+                    # mean s population of each molecule
                     for mul, l in Rs:
                         if l == 0:
-                            num_ele = torch.mean(y_ml[:,:mul]).detach()
-                            # num_ele = sum(sum(y_ml[:,:mul])).detach()
+                            counts = torch.bincount(data.batch, minlength=data.num_graphs)*mul
+                            num_ele = (get_graph_sum(y_ml[:,:mul], data.batch, data.num_graphs)/counts).detach()
+                            # num_ele = get_graph_sum(y_ml[:,:mul], data.batch, data.num_graphs).detach()
+
+                    test_mue_cum += num_ele.sum()
+                    test_mae_cum += num_ele.abs().sum()
+                    test_loss_cum += get_graph_mse(err, data.batch, data.num_graphs).sum().detach().abs()
 
-                    test_mue_cum += num_ele
-                    test_mae_cum += abs(num_ele)
-                    test_loss_cum += err.pow(2).mean().detach().abs()
+                    # analytic electron count and dipole (a.u.), no grid needed
+                    moments_target, moments_ml = get_moment_comparisons(data, y_ml, Rs)
+                    moment_ele_cum += (moments_ml['electrons'] - moments_target['electrons']).abs().sum()
+                    dipole_cum += (moments_ml['dipole'] - moments_target['dipole']).norm(dim=1).sum()
 
                     if epoch % save_interval == 0:
                         torch.save(model.state_dict(), os.path.join(wandb.run.dir, "model_weights_epoch_"+str(epoch)+".pt"))
                         wandb.save("model_weights_epoch_"+str(epoch)+".pt")
 
-                    if ldep_bool: 
-                        num_ele_target, num_ele_ml, bigI, ep, ep_per_l= get_scalar_density_comparisons(data, y_ml, Rs, spacing=density_spacing, buffer=3.0, ldep=ldep_bool)
-                        ep_per_l_cum += ep_per_l
-                    else:
-                        num_ele_target, num_ele_ml, bigI, ep = get_scalar_density_comparisons(data, y_ml, Rs, spacing=density_spacing, buffer=3.0, ldep=ldeb_bool)
+                    # density comparisons are done one molecule at a time
+                    for g, molecule in enumerate(data.to_data_list()):
+                        molecule_y_ml = y_ml[data.batch == g]
+                        if ldep_bool: 
+                            num_ele_target, num_ele_ml, bigI, ep, ep_per_l= get_scalar_density_comparisons(molecule, molecule_y_ml, Rs, spacing=density_spacing, buffer=3.0, ldep=ldep_bool, cache=density_cache, grid=args.density_grid)
+                            ep_per_l_cum += ep_per_l
+                        else:
+                            num_ele_target, num_ele_ml, bigI, ep = get_scalar_density_comparisons(molecule, molecule_y_ml, Rs, spacing=density_spacing, buffer=3.0, ldep=ldep_bool, cache=density_cache, grid=args.density_grid)
 
-                    n_ele = np.sum(data.z.cpu().detach().numpy())
-                    ele_diff_cum += np.abs(n_ele-num_ele_target)
-                    bigIs_cum += bigI
-                    eps_cum += ep
+                        n_ele = np.sum(molecule.z.cpu().detach().numpy())
+                        ele_diff_cum += np.abs(n_ele-num_ele_target)
+                        bigIs_cum += bigI
+                        eps_cum += ep
 
-                metrics.append([test_loss_cum, test_mae_cum, test_mue_cum, ele_diff_cum, bigIs_cum, eps_cum, ep_per_l_cum])
+                metrics.append([test_loss_cum, test_mae_cum, test_mue_cum, ele_diff_cum, bigIs_cum, eps_cum, moment_ele_cum, dipole_cum, ep_per_l_cum])
 
         # eps per l and loss per l hard coded for def2 below
         wandb.log({
             "Epoch": epoch,
-            "Train_Loss": float(loss_cum)/len(train_loader),
+            "Train_Loss": float(loss_cum)/num_train,
 
 
-            "Train_Loss l=0": float(loss_cum_per_l[0])/len(train_loader),
-            "Train_Loss l=1": float(loss_cum_per_l[1])/len(train_loader),
-            "Train_Loss l=2": float(loss_cum_per_l[2])/len(train_loader),
-            "Train_Loss l=3": float(loss_cum_per_l[3])/len(train_loader),
-            "Train_Loss l=4": float(loss_cum_per_l[4])/len(train_loader),
+            "Train_Loss l=0": float(loss_perchannel_cum[0])/num_train,
+            "Train_Loss l=1": float(loss_perchannel_cum[1])/num_train,
+            "Train_Loss l=2": float(loss_perchannel_cum[2])/num_train,
+            "Train_Loss l=3": float(loss_perchannel_cum[3])/num_train,
+            "Train_Loss l=4": float(loss_perchannel_cum[4])/num_train,
 
 
-            "Train_MAE": mae_cum/len(train_loader),
-            "Train_MUE": mue_cum/len(train_loader),
+            "Train_MAE": mae_cum/num_train,
+            "Train_MUE": mue_cum/num_train,
 
 
 
-            "Test_Loss": float(metrics[0][0].item())/len(test_loader),
-            "Test_MAE": metrics[0][1].item()/len(test_loader),
-            "Test_MUE": metrics[0][2].item()/len(test_loader),
-            "Test_Electron_Difference": metrics[0][3].item()/len(test_loader),
-            "Test_big_I": metrics[0][4].item()/len(test_loader),
-            "Test_Epsilon": metrics[0][5].item()/len(test_loader),  
-            "Test_Epsilon l=0": metrics[0][-1][0].item()/len(test_loader),  
-            "Test_Epsilon l=1": metrics[0][-1][1].item()/len(test_loader),
-            "Test_Epsilon l=2": metrics[0][-1][2].item()/len(test_loader),
-            "Test_Epsilon l=3": metrics[0][-1][3].item()/len(test_loader),
-            "Test_Epsilon l=4": metrics[0][-1][4].item()/len(test_loader),
+            "Test_Loss": float(metrics[0][0].item())/num_test,
+            "Test_MAE": metrics[0][1].item()/num_test,
+            "Test_MUE": metrics[0][2].item()/num_test,
+            "Test_Electron_Difference": metrics[0][3].item()/num_test,
+            "Test_big_I": metrics[0][4].item()/num_test,
+            "Test_Epsilon": metrics[0][5].item()/num_test,  
+            "Test_Analytic_Electron_Difference": metrics[0][6].item()/num_test,
+            "Test_Dipole_Error": metrics[0][7].item()/num_test,
+            "Test_Epsilon l=0": metrics[0][-1][0].item()/num_test,  
+            "Test_Epsilon l=1": metrics[0][-1][1].item()/num_test,
+            "Test_Epsilon l=2": metrics[0][-1][2].item()/num_test,
+            "Test_Epsilon l=3": metrics[0][-1][3].item()/num_test,
+            "Test_Epsilon l=4": metrics[0][-1][4].item()/num_test,
         })
 
         if epoch % 1 == 0:
-            print(str(epoch) + " " + f"{float(loss_cum)/len(train_loader):.10f}")
-
-
-            print("Train_Loss l=0", float(loss_cum_per_l[0])/len(train_loader))
-            print("Train_Loss l=1",float(loss_cum_per_l[1])/len(train_loader))
-            print("Train_Loss l=2", float(loss_cum_per_l[2])/len(train_loader))
-            print("Train_Loss l=3",float(loss_cum_per_l[3])/len(train_loader))
-            print("Train_Loss l=4", float(loss_cum_per_l[4])/len(train_loader))
-
-            print("    MAE",mae_cum/(len(train_loader)*b))
-            print("    MUE",mue_cum/(len(train_loader)*b))
-            print("    Test_Loss", float(metrics[0][0].item())/len(test_loader))
-            print("    Test_MAE",metrics[0][1].item()/len(test_loader))
-            print("    Test_MUE",metrics[0][2].item()/len(test_loader))
-            print("    Test_Electron_Difference",metrics[0][3].item()/len(test_loader))
-            print("    Test_big_I",metrics[0][4].item()/len(test_loader))
-            print("    Test_Epsilon",metrics[0][5].item()/len(test_loader))
-            print("    Test_Epsilon l=0",metrics[0][-1][0].item()/len(test_loader)
-            print("    Test_Epsilon l=1",metrics[0][-1][1].item()/len(test_loader)
-            print("    Test_Epsilon l=2",metrics[0][-1][2].item()/len(test_loader)   
-            print("    Test_Epsilon l=3",metrics[0][-1][3].item()/len(test_loader)
-            print("    Test_Epsilon l=4",metrics[0][-1][4].item()/len(test_loader)
+            print(str(epoch) + " " + f"{float(loss_cum)/num_train:.10f}")
+
+
+            print("Train_Loss l=0", float(loss_perchannel_cum[0])/num_train)
+            print("Train_Loss l=1",float(loss_perchannel_cum[1])/num_train)
+            print("Train_Loss l=2", float(loss_perchannel_cum[2])/num_train)
+            print("Train_Loss l=3",float(loss_perchannel_cum[3])/num_train)
+            print("Train_Loss l=4", float(loss_perchannel_cum[4])/num_train)
+
+            print("    MAE",mae_cum/num_train)
+            print("    MUE",mue_cum/num_train)
+            print("    Test_Loss", float(metrics[0][0].item())/num_test)
+            print("    Test_MAE",metrics[0][1].item()/num_test)
+            print("    Test_MUE",metrics[0][2].item()/num_test)
+            print("    Test_Electron_Difference",metrics[0][3].item()/num_test)
+            print("    Test_big_I",metrics[0][4].item()/num_test)
+            print("    Test_Epsilon",metrics[0][5].item()/num_test)
+            print("    Test_Analytic_Electron_Difference",metrics[0][6].item()/num_test)
+            print("    Test_Dipole_Error",metrics[0][7].item()/num_test)
+            print("    Test_Epsilon l=0",metrics[0][-1][0].item()/num_test)
+            print("    Test_Epsilon l=1",metrics[0][-1][1].item()/num_test)
+            print("    Test_Epsilon l=2",metrics[0][-1][2].item()/num_test)
+            print("    Test_Epsilon l=3",metrics[0][-1][3].item()/num_test)
+            print("    Test_Epsilon l=4",metrics[0][-1][4].item()/num_test)
 
 
     wandb.finish()
@@ -1,3 +1,5 @@
+import sys
+import os
 import math
 import numpy as np
 import torch
@@ -6,7 +8,8 @@ from torch_cluster import radius_graph
 from torch_scatter import scatter
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from utils import get_iso_dataset
-from e3nn.nn.models.gate_points_2101 import Network
+from density_dataset import MemmapDensityDataset, SizeBucketSampler, get_num_atoms, get_graph_sum, get_graph_mse
+from density_network import DensityNetwork
 from e3nn import o3
 from utils import get_scalar_density_comparisons
 import wandb
@@ -21,6 +24,8 @@ def main():
     parser.add_argument('--split', type=int)
     parser.add_argument('--epochs', type=int, default=300)
     parser.add_argument('--gpu', type=str)
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--max_atoms', type=int, default=None, help='batch by total number of atoms instead of --batch_size')
     args = parser.parse_args()
 
     device = torch.device(args.gpu if torch.cuda.is_available() else "cpu")
@@ -36,7 +41,11 @@ def main():
     # def2 basis set max irreps
     Rs = [(12, 0), (5, 1), (4, 2), (2, 3), (1, 4)]
 
-    test_dataset = get_iso_dataset(args.testset,o_iso=ooo,h_iso=hhh)
+    # a directory is a dataset compiled with generate_density_datasets/compile_dataset.py
+    if os.path.isdir(args.testset):
+        test_dataset = MemmapDensityDataset(args.testset, permuted=False)
+    else:
+        test_dataset = get_iso_dataset(args.testset,o_iso=ooo,h_iso=hhh)
 
     split = args.split
     data_file = args.dataset
@@ -57,18 +66,30 @@ def main():
         "reduce_output": True, 
     }
 
-    dataset = get_iso_dataset(data_file,o_iso=ooo,h_iso=hhh)
-    random.shuffle(dataset)
+    if os.path.isdir(data_file):
+        dataset = MemmapDensityDataset(data_file, permuted=False)
+        indices = list(range(len(dataset)))
+        random.shuffle(indices)
+        train_dataset = torch.utils.data.Subset(dataset, indices[:split])
+    else:
+        dataset = get_iso_dataset(data_file,o_iso=ooo,h_iso=hhh)
+        random.shuffle(dataset)
+        train_dataset = dataset[:split]
     
     if split > len(dataset):
         # continue # Only run when the split is contained in the dataset
         raise ValueError('Split it too large for the dataset.')
     
-    b = 1
-    train_loader = torch_geometric.data.DataLoader(dataset[:split], batch_size=b, shuffle=True)
-    test_loader = torch_geometric.data.DataLoader(test_dataset, batch_size=b, shuffle=True)
+    # batches of molecules of similar size
+    b = args.batch_size
+    train_sampler = SizeBucketSampler(get_num_atoms(train_dataset), batch_size=b, max_atoms=args.max_atoms)
+    train_loader = torch_geometric.data.DataLoader(train_dataset, batch_sampler=train_sampler)
+    test_sampler = SizeBucketSampler(get_num_atoms(test_dataset), batch_size=b, max_atoms=args.max_atoms)
+    test_loader = torch_geometric.data.DataLoader(test_dataset, batch_sampler=test_sampler)
+    num_train = len(train_dataset)
+    num_test = len(test_dataset)
 
-    model = Network(**model_kwargs)
+    model = DensityNetwork(**model_kwargs)
 
     optim = torch.optim.Adam(model.parameters(), lr=lr)
     optim.zero_grad()
@@ -93,26 +114,30 @@ def main():
         e_mue = 0.0
         f_mae = 0.0
         for step, data in enumerate(train_loader):
+            data = data.to(device)
             data.pos.requires_grad = True
-            y_ml = model(data.to(device))
+            # one energy per molecule
+            y_ml = model(data).reshape(-1)
 
             # get ml force
-            forces = torch.autograd.grad(y_ml, data.pos.to(device), create_graph=True, retain_graph=True)[0]
+            forces = torch.autograd.grad(y_ml.sum(), data.pos, create_graph=True, retain_graph=True)[0]
             
             # subtract energy of water monomers (PBE0)
             monomer_energy = -76.379999960410643
-            energy_err = y_ml - (data.energy.to(device) - monomer_energy*data.pos.shape[0]/3 )
-            forces_err = forces - data.forces.to(device)
+            num_atoms = torch.bincount(data.batch, minlength=data.num_graphs)
+            energy_err = y_ml - (data.energy.reshape(-1) - monomer_energy*num_atoms/3 )
+            forces_err = forces - data.forces
 
-            e_mue += energy_err.detach()
-            e_mae += energy_err.detach().abs()
-            f_mae += forces_err.detach().flatten().abs().mean()
+            e_mue += energy_err.detach().sum()
+            e_mae += energy_err.detach().abs().sum()
+            f_mae += (get_graph_sum(forces_err.detach().abs(), data.batch, data.num_graphs)/(3*num_atoms)).sum()
 
-            energy_loss = energy_err.pow(2).mean()
-            force_loss = forces_err.pow(2).mean()
+            # per molecule losses
+            energy_loss = energy_err.pow(2)
+            force_loss = get_graph_mse(forces_err, data.batch, data.num_graphs)
             err = (energy_coefficient * energy_loss) + (force_coefficient * force_loss)
-            err.backward()
-            loss_cum += err.detach()
+            err.mean().backward()
+            loss_cum += err.detach().sum()
 
             optim.step()
             optim.zero_grad()
@@ -124,42 +149,46 @@ def main():
             test_e_mue = 0.0
             test_f_mae = 0.0
             for step, data in enumerate(testset):
+                data = data.to(device)
                 data.pos.requires_grad = True
-                y_ml = model(data.to(device))
+                # one energy per molecule
+                y_ml = model(data).reshape(-1)
 
                 # get ml force
-                forces = torch.autograd.grad(y_ml, data.pos.to(device), create_graph=True, retain_graph=True)[0]
+                forces = torch.autograd.grad(y_ml.sum(), data.pos, create_graph=True, retain_graph=True)[0]
 
                 # subtract energy of water monomers
                 monomer_energy = -76.379999960410643
-                energy_err = y_ml - (data.energy.to(device) - monomer_energy*data.pos.shape[0]/3 )
-                forces_err = forces - data.forces.to(device)
+                num_atoms = torch.bincount(data.batch, minlength=data.num_graphs)
+                energy_err = y_ml - (data.energy.reshape(-1) - monomer_energy*num_atoms/3 )
+                forces_err = forces - data.forces
 
-                test_e_mue += energy_err.detach()
-                test_e_mae += energy_err.detach().abs()
-                test_f_mae += forces_err.detach().flatten().abs().mean()
+                test_e_mue += energy_err.detach().sum()
+                test_e_mae += energy_err.detach().abs().sum()
+                test_f_mae += (get_graph_sum(forces_err.detach().abs(), data.batch, data.num_graphs)/(3*num_atoms)).sum()
 
-                energy_loss = energy_err.pow(2).mean()
-                force_loss = forces_err.pow(2).mean()
+                # per molecule losses
+                energy_loss = energy_err.pow(2)
+                force_loss = get_graph_mse(forces_err, data.batch, data.num_graphs)
                 err = (energy_coefficient * energy_loss) + (force_coefficient * force_loss)
-                test_loss_cum += err.detach()
+                test_loss_cum += err.detach().sum()
                 
         wandb.log({
             "Epoch": epoch,
-            "Train_Loss": float(loss_cum)/len(train_loader),
-            "Train_Energy_MAE": float(e_mae)/len(train_loader),
-            "Train_Energy_MUE": float(e_mue)/len(train_loader),
-            "Train_Forces_MAE": float(f_mae)/len(train_loader),
-
-            "Test_Loss": float(test_loss_cum)/len(test_loader),
-            "Test_Energy_MAE": float(test_e_mae)/len(test_loader),
-            "Test_Energy_MUE": float(test_e_mue)/len(test_loader),
-            "Test_Forces_MAE": float(test_f_mae)/len(test_loader)
+            "Train_Loss": float(loss_cum)/num_train,
+            "Train_Energy_MAE": float(e_mae)/num_train,
+            "Train_Energy_MUE": float(e_mue)/num_train,
+            "Train_Forces_MAE": float(f_mae)/num_train,
+
+            "Test_Loss": float(test_loss_cum)/num_test,
+            "Test_Energy_MAE": float(test_e_mae)/num_test,
+            "Test_Energy_MUE": float(test_e_mue)/num_test,
+            "Test_Forces_MAE": float(test_f_mae)/num_test
   
         })
 
         if epoch % 1 == 0:
-            print(str(epoch) + " " + f"{float(loss_cum)/len(train_loader):.10f}")
+            print(str(epoch) + " " + f"{float(loss_cum)/num_train:.10f}")
 
     wandb.finish()
 
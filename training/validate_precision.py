@@ -0,0 +1,139 @@
+import sys
+import os
+import time
+import json
+import argparse
+import torch
+import torch_geometric
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import get_iso_permuted_dataset, get_scalar_density_comparisons, get_moment_comparisons
+from density_dataset import MemmapDensityDataset, get_graph_mse
+from density_network import DensityNetwork, get_autocast, set_tf32, PRESETS
+
+# validation of the mixed precision modes of train_density.py against float32
+# the same model (--weights, or a seeded random one) predicts the test
+# molecules in float32 and in --precision, and the report gives the drift of
+# the analytic electron count and of epsilon (the density error, needs
+# gau2grid) from the float32 predictions, along with the time of a training
+# step (forward and backward) in both
+# the float32 baseline is DensityNetwork, not Network of gate_points_2101:
+# their outputs are the same where their radius graphs are (molecules of up
+# to 25 atoms), but Network adds self loops to larger systems and batches
+#
+# python validate_precision.py --testset ../tests/water_density_testset.pkl --weights model_weights_epoch_100.pt --precision bf16 --output report.json
+
+# model_kwargs of train_density.py
+MODEL_KWARGS = PRESETS['water']
+Rs = [(12, 0), (5, 1), (4, 2), (2, 3), (1, 4)]
+
+
+def predict(model, data, device, precision):
+    mask = torch.where(data.y == 0, torch.zeros_like(data.y), torch.ones_like(data.y))
+    with torch.no_grad(), get_autocast(device, precision):
+        return model(data)*mask
+
+
+def time_step(model, data, device, precision, repeat):
+    # best time of a forward and backward pass
+    best = float('inf')
+    for i in range(repeat + 1):
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        with get_autocast(device, precision):
+            y_ml = model(data)
+        get_graph_mse(y_ml - data.y, data.batch, data.num_graphs).mean().backward()
+        model.zero_grad()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        # the first pass warms up
+        if i > 0:
+            best = min(best, time.perf_counter() - start)
+    return best
+
+
+def get_errors(molecule, y_ml, args):
+    # electron count error (analytic) and epsilon of a prediction
+    moments_target, moments_ml = get_moment_comparisons(molecule, y_ml, Rs)
+    errors = {'electrons': float((moments_ml['electrons'] - moments_target['electrons']).sum())}
+    try:
+        errors['epsilon'] = float(get_scalar_density_comparisons(molecule, y_ml, Rs, spacing=args.spacing, buffer=3.0, grid=args.density_grid)[3])
+    except ImportError:
+        errors['epsilon'] = None
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='compare mixed precision predictions with float32')
+    parser.add_argument('--testset', type=str)
+    parser.add_argument('--weights', type=str, default=None, help='state_dict of a trained model, a seeded random model otherwise')
+    parser.add_argument('--precision', type=str, default='bf16', choices=['bf16', 'fp16'])
+    parser.add_argument('--tf32', action='store_true')
+    parser.add_argument('--molecules', type=int, default=10)
+    parser.add_argument('--density_grid', type=str, default='becke', choices=['cube', 'becke'])
+    parser.add_argument('--spacing', type=float, default=0.1)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', type=str, default=None, help='write the report as json')
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    hhh = os.path.dirname(os.path.realpath(__file__)) + "/../data/water/h_s_only_def2-universal-jfit-decontract_density.out"
+    ooo = os.path.dirname(os.path.realpath(__file__)) + "/../data/water/o_s_only_def2-universal-jfit-decontract_density.out"
+    if os.path.isdir(args.testset):
+        dataset = MemmapDensityDataset(args.testset)
+    else:
+        dataset = get_iso_permuted_dataset(args.testset, o_iso=ooo, h_iso=hhh)
+
+    torch.manual_seed(0)
+    model = DensityNetwork(**MODEL_KWARGS)
+    if args.weights is not None:
+        model.load_state_dict(torch.load(args.weights, map_location='cpu'))
+    model.to(device)
+
+    molecules = []
+    times = {'fp32': 0.0, args.precision: 0.0}
+    for i in range(min(args.molecules, len(dataset))):
+        # float32 matmuls for the baseline, tf32 (if asked) for the other
+        data = torch_geometric.data.Batch.from_data_list([dataset[i]]).to(device)
+        molecule = data.to_data_list()[0]
+        report = {'atoms': int(data.num_nodes)}
+        predictions = {}
+        for precision in ['fp32', args.precision]:
+            set_tf32(args.tf32 and precision != 'fp32')
+            predictions[precision] = predict(model, data, device, precision)
+            report[precision] = get_errors(molecule, predictions[precision], args)
+            seconds = time_step(model, data, device, precision, args.repeat)
+            report[precision]['step_seconds'] = seconds
+            times[precision] += seconds
+        y32, y16 = predictions['fp32'], predictions[args.precision]
+        report['max_coefficient_difference'] = float((y16 - y32).abs().max())
+        report['relative_coefficient_difference'] = float((y16 - y32).norm()/y32.norm())
+        for key in ['electrons', 'epsilon']:
+            if report['fp32'][key] is not None:
+                report[key + '_drift'] = report[args.precision][key] - report['fp32'][key]
+        molecules.append(report)
+        print(i, json.dumps(report))
+    set_tf32(False)
+
+    def worst(key):
+        values = [abs(m[key]) for m in molecules if key in m]
+        return max(values) if values else None
+
+    summary = {
+        'precision': args.precision,
+        'tf32': args.tf32,
+        'device': str(device),
+        'molecules': len(molecules),
+        'max_electrons_drift': worst('electrons_drift'),
+        'max_epsilon_drift': worst('epsilon_drift'),
+        'max_relative_coefficient_difference': worst('relative_coefficient_difference'),
+        'speedup': times['fp32']/times[args.precision],
+    }
+    print(json.dumps(summary, indent=1))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'summary': summary, 'molecules': molecules}, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -27,24 +27,14 @@ def get_iso_permuted_dataset(picklefile, **atm_iso):
     import torch_geometric
     import copy
     import numpy as np
+    from density_dataset import get_iso_table, subtract_iso, load_molecules
 
     dataset = []
 
-    for key, value in atm_iso.items():
-        if key=='h_iso':
-            h_data = torch.Tensor(np.loadtxt(value,skiprows=2,usecols=1))
-        elif key=='c_iso':
-            c_data = torch.Tensor(np.loadtxt(value,skiprows=2,usecols=1))
-        elif key=='n_iso':
-            n_data = torch.Tensor(np.loadtxt(value,skiprows=2,usecols=1))
-        elif key=='o_iso':
-            o_data = torch.Tensor(np.loadtxt(value,skiprows=2,usecols=1))
-        elif key=='p_iso':
-            p_data = torch.Tensor(np.loadtxt(value,skiprows=2,usecols=1))
-        else:
-            raise ValueError("Isolated atom type not found. Use kwargs \"h_iso\", \"c_iso\", etc.")
+    # isolated atom coefficients indexed by atomic number
+    iso_table, supported = get_iso_table(**atm_iso)
 
-    for molecule in pickle.load( open (picklefile, "rb")):
+    for molecule in load_molecules(picklefile):
         pos = molecule['pos']
         # z is atomic number- may want to make 1,0
         z = molecule['type'].unsqueeze(1)
@@ -56,27 +46,9 @@ def get_iso_permuted_dataset(picklefile, **atm_iso):
         exp = molecule['exponents']
 
         full_c = copy.deepcopy(c)        
-        iso_c = torch.zeros_like(c)
         
         #now subtract the isolated atoms
-        for atom, iso, typ in zip(c,iso_c,z):
-            if typ.item() == 1.0:
-                atom[:list(h_data.shape)[0]] -= h_data
-                iso[:list(h_data.shape)[0]] += h_data
-            elif typ.item() == 6.0:
-                atom[:list(c_data.shape)[0]] -= c_data
-                iso[:list(c_data.shape)[0]] += c_data
-            elif typ.item() == 7.0:
-                atom[:list(n_data.shape)[0]] -= n_data
-                iso[:list(n_data.shape)[0]] += n_data
-            elif typ.item() == 8.0:
-                atom[:list(o_data.shape)[0]] -= o_data
-                iso[:list(o_data.shape)[0]] += o_data
-            elif typ.item() == 15.0:
-                atom[:list(p_data.shape)[0]] -= p_data
-                iso[:list(p_data.shape)[0]] += p_data
-            else:
-                raise ValueError("Isolated atom type not supported!")
+        c, iso_c = subtract_iso(full_c, z, iso_table, supported)
 
         pop = torch.where(n != 0, c*2*math.sqrt(2)/n, n)
 
@@ -107,24 +79,14 @@ def get_iso_dataset(picklefile, **atm_iso):
     import torch_geometric
     import copy
     import numpy as np
+    from density_dataset import get_iso_table, subtract_iso, load_molecules
 
     dataset = []
 
-    for key, value in atm_iso.items():
-        if key=='h_iso':
-            h_data = torch.Tensor(np.loadtxt(value,skiprows=2,usecols=1))
-        elif key=='c_iso':
-            c_data = torch.Tensor(np.loadtxt(value,skiprows=2,usecols=1))
-        elif key=='n_iso':
-            n_data = torch.Tensor(np.loadtxt(value,skiprows=2,usecols=1))
-        elif key=='o_iso':
-            o_data = torch.Tensor(np.loadtxt(value,skiprows=2,usecols=1))
-        elif key=='p_iso':
-            p_data = torch.Tensor(np.loadtxt(value,skiprows=2,usecols=1))
-        else:
-            raise ValueError("Isolated atom type not found. Use kwargs \"h_iso\", \"c_iso\", etc.")
+    # isolated atom coefficients indexed by atomic number
+    iso_table, supported = get_iso_table(**atm_iso)
 
-    for molecule in pickle.load( open (picklefile, "rb")):
+    for molecule in load_molecules(picklefile):
         pos = molecule['pos']
         # z is atomic number- may want to make 1,0
         z = molecule['type'].unsqueeze(1)
@@ -145,19 +107,7 @@ def get_iso_dataset(picklefile, **atm_iso):
         full_c = copy.deepcopy(c)
 
         #now subtract the isolated atoms
-        for atom, typ in zip(c,z):
-            if typ.item() == 1.0:
-                atom[:list(h_data.shape)[0]] -= h_data
-            elif typ.item() == 6.0:
-                atom[:list(c_data.shape)[0]] -= c_data
-            elif typ.item() == 7.0:
-                atom[:list(n_data.shape)[0]] -= n_data
-            elif typ.item() == 8.0:
-                atom[:list(o_data.shape)[0]] -= o_data
-            elif typ.item() == 15.0:
-                atom[:list(p_data.shape)[0]] -= p_data
-            else:
-                raise ValueError("Isolated atom type not supported!")
+        c, iso_c = subtract_iso(full_c, z, iso_table, supported)
 
         pop = torch.where(n != 0, c*2*math.sqrt(2)/n, n)
 
@@ -192,30 +142,16 @@ def get_iso_permuted_dataset_lpop_scale(picklefile, rs, **atm_iso):
     import torch_geometric
     import copy
     import numpy as np
+    from density_dataset import get_iso_table, subtract_iso, load_molecules
 
     dataset = []
 
     print(rs)
 
-    for key, value in atm_iso.items():
-        if key=='h_iso':
-            h_data = torch.Tensor(np.loadtxt(value,skiprows=2,usecols=1))
-        elif key=='c_iso':
-            c_data = torch.Tensor(np.loadtxt(value,skiprows=2,usecols=1))
-        elif key=='n_iso':
-            n_data = torch.Tensor(np.loadtxt(value,skiprows=2,usecols=1))
-        elif key=='o_iso':
-            o_data = torch.Tensor(np.loadtxt(value,skiprows=2,usecols=1))
-        elif key=='p_iso':
-            p_data = torch.Tensor(np.loadtxt(value,skiprows=2,usecols=1))
-        elif key=='mg_iso':
-            mg_data = torch.Tensor(np.loadtxt(value,skiprows=2,usecols=1))
-        elif key=='cl_iso':
-            cl_data = torch.Tensor(np.loadtxt(value,skiprows=2,usecols=1))
-        else:
-            raise ValueError("Isolated atom type not found. Use kwargs \"h_iso\", \"c_iso\", etc.")
+    # isolated atom coefficients indexed by atomic number
+    iso_table, supported = get_iso_table(**atm_iso)
 
-    for molecule in pickle.load( open (picklefile, "rb")):
+    for molecule in load_molecules(picklefile):
         pos = molecule['pos']
         # z is atomic number- may want to make 1,0
         z = molecule['type'].unsqueeze(1)
@@ -227,36 +163,12 @@ def get_iso_permuted_dataset_lpop_scale(picklefile, rs, **atm_iso):
         exp = molecule['exponents']
 
         full_c = copy.deepcopy(c)
-        iso_c = torch.zeros_like(c)
 
         if amberFlag==1:
             amber_chg = molecule['amber_chg']
 
         #now subtract the isolated atoms
-        for atom, iso, typ in zip(c,iso_c,z):
-            if typ.item() == 1.0:
-                atom[:list(h_data.shape)[0]] -= h_data
-                iso[:list(h_data.shape)[0]] += h_data
-            elif typ.item() == 6.0:
-                atom[:list(c_data.shape)[0]] -= c_data
-                iso[:list(c_data.shape)[0]] += c_data
-            elif typ.item() == 7.0:
-                atom[:list(n_data.shape)[0]] -= n_data
-                iso[:list(n_data.shape)[0]] += n_data
-            elif typ.item() == 8.0:
-                atom[:list(o_data.shape)[0]] -= o_data
-                iso[:list(o_data.shape)[0]] += o_data
-            elif typ.item() == 15.0:
-                atom[:list(p_data.shape)[0]] -= p_data
-                iso[:list(p_data.shape)[0]] += p_data
-            elif typ.item() == 12.0:
-                atom[:list(p_data.shape)[0]] -= mg_data
-                iso[:list(p_data.shape)[0]] += mg_data
-            elif typ.item() == 17.0:
-                atom[:list(p_data.shape)[0]] -= cl_data
-                iso[:list(p_data.shape)[0]] += cl_data
-            else:
-                raise ValueError("Isolated atom type not supported!")
+        c, iso_c = subtract_iso(full_c, z, iso_table, supported)
 
         pop = torch.zeros_like(c)
 
@@ -413,23 +325,8 @@ def electron_error(dimer_num, true_coeffs, ml_output_coeffs, exponents, norms, R
 
 
 def find_min_max(coords):
-    xmin, xmax = coords[0,0], coords[0,0]
-    ymin, ymax = coords[0,1], coords[0,1]
-    zmin, zmax = coords[0,2], coords[0,2]
-
-    for coord in coords:
-        if coord[0] < xmin:
-            xmin = coord[0]
-        if coord[0] > xmax:
-            xmax = coord[0]
-        if coord[1] < ymin:
-            ymin = coord[1]
-        if coord[1] > ymax:
-            ymax = coord[1]
-        if coord[2] < zmin:
-            zmin = coord[2]
-        if coord[2] > zmax:
-            zmax = coord[2]
+    xmin, ymin, zmin = coords.min(axis=0)
+    xmax, ymax, zmax = coords.max(axis=0)
     
     return xmin, xmax, ymin, ymax, zmin, zmax
 
@@ -468,6 +365,129 @@ def generate_grid(data, spacing=0.5, buffer=2.0):
     return x, y, z, vol, x_spacing, y_spacing, z_spacing
 
 
+
+# Bragg-Slater radii in angstrom, with 0.35 for hydrogen as in Becke's paper
+# elements past argon fall back to 1.0
+BRAGG_SLATER_RADII = [1.0, 0.35, 0.35, 1.45, 1.05, 0.85, 0.70, 0.65, 0.60, 0.50, 0.45,
+                      1.80, 1.50, 1.25, 1.10, 1.00, 1.00, 1.00, 0.95]
+
+def get_angular_grid(order):
+    import numpy as np
+    # unit vectors [3, n] and weights [n] (summing to 4 pi) that integrate
+    # spherical harmonics up to degree order exactly
+    try:
+        from scipy.integrate import lebedev_rule
+        return lebedev_rule(order)
+    except ImportError:
+        # older scipy, gauss-legendre in cos(theta) times trapezoid in phi
+        ntheta = (order + 2)//2
+        nphi = order + 1
+        cos_theta, w_theta = np.polynomial.legendre.leggauss(ntheta)
+        phi = 2*np.pi*np.arange(nphi)/nphi
+        sin_theta = np.sqrt(1 - cos_theta**2)
+        xyz = np.stack([np.outer(sin_theta, np.cos(phi)).ravel(),
+                        np.outer(sin_theta, np.sin(phi)).ravel(),
+                        np.repeat(cos_theta, nphi)])
+        return xyz, np.repeat(w_theta, nphi)*2*np.pi/nphi
+
+def get_radial_grid(n, rm):
+    import numpy as np
+    # becke's mapping r = rm (1 + x)/(1 - x) of gauss-chebyshev (second kind)
+    # nodes, returns radii and weights for int f(r) r^2 dr, in units of rm
+    i = np.arange(1, n + 1)
+    x = np.cos(i*np.pi/(n + 1))
+    w = np.pi/(n + 1)*np.sin(i*np.pi/(n + 1))**2
+    r = rm*(1 + x)/(1 - x)
+    w = w/np.sqrt(1 - x**2)*2*rm/(1 - x)**2*r**2
+    return r, w
+
+def get_becke_weights(points, owner, coords, radii, iterations=3, screen=0.9, max_block=2**16):
+    import numpy as np
+    # becke partition weight of every point [npoints, 3] for its own atom
+    # (owner), with the atomic size adjustment, all in angstrom
+    # the cell function P_i of a point is only evaluated for the atoms with
+    # mu < screen relative to the atom nearest to the point, the others are
+    # below 2e-5 for 0.9 and are left out of the normalization
+    natoms = coords.shape[0]
+    if natoms == 1:
+        return np.ones(points.shape[0])
+    R = np.sqrt(np.sum((coords[:,None,:] - coords[None,:,:])**2, axis=2))
+    inv_R = 1/np.where(R > 0, R, 1.0)
+    np.fill_diagonal(inv_R, 0.0)
+    chi = radii[:,None]/radii[None,:]
+    u = (chi - 1)/(chi + 1)
+    a = np.clip(u/(u**2 - 1), -0.5, 0.5)
+    np.fill_diagonal(a, 0.0)
+
+    weights = np.zeros(points.shape[0])
+    for begin in range(0, points.shape[0], max_block):
+        end = min(begin + max_block, points.shape[0])
+        dist = np.sqrt(np.sum((points[begin:end,None,:] - coords[None,:,:])**2, axis=2))
+        nearest = np.argmin(dist, axis=1)
+        d_min = dist[np.arange(end - begin), nearest]
+        active = (dist - d_min[:,None] < screen*R[nearest]) | (np.arange(natoms)[None,:] == nearest[:,None])
+        p, i = np.nonzero(active)
+
+        # mu_ij for every active (point, atom) pair against all atoms j
+        mu = (dist[p, i][:,None] - dist[p])*inv_R[i]
+        nu = mu + a[i]*(1 - mu*mu)
+        for it in range(iterations):
+            nu = nu*(1.5 - 0.5*nu*nu)
+        s = 0.5*(1 - nu)
+        # j = i gives mu = 0, set it to 1 so it drops out of the product
+        s[np.arange(len(i)), i] = 1.0
+        P = np.prod(s, axis=1)
+
+        total = np.bincount(p, weights=P, minlength=end - begin)
+        own = np.bincount(p, weights=P*(i == owner[begin:end][p]), minlength=end - begin)
+        weights[begin:end] = own/total
+    return weights
+
+def generate_becke_grid(data, radial_points=50, angular_order=11, becke_iterations=3, screen=0.9):
+    import numpy as np
+    # atom-centered integration grid for the density metrics, in place of the
+    # uniform cube of generate_grid. every atom gets radial_points shells of
+    # a lebedev grid of degree angular_order (50 points for 11), and the
+    # atomic grids are combined with becke's fuzzy cell partition
+    # returns the points xyz [3, npoints] in angstrom and their weights
+    # [npoints] in angstrom**3, which take the place of vol
+    # the partition of a shell at radius r only includes atoms closer than
+    # 2 r/(1 - screen), further atoms have mu >= screen everywhere on the
+    # shell (a cell function below 2e-5 for 0.9). shells with
+    # 2 r/R - 1 <= -screen for the nearest neighbor at R get weight 1
+    coords = data.pos_orig.cpu().detach().numpy().astype(np.float64)
+    z = data.z.cpu().detach().numpy().astype(np.int64).reshape(-1)
+    radii = np.array([BRAGG_SLATER_RADII[n] if n < len(BRAGG_SLATER_RADII) else 1.0 for n in z])
+    # becke uses half the radius except for hydrogen
+    rm = np.where(z == 1, radii, 0.5*radii)
+
+    directions, angular_weights = get_angular_grid(angular_order)
+    R = np.sqrt(np.sum((coords[:,None,:] - coords[None,:,:])**2, axis=2))
+    points = []
+    weights = []
+    for a in range(coords.shape[0]):
+        r, radial_weights = get_radial_grid(radial_points, rm[a])
+        atom_points = coords[a][None,None,:] + r[:,None,None]*directions.T[None,:,:]
+        atom_weights = radial_weights[:,None]*angular_weights[None,:]
+
+        # atoms sorted by distance, the first is atom a itself
+        order = np.argsort(R[a], kind='stable')
+        nearest = R[a, order[1]] if len(order) > 1 else np.inf
+        counts = np.searchsorted(R[a, order], 2*r/(1 - screen), side='left')
+        counts[2*r/nearest - 1 <= -screen] = 1
+        for count in np.unique(counts):
+            if count == 1:
+                continue
+            shells = np.nonzero(counts == count)[0]
+            block = atom_points[shells].reshape(-1, 3)
+            owner = np.zeros(block.shape[0], dtype=np.int64)
+            atom_weights[shells] *= get_becke_weights(block, owner, coords[order[:count]], radii[order[:count]], iterations=becke_iterations).reshape(len(shells), -1)
+
+        points.append(atom_points.reshape(-1, 3).T)
+        weights.append(atom_weights.reshape(-1))
+    return np.concatenate(points, axis=1), np.concatenate(weights)
+
+
 #import gau2grid as g2g
 #from scipy import spatial
 
@@ -489,7 +509,7 @@ def gau2grid_density_kdtree(x, y, z, data, ml_y, rs, ldepb=False):
     ml_density_per_l = np.array([np.zeros_like(x), np.zeros_like(x), np.zeros_like(x), np.zeros_like(x), np.zeros_like(x)])
     target_density_per_l = np.array([np.zeros_like(x), np.zeros_like(x), np.zeros_like(x),np.zeros_like(x),np.zeros_like(x)])
     
-    for coords, full_coeffs, iso_coeffs, ml_coeffs, alpha, norm in zip(data.pos_orig.cpu().detach().numpy(), data.full_c.cpu().detach().numpy(), data.iso_c.cpu().detach().numpy(), ml_y.cpu().detach().numpy(), data.exp.cpu().detach().numpy(), data.norm.cpu().detach().numpy()):
+    for coords, full_coeffs, iso_coeffs, ml_coeffs, alpha, norm in zip(data.pos_orig.cpu().detach().numpy(), permute_coeffs(data.full_c.cpu().detach().numpy(), rs), permute_coeffs(data.iso_c.cpu().detach().numpy(), rs), permute_coeffs(ml_y.cpu().detach().numpy(), rs), data.exp.cpu().detach().numpy(), data.norm.cpu().detach().numpy()):
         center = coords
         counter = 0
         for mul, l in rs:
@@ -524,13 +544,7 @@ def gau2grid_density_kdtree(x, y, z, data, ml_y, rs, ldepb=False):
                     ret_target = g2g.collocation(points*angstrom2bohr, l, [1], exp, center*angstrom2bohr) 
                     ret_ml = g2g.collocation(points*angstrom2bohr, l, [1], exp, center*angstrom2bohr)
                     
-                    # Now permute back to psi4 ordering
-                    ##              s     p         d             f                 g                      h                           i
-                    psi4_2_e3nn = [[0],[2,0,1],[4,2,0,1,3],[6,4,2,0,1,3,5],[8,6,4,2,0,1,3,5,7],[10,8,6,4,2,0,1,3,5,7,9],[12,10,8,6,4,2,0,1,3,5,7,9,11]]
-                    e3nn_2_psi4 = [[0],[1,2,0],[2,3,1,4,0],[3,4,2,5,1,6,0],[4,5,3,6,2,7,1,8,0],[5,6,4,7,3,8,2,9,1,10,0],[6,7,5,8,4,9,3,10,2,11,1,12,0]]
-                    
-                    target_full_coeffs = np.array([target_full_coeffs[k] for k in e3nn_2_psi4[l]])
-                    ml_full_coeffs = np.array([ml_full_coeffs[k] for k in e3nn_2_psi4[l]])
+                    # the coefficient rows were permuted to psi4 ordering above
                     
                     #target_full_coeffs = full_coeffs[counter:counter+(2*l + 1)]
                     scaled_components = (target_full_coeffs * normal * ret_target["PHI"].T).T
@@ -558,6 +572,346 @@ def gau2grid_density_kdtree(x, y, z, data, ml_y, rs, ldepb=False):
     else:
         return target_density, ml_density
 
+
+def get_shell_layout(rs):
+    import numpy as np
+    # column offset and angular momentum of every shell in an Rs layout
+    starts = []
+    ls = []
+    counter = 0
+    for mul, l in rs:
+        for j in range(mul):
+            starts.append(counter)
+            ls.append(l)
+            counter += 2*l + 1
+    return np.array(starts, dtype=np.int64), np.array(ls, dtype=np.int64)
+
+
+def gau2grid_density_batched(x, y, z, data, ml_y, rs, ldepb=False, small=1e-5, max_block=2**22):
+    import numpy as np
+    from scipy import spatial
+    # same inputs and outputs as gau2grid_density_kdtree, but instead of
+    # looping over atoms x shells, every shell with the same (l, exponent)
+    # is evaluated in one collocation call (see gau2grid_density_coeffs)
+    xyz = np.vstack([x,y,z])
+    tree = spatial.cKDTree(xyz.T)
+
+    full_coeffs = data.full_c.cpu().detach().numpy()
+    ml_full_coeffs = get_ml_full_coeffs(data, ml_y)
+
+    (target_density, target_density_per_l), (ml_density, ml_density_per_l) = gau2grid_density_coeffs(xyz, tree, data, [full_coeffs, ml_full_coeffs], rs, small=small, max_block=max_block)
+
+    if ldepb:
+        return target_density, ml_density, target_density_per_l, ml_density_per_l
+    else:
+        return target_density, ml_density
+
+
+def get_ml_full_coeffs(data, ml_y):
+    import numpy as np
+    # full coefficients of an ml prediction of the populations
+    # (c = pop * norm / 2 sqrt(2) plus the isolated atoms)
+    ml_coeffs = ml_y.cpu().detach().numpy()
+    norm = data.norm.cpu().detach().numpy()
+    iso_coeffs = data.iso_c.cpu().detach().numpy()
+    return ml_coeffs * norm / (2 * np.sqrt(2)) + iso_coeffs
+
+
+def get_ml_psi4_coeffs(y, x, norms, iso_c, Rs, standardizer=None):
+    import math
+    import torch
+    # full coefficients in psi4 ordering of network outputs y [..., N, C]
+    # (torch, on any device), as written by the inference scripts: a
+    # standardizer (train_density.py --standardize) is inverted with the
+    # onehot x [N, E], then the populations become coefficients as in
+    # get_ml_full_coeffs (zero where the norm [N, C] is) and the isolated
+    # atom coefficients iso_c [N, C] are added back
+    if standardizer is not None:
+        y = standardizer.inverse(y, x)
+    c = torch.where(norms != 0, y*norms/(2*math.sqrt(2)), torch.zeros_like(y)) + iso_c
+    return permute_coeffs(c, Rs, to='psi4')
+
+
+def gau2grid_density_coeffs(xyz, tree, data, coeff_list, rs, small=1e-5, max_block=2**22, neighbors=None):
+    import numpy as np
+    import gau2grid as g2g
+    # density of every full coefficient array in coeff_list (in e3nn order,
+    # like data.full_c) on the points xyz [3, npoints] in angstrom, with the
+    # kd tree over those points. returns a (density, density_per_l) pair for
+    # each coefficient array
+    # the points of all atoms in an (l, exponent) group are stacked relative
+    # to their own centers, so one call with the center at the origin covers
+    # the whole group. the cutoff of each shell uses the largest coefficient
+    # over coeff_list
+    # max_block bounds the number of (shell, point) pairs held at once
+    # with neighbors from get_grid_neighbors, the points of a shell are read
+    # from the precomputed lists and the tree is only queried for shells whose
+    # cutoff is beyond the precomputed radius of their atom
+    npoints = xyz.shape[1]
+
+    angstrom2bohr = 1.8897259886
+    bohr2angstrom = 1/angstrom2bohr
+
+    coords = data.pos_orig.cpu().detach().numpy()
+    alpha = data.exp.cpu().detach().numpy()
+    norm = data.norm.cpu().detach().numpy()
+
+    starts, ls = get_shell_layout(rs)
+
+    nl = max(5, int(ls.max()) + 1)
+    densities = [np.zeros(npoints, dtype=xyz.dtype) for coeffs in coeff_list]
+    densities_per_l = [np.zeros((nl, npoints), dtype=xyz.dtype) for coeffs in coeff_list]
+
+    e3nn_2_psi4, _ = get_psi4_permutation(tuple(map(tuple, rs)))
+
+    # group every nonzero (atom, shell) by angular momentum and exponent
+    atom_idx, shell_idx = np.nonzero(norm[:, starts] != 0)
+    shell_l = ls[shell_idx]
+    shell_exp = alpha[atom_idx, starts[shell_idx]]
+    groups = {}
+    for key, a, s in zip(zip(shell_l.tolist(), shell_exp.tolist()), atom_idx, shell_idx):
+        groups.setdefault(key, []).append((a, s))
+
+    for (l, exp), members in groups.items():
+        members = np.array(members)
+        atoms = members[:,0]
+        cols = e3nn_2_psi4[starts[members[:,1]][:,None] + np.arange(2*l + 1)[None,:]]
+        normal = norm[atoms, starts[members[:,1]]]
+
+        group_coeffs = [coeffs[atoms[:,None], cols] for coeffs in coeff_list]
+
+        max_c = np.amax([np.amax(np.abs(coeffs), axis=1) for coeffs in group_coeffs], axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cutoff = np.sqrt((-1/exp)*np.log(small/np.abs(max_c*normal)))*bohr2angstrom
+        keep = np.isfinite(cutoff)
+
+        centers = coords[atoms]
+        lengths = np.zeros(len(atoms), dtype=np.int64)
+        if neighbors is None:
+            lengths[keep] = tree.query_ball_point(centers[keep], cutoff[keep], return_length=True, workers=-1)
+        else:
+            indptr = neighbors['indptr']
+            listed = keep & (cutoff <= neighbors['cutoffs'][atoms])
+            for k in np.nonzero(listed)[0]:
+                a = atoms[k]
+                lengths[k] = np.searchsorted(neighbors['dists'][indptr[a]:indptr[a+1]], cutoff[k], side='right')
+            unlisted = keep & ~listed
+            lengths[unlisted] = tree.query_ball_point(centers[unlisted], cutoff[unlisted], return_length=True, workers=-1)
+        rows = np.nonzero(lengths)[0]
+
+        # split the group so that no block holds more than max_block pairs
+        cum_lengths = np.cumsum(lengths[rows])
+        begin = 0
+        while begin < len(rows):
+            done = cum_lengths[begin-1] if begin > 0 else 0
+            end = max(begin + 1, int(np.searchsorted(cum_lengths, done + max_block, side='right')))
+            block = rows[begin:end]
+            begin = end
+
+            if neighbors is None:
+                close_indices = tree.query_ball_point(centers[block], cutoff[block], workers=-1)
+            else:
+                close_indices = [neighbors['indices'][indptr[atoms[k]]:indptr[atoms[k]]+lengths[k]] if listed[k] else tree.query_ball_point(centers[k], cutoff[k]) for k in block]
+            owner = np.repeat(np.arange(len(block)), lengths[block])
+            close_indices = np.concatenate([np.asarray(c, dtype=np.int64) for c in close_indices])
+
+            center_bohr = (centers[block]*angstrom2bohr).astype(np.float64)
+            points = xyz[:,close_indices]*angstrom2bohr - center_bohr[owner].T
+            points = np.require(points, requirements=['C','A'])
+            phi = g2g.collocation(points, l, [1], [exp], [0.0, 0.0, 0.0])["PHI"]
+
+            for coeffs, density, density_per_l in zip(group_coeffs, densities, densities_per_l):
+                scaled = coeffs[block] * normal[block,None]
+                tot = scaled[owner,0] * phi[0]
+                for m in range(1, 2*l + 1):
+                    tot += scaled[owner,m] * phi[m]
+
+                tot = np.bincount(close_indices, weights=tot, minlength=npoints)
+                density += tot
+                density_per_l[l] += tot
+
+    return list(zip(densities, densities_per_l))
+
+def get_atom_radii(coeffs, exps, norms, Rs, small=1e-5):
+    import numpy as np
+    # radius (angstrom) past which every shell of an atom is below small,
+    # |c| norm exp(-a r^2) < small, or -1 for atoms with no shell above it
+    bohr2angstrom = 1/1.8897259886
+    starts, ls = get_shell_layout(Rs)
+    shell_max = np.stack([np.amax(np.abs(coeffs[:, start:start + 2*l + 1]), axis=1) for start, l in zip(starts, ls)], axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cutoffs = np.sqrt((-1/exps[:, starts])*np.log(small/np.abs(shell_max*norms[:, starts])))*bohr2angstrom
+    cutoffs[~np.isfinite(cutoffs)] = -1.0
+    return np.amax(cutoffs, axis=1)
+
+
+def evaluate_density(points, coeffs, exps, norms, positions, Rs, small=1e-5, chunk_size=2**20, max_block=2**22, sort=True):
+    import numpy as np
+    import torch
+    import torch_geometric
+    from scipy import spatial
+    # density of the full coefficients coeffs [N, C] (e3nn order, like
+    # data.full_c or get_ml_full_coeffs) at arbitrary points [P, 3], e.g.
+    # embedding points, isosurface vertices or cube files. numpy arrays or
+    # tensors are accepted, points and positions are in angstrom and the
+    # density is returned in e-/bohr**3
+    # - a shell is only evaluated where |c| norm exp(-a r^2) > small, and
+    #   shells with |c| norm below small are skipped altogether
+    # - every atom has a bounding sphere (its largest shell cutoff) and a
+    #   chunk of points only sees the atoms whose sphere reaches its box
+    # - with sort, points are ordered by 2 angstrom cells so that chunks are
+    #   compact, and chunk_size points are evaluated at a time
+
+    def as_numpy(x):
+        if isinstance(x, torch.Tensor):
+            x = x.detach().cpu().numpy()
+        return np.asarray(x, dtype=np.float64)
+
+    points = as_numpy(points).reshape(-1, 3)
+    coeffs = as_numpy(coeffs)
+    exps = as_numpy(exps)
+    norms = as_numpy(norms)
+    positions = as_numpy(positions)
+
+    radius = get_atom_radii(coeffs, exps, norms, Rs, small=small)
+    atoms = np.nonzero(radius >= 0)[0]
+
+    density = np.zeros(points.shape[0])
+    if sort:
+        cells = np.floor(points/2.0).astype(np.int64)
+        order = np.lexsort((cells[:, 2], cells[:, 1], cells[:, 0]))
+    for begin in range(0, points.shape[0], chunk_size):
+        index = order[begin:begin + chunk_size] if sort else slice(begin, begin + chunk_size)
+        chunk = points[index]
+
+        # distance from every atom to the bounding box of the chunk
+        gap = np.maximum(chunk.min(0) - positions[atoms], 0) + np.maximum(positions[atoms] - chunk.max(0), 0)
+        near = atoms[np.sqrt(np.sum(gap**2, axis=1)) <= radius[atoms]]
+        if len(near) == 0:
+            continue
+
+        data = torch_geometric.data.Data(pos_orig=torch.from_numpy(positions[near]), exp=torch.from_numpy(exps[near]), norm=torch.from_numpy(norms[near]))
+        xyz = np.ascontiguousarray(chunk.T)
+        tree = spatial.cKDTree(chunk)
+        density[index] = gau2grid_density_coeffs(xyz, tree, data, [coeffs[near]], Rs, small=small, max_block=max_block)[0][0]
+
+    return density
+
+
+def generate_periodic_grid(cell, spacing=0.2):
+    import numpy as np
+    # uniform grid of a periodic cell (lattice vectors as rows, angstrom),
+    # with about spacing between points along each lattice vector and no
+    # points on the far faces (they are images of the near ones)
+    # returns x, y, z [na, nb, nc] and the volume of a point in bohr**3, so
+    # that density.sum()*vol is the number of electrons in the cell
+    angstrom2bohr = 1.8897259886
+    cell = np.asarray(cell, dtype=np.float64)
+    shape = [max(int(np.ceil(np.linalg.norm(vector)/spacing)), 1) for vector in cell]
+    frac = np.stack(np.meshgrid(*[np.arange(n)/n for n in shape], indexing='ij'), axis=-1)
+    xyz = frac @ cell
+    vol = abs(np.linalg.det(cell))*angstrom2bohr**3/np.prod(shape)
+    return xyz[..., 0], xyz[..., 1], xyz[..., 2], vol
+
+
+def get_periodic_images(positions, cell, radius):
+    import numpy as np
+    import itertools
+    # periodic images of the atoms (positions [N, 3] wrapped into the cell)
+    # whose sphere of radius [N] reaches into the cell, as (index [M] of the
+    # atom of each image, image positions [M, 3]), the atoms themselves
+    # included; a sphere reaches the cell if its center is within radius of
+    # all the faces, measured along the normals (a superset in skewed cells)
+    cell = np.asarray(cell, dtype=np.float64)
+    frac = np.asarray(positions, dtype=np.float64) @ np.linalg.inv(cell)
+    frac = frac - np.floor(frac)
+    volume = abs(np.linalg.det(cell))
+    heights = volume/np.linalg.norm(np.cross(cell[[1, 2, 0]], cell[[2, 0, 1]]), axis=1)
+    reach = np.maximum(radius, 0)[:, None]/heights[None, :]
+    kmax = int(np.ceil(np.amax(reach, initial=0.0))) + 1
+
+    index, images = [], []
+    for image in itertools.product(range(-kmax, kmax + 1), repeat=3):
+        shifted = frac + np.array(image)
+        inside = np.all((shifted >= -reach) & (shifted <= 1 + reach), axis=1) & (radius >= 0)
+        index.append(np.nonzero(inside)[0])
+        images.append(shifted[inside] @ cell)
+    return np.concatenate(index), np.concatenate(images)
+
+
+def evaluate_periodic_density(points, coeffs, exps, norms, positions, Rs, cell, small=1e-5, **kwargs):
+    import numpy as np
+    import torch
+    # evaluate_density of a periodic system (cell: lattice vectors as rows,
+    # angstrom) at points [P, 3] anywhere, e.g. generate_periodic_grid
+    # points are wrapped into the cell, and the atoms are replaced by all
+    # their periodic images that reach into it, so the kd tree and the
+    # collocation of evaluate_density see every image within the shell
+    # cutoffs; kwargs go to evaluate_density
+    def as_numpy(x):
+        if isinstance(x, torch.Tensor):
+            x = x.detach().cpu().numpy()
+        return np.asarray(x, dtype=np.float64)
+
+    cell = as_numpy(cell)
+    points = as_numpy(points).reshape(-1, 3)
+    coeffs = as_numpy(coeffs)
+    exps = as_numpy(exps)
+    norms = as_numpy(norms)
+    frac = points @ np.linalg.inv(cell)
+    points = (frac - np.floor(frac)) @ cell
+
+    radius = get_atom_radii(coeffs, exps, norms, Rs, small=small)
+    index, images = get_periodic_images(as_numpy(positions), cell, radius)
+    return evaluate_density(points, coeffs[index], exps[index], norms[index], images, Rs, small=small, **kwargs)
+
+def get_grid_neighbors(xyz, tree, data, rs, coeff_scale=10.0, small=1e-5):
+    import numpy as np
+    # precomputed grid points around every atom for gau2grid_density_coeffs
+    # the radius of an atom is the largest shell cutoff for coefficients up to
+    # coeff_scale times the largest target or isolated atom coefficient of the
+    # shell, so any prediction within that bound needs no tree queries
+    # the lists are stored as CSR arrays, indptr [natoms + 1] into indices
+    # (point indices) and dists, sorted by distance from the atom, so the
+    # points of a shell are the first searchsorted(dists, cutoff) entries
+    angstrom2bohr = 1.8897259886
+    bohr2angstrom = 1/angstrom2bohr
+
+    coords = data.pos_orig.cpu().detach().numpy()
+    alpha = data.exp.cpu().detach().numpy()
+    norm = data.norm.cpu().detach().numpy()
+    bound = coeff_scale*np.maximum(np.abs(data.full_c.cpu().detach().numpy()), np.abs(data.iso_c.cpu().detach().numpy()))
+
+    starts, ls = get_shell_layout(rs)
+    shell_bound = np.zeros((coords.shape[0], len(starts)))
+    for i, (start, l) in enumerate(zip(starts, ls)):
+        shell_bound[:, i] = np.amax(bound[:, start:start + 2*l + 1], axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shell_cutoffs = np.sqrt((-1/alpha[:, starts])*np.log(small/np.abs(shell_bound*norm[:, starts])))*bohr2angstrom
+    shell_cutoffs[~np.isfinite(shell_cutoffs)] = 0.0
+    cutoffs = np.amax(shell_cutoffs, axis=1)
+
+    index_type = np.int32 if xyz.shape[1] < 2**31 else np.int64
+    close_indices = tree.query_ball_point(coords, cutoffs, workers=-1)
+    indptr = np.zeros(coords.shape[0] + 1, dtype=np.int64)
+    indices = []
+    dists = []
+    for a, close in enumerate(close_indices):
+        close = np.asarray(close, dtype=np.int64)
+        dist = np.sqrt(np.sum((xyz[:, close].T.astype(np.float64) - coords[a])**2, axis=1))
+        order = np.argsort(dist, kind='stable')
+        indices.append(close[order].astype(index_type))
+        dists.append(dist[order])
+        indptr[a + 1] = indptr[a] + len(close)
+
+    return {
+        'indptr': indptr,
+        'indices': np.concatenate(indices) if indices else np.zeros(0, dtype=index_type),
+        'dists': np.concatenate(dists) if dists else np.zeros(0),
+        'cutoffs': cutoffs,
+    }
+
+
 # use with get_iso_permuted_dataset_lpop_scale
 def gau2grid_density_kdtree_lpop_scale(x, y, z, data, ml_y, rs, isoOnlyFlag=0):
 
@@ -571,7 +925,7 @@ def gau2grid_density_kdtree_lpop_scale(x, y, z, data, ml_y, rs, isoOnlyFlag=0):
     ml_density_neg = np.zeros_like(x)
     target_density = np.zeros_like(x)
 
-    for coords, full_coeffs, iso_coeffs, ml_coeffs, alpha, norm in zip(data.pos_orig.cpu().detach().numpy(), data.full_c.cpu().detach().numpy(), data.iso_c.cpu().detach().numpy(), ml_y.cpu().detach().numpy(), data.exp.cpu().detach().numpy(), data.norm.cpu().detach().numpy()):
+    for coords, full_coeffs, iso_coeffs, ml_coeffs, alpha, norm in zip(data.pos_orig.cpu().detach().numpy(), permute_coeffs(data.full_c.cpu().detach().numpy(), rs), permute_coeffs(data.iso_c.cpu().detach().numpy(), rs), permute_coeffs(ml_y.cpu().detach().numpy(), rs), data.exp.cpu().detach().numpy(), data.norm.cpu().detach().numpy()):
         center = coords
         counter = 0
         for mul, l in rs:
@@ -657,12 +1011,7 @@ def gau2grid_density_kdtree_lpop_scale(x, y, z, data, ml_y, rs, isoOnlyFlag=0):
                     ret_ml = g2g.collocation(points*angstrom2bohr, l, [1], exp, center*angstrom2bohr)
 
 
-                    # Now permute back to psi4 ordering
-                    ##              s     p         d             f                 g
-                    psi4_2_e3nn = [[0],[2,0,1],[4,2,0,1,3],[6,4,2,0,1,3,5],[8,6,4,2,0,1,3,5,7],[10,8,6,4,2,0,1,3,5,7,9],[12,10,8,6,4,2,0,1,3,5,7,9,11]]
-                    e3nn_2_psi4 = [[0],[1,2,0],[2,3,1,4,0],[3,4,2,5,1,6,0],[4,5,3,6,2,7,1,8,0],[5,6,4,7,3,8,2,9,1,10,0],[6,7,5,8,4,9,3,10,2,11,1,12,0]]
-                    target_full_coeffs = np.array([target_full_coeffs[k] for k in e3nn_2_psi4[l]])
-                    ml_full_coeffs = np.array([ml_full_coeffs[k] for k in e3nn_2_psi4[l]])
+                    # the coefficient rows were permuted to psi4 ordering above
 
                     #target_full_coeffs = full_coeffs[counter:counter+(2*l + 1)]
                     scaled_components = (target_full_coeffs * normal * ret_target["PHI"].T).T
@@ -683,40 +1032,131 @@ def gau2grid_density_kdtree_lpop_scale(x, y, z, data, ml_y, rs, isoOnlyFlag=0):
     return target_density, ml_density
     
 
-def get_scalar_density_comparisons(data, y_ml, Rs, spacing=0.5, buffer=2.0, ldep=False):
+class DensityGridCache:
+    # per-molecule cache for get_scalar_density_comparisons of the
+    # evaluation grid, its kd tree and the target density, which do not
+    # change between epochs. entries are keyed on the geometry and target
+    # coefficients of the molecule plus the grid spacing and buffer, and the
+    # least recently used entries are evicted to stay under max_bytes
+    # with neighbor_lists, the grid points around every atom are also stored
+    # (get_grid_neighbors), so later evaluations skip the kd tree queries
+    # grid is 'cube' (generate_grid) or 'becke' (generate_becke_grid, which
+    # does not use spacing and buffer)
+
+    def __init__(self, max_bytes=2**31, neighbor_lists=True, coeff_scale=10.0):
+        from collections import OrderedDict
+        self.max_bytes = max_bytes
+        self.neighbor_lists = neighbor_lists
+        self.coeff_scale = coeff_scale
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get_key(self, data, Rs, spacing, buffer, grid='cube'):
+        import hashlib
+        sha = hashlib.sha1()
+        for field in (data.pos_orig, data.full_c, data.exp, data.norm):
+            sha.update(field.cpu().detach().numpy().tobytes())
+        return sha.hexdigest(), tuple(map(tuple, Rs)), spacing, buffer, grid
+
+    def get(self, data, Rs, spacing, buffer, grid='cube'):
+        import numpy as np
+        from scipy import spatial
+        key = self.get_key(data, Rs, spacing, buffer, grid)
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+
+        xyz, vol = get_comparison_grid(data, spacing, buffer, grid)
+        tree = spatial.cKDTree(xyz.T)
+        entry = {'xyz': xyz, 'vol': vol, 'tree': tree}
+        entry['neighbors'] = get_grid_neighbors(xyz, tree, data, Rs, coeff_scale=self.coeff_scale) if self.neighbor_lists else None
+        target_density, target_density_per_l = gau2grid_density_coeffs(xyz, tree, data, [data.full_c.cpu().detach().numpy()], Rs, neighbors=entry['neighbors'])[0]
+        entry['target_density'] = target_density
+        entry['target_density_per_l'] = target_density_per_l
+        entry['nbytes'] = xyz.nbytes + np.asarray(vol).nbytes + tree.data.nbytes + tree.indices.nbytes + target_density.nbytes + target_density_per_l.nbytes
+        if entry['neighbors'] is not None:
+            entry['nbytes'] += entry['neighbors']['indices'].nbytes + entry['neighbors']['dists'].nbytes
+        self.entries[key] = entry
+        self.nbytes += entry['nbytes']
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            key, evicted = self.entries.popitem(last=False)
+            self.nbytes -= evicted['nbytes']
+        return entry
+
+
+def get_comparison_grid(data, spacing, buffer, grid='cube'):
+    import numpy as np
+    # points [3, npoints] in angstrom and the volume of every point (a scalar
+    # for the cube, weights for the becke grid) for get_scalar_density_comparisons
+    if grid == 'cube':
+        x,y,z,vol,x_spacing,y_spacing,z_spacing = generate_grid(data, spacing=spacing, buffer=buffer)
+        return np.vstack([x.flatten(),y.flatten(),z.flatten()]), vol
+    elif grid == 'becke':
+        return generate_becke_grid(data)
+    raise ValueError("unknown grid " + str(grid))
+
+
+def get_scalar_density_comparisons(data, y_ml, Rs, spacing=0.5, buffer=2.0, ldep=False, cache=None, grid='cube'):
     import numpy as np
+    # with a DensityGridCache as cache, the grid, kd tree and target density
+    # of a molecule are only built the first time and only the ml density is
+    # evaluated on later calls
+    # grid='becke' integrates on atom-centered grids (generate_becke_grid)
+    # instead of the uniform cube, which needs far fewer points for the same
+    # accuracy. spacing and buffer only apply to the cube
+    if cache is not None:
+        entry = cache.get(data, Rs, spacing, buffer, grid)
+        vol = entry['vol']
+        target_density = entry['target_density']
+        target_density_per_l = entry['target_density_per_l']
+        ml_density, ml_density_per_l = gau2grid_density_coeffs(entry['xyz'], entry['tree'], data, [get_ml_full_coeffs(data, y_ml)], Rs, neighbors=entry['neighbors'])[0]
+        return get_density_metrics(target_density, ml_density, target_density_per_l, ml_density_per_l, vol, Rs, ldep)
+
     # generate grid in xyz input units (angstroms)
-    x,y,z,vol,x_spacing,y_spacing,z_spacing = generate_grid(data, spacing=spacing, buffer=buffer)
+    xyz, vol = get_comparison_grid(data, spacing, buffer, grid)
+    x, y, z = xyz
     # get density on grid
     
+    if ldep:
+        target_density, ml_density, target_density_per_l, ml_density_per_l = gau2grid_density_batched(x.flatten(),y.flatten(),z.flatten(),data,y_ml,Rs, ldepb=ldep)
+        #target_density, ml_density, target_density_per_l, ml_density_per_l = gau2grid_density_kdtree_lpop_scale(x.flatten(),y.flatten(),z.flatten(),data,y_ml,Rs, ldepb=ldep)
+    else:
+        target_density, ml_density = gau2grid_density_batched(x.flatten(),y.flatten(),z.flatten(),data,y_ml,Rs,ldepb=ldep)
+        target_density_per_l, ml_density_per_l = None, None
+        #target_density, ml_density = gau2grid_density_kdtree_lpop_scale(x.flatten(),y.flatten(),z.flatten(),data,y_ml,Rs,ldepb=ldep)
+
+    return get_density_metrics(target_density, ml_density, target_density_per_l, ml_density_per_l, vol, Rs, ldep)
+
+
+def get_density_metrics(target_density, ml_density, target_density_per_l, ml_density_per_l, vol, Rs, ldep=False):
+    import numpy as np
+    # vol is the volume of a grid point in angstrom**3, either one number for
+    # the cube or the weight of every point of an atom-centered grid
     #l-dependent eps
     ep_per_l = np.zeros(len(Rs))
 
     if ldep:
-        target_density, ml_density, target_density_per_l, ml_density_per_l = gau2grid_density_kdtree(x.flatten(),y.flatten(),z.flatten(),data,y_ml,Rs, ldepb=ldep)
-        #target_density, ml_density, target_density_per_l, ml_density_per_l = gau2grid_density_kdtree_lpop_scale(x.flatten(),y.flatten(),z.flatten(),data,y_ml,Rs, ldepb=ldep)
         #fill l-dependent eps in this case
         for l in range(len(Rs)):
-            ep_per_l[l] = 100 * np.sum(np.abs(ml_density_per_l[l]-target_density_per_l[l])) / np.sum(target_density)
+            ep_per_l[l] = 100 * np.sum(vol*np.abs(ml_density_per_l[l]-target_density_per_l[l])) / np.sum(vol*target_density)
 
-
-    else:
-        target_density, ml_density = gau2grid_density_kdtree(x.flatten(),y.flatten(),z.flatten(),data,y_ml,Rs,ldepb=ldep)
-        #target_density, ml_density = gau2grid_density_kdtree_lpop_scale(x.flatten(),y.flatten(),z.flatten(),data,y_ml,Rs,ldepb=ldep)
-    
     # density is in e-/bohr**3
     angstrom2bohr = 1.8897259886
     bohr2angstrom = 1/angstrom2bohr
 
     #n_ele = np.sum(data.z.cpu().detach().numpy())
     #ep = 100 * vol * (angstrom2bohr**3) * np.sum(np.abs(target_density - ml_density)) / n_ele
-    ep = 100 * np.sum(np.abs(ml_density-target_density)) / np.sum(target_density)
+    ep = 100 * np.sum(vol*np.abs(ml_density-target_density)) / np.sum(vol*target_density)
     
-    num_ele_target = np.sum(target_density)*vol*angstrom2bohr**3
-    num_ele_ml = np.sum(ml_density)*vol*angstrom2bohr**3
+    num_ele_target = np.sum(vol*target_density)*angstrom2bohr**3
+    num_ele_ml = np.sum(vol*ml_density)*angstrom2bohr**3
 
-    numer = np.sum((ml_density - target_density)**2)
-    denom = np.sum(ml_density**2) + np.sum(target_density**2)
+    numer = np.sum(vol*(ml_density - target_density)**2)
+    denom = np.sum(vol*ml_density**2) + np.sum(vol*target_density**2)
     bigI = numer/denom
     
     if ldep: return num_ele_target, num_ele_ml, bigI, ep, ep_per_l
@@ -724,6 +1164,529 @@ def get_scalar_density_comparisons(data, y_ml, Rs, spacing=0.5, buffer=2.0, ldep
     else: return num_ele_target, num_ele_ml, bigI, ep
 
 
+from functools import lru_cache
+
+@lru_cache(maxsize=None)
+def get_solid_harmonic_coeffs(l):
+    import numpy as np
+    from math import factorial, comb, sqrt
+    # cartesian expansion of the real solid harmonics used by psi4 and gau2grid
+    # (Helgaker, Jorgensen and Olsen, eqs. 6.4.47-6.4.50)
+    # returns the cartesian powers [ncart, 3] and the coefficients
+    # [2l+1, ncart], with rows in e3nn ordering (-l, ..., 0, ..., +l)
+    if l > 6:
+        raise ValueError('L is too high. Currently only supports L<7')
+    powers = [(l - ly - lz, ly, lz) for lz in range(l + 1) for ly in range(l - lz + 1)]
+    index = {p: i for i, p in enumerate(powers)}
+
+    coeffs = np.zeros((2*l + 1, len(powers)))
+    for row, m in enumerate(range(-l, l + 1)):
+        am = abs(m)
+        # v runs over half integers for the sine (m < 0) components
+        vm2 = 1 if m < 0 else 0
+        normal = sqrt(2 * factorial(l + am) * factorial(l - am) / (2 if m == 0 else 1)) / (2**am * factorial(l))
+        for t in range((l - am)//2 + 1):
+            for u in range(t + 1):
+                for k in range((am - vm2)//2 + 1):
+                    v2 = vm2 + 2*k
+                    c = (-1)**(t + k) * 0.25**t * comb(l, t) * comb(l - t, am + t) * comb(t, u) * comb(am, v2)
+                    power = (2*t + am - 2*u - v2, 2*u + v2, l - 2*t - am)
+                    coeffs[row, index[power]] += normal * c
+
+    return np.array(powers), coeffs
+
+
+def gaussian_density_torch(points, coeffs, exps, norms, positions, Rs, cutoffs=None, chunk_size=4096, shell_chunk=64):
+    import torch
+    # pure torch version of the collocation in gau2grid_density_kdtree
+    # points [P, 3] and positions [N, 3] are in angstrom, coeffs are the full
+    # (not population) coefficients in e3nn ordering, shape [N, C]
+    # optional cutoffs [N, nshells] in angstrom drop shell contributions
+    # beyond that distance, exactly like the kdtree screening, and shells
+    # with a negative cutoff (negligible everywhere) altogether
+    # everything stays on the device of coeffs and is differentiable
+    # points are processed chunk_size at a time and shells shell_chunk at a
+    # time, so memory is bounded by shell_chunk*chunk_size*ncart
+    angstrom2bohr = 1.8897259886
+    device = coeffs.device
+    dtype = coeffs.dtype
+
+    starts, ls = get_shell_layout(Rs)
+    points = points.to(device=device, dtype=dtype)
+    positions = positions.to(device=device, dtype=dtype)
+    exps = exps.to(device=device, dtype=dtype)
+    norms = norms.to(device=device, dtype=dtype)
+
+    # per l: the (atom, shell) pairs with a basis function present
+    shells = []
+    for l in sorted(set(ls.tolist())):
+        shell_idx = torch.as_tensor((ls == l).nonzero()[0], device=device)
+        shell_starts = torch.as_tensor(starts, device=device)[shell_idx]
+        present = norms[:, shell_starts] != 0
+        if cutoffs is not None:
+            present = present & (cutoffs.to(device=device, dtype=dtype)[:, shell_idx] >= 0)
+        atom_idx, which = present.nonzero(as_tuple=True)
+        cols = shell_starts[which]
+        normal = norms[atom_idx, cols]
+        alpha = exps[atom_idx, cols]
+        comp = cols[:, None] + torch.arange(2*l + 1, device=device)[None, :]
+        weights = coeffs[atom_idx[:, None], comp] * normal[:, None]
+        cut = None if cutoffs is None else cutoffs.to(device=device, dtype=dtype)[atom_idx, shell_idx[which]]
+        powers, harmonics = get_solid_harmonic_coeffs(l)
+        powers = torch.as_tensor(powers, device=device)
+        harmonics = torch.as_tensor(harmonics, device=device, dtype=dtype)
+        for first in range(0, atom_idx.shape[0], shell_chunk):
+            group = slice(first, first + shell_chunk)
+            shells.append((atom_idx[group], alpha[group], weights[group], None if cut is None else cut[group], powers, harmonics))
+
+    density = []
+    for chunk in torch.split(points, chunk_size):
+        chunk_density = chunk.new_zeros(chunk.shape[0])
+        for atom_idx, alpha, weights, cut, powers, harmonics in shells:
+            # [S, P, 3] displacements in bohr from the atom of every shell
+            rel = (chunk[None, :, :] - positions[atom_idx, None, :]) * angstrom2bohr
+            r2 = rel.pow(2).sum(-1)
+            radial = torch.exp(-alpha[:, None] * r2)
+            if cut is not None:
+                radial = radial * (r2 <= (cut[:, None]*angstrom2bohr)**2)
+            cart = rel[..., 0, None].pow(powers[:, 0]) * rel[..., 1, None].pow(powers[:, 1]) * rel[..., 2, None].pow(powers[:, 2])
+            angular = cart @ harmonics.T
+            chunk_density = chunk_density + (radial * (angular * weights[:, None, :]).sum(-1)).sum(0)
+        density.append(chunk_density)
+
+    return torch.cat(density)
+
+
+def get_density_cutoffs(data, ml_full_c, Rs, small=1e-5):
+    import torch
+    # per (atom, shell) cutoff radius in angstrom used by gau2grid_density_kdtree
+    angstrom2bohr = 1.8897259886
+    starts, ls = get_shell_layout(Rs)
+    norms = data.norm.detach().to(device=ml_full_c.device, dtype=ml_full_c.dtype)
+    full_c = data.full_c.detach().to(device=ml_full_c.device)
+    exps = data.exp.detach().to(device=ml_full_c.device, dtype=ml_full_c.dtype)
+    cutoffs = torch.full((norms.shape[0], len(starts)), float('nan'), device=norms.device, dtype=norms.dtype)
+    for shell, (start, l) in enumerate(zip(starts, ls)):
+        target_max = full_c[:, start:start + 2*l + 1].abs().amax(1)
+        ml_max = ml_full_c[:, start:start + 2*l + 1].detach().abs().amax(1)
+        max_c = torch.maximum(target_max, ml_max).to(norms.dtype)
+        alpha = exps[:, start]
+        cutoffs[:, shell] = torch.sqrt((-1/alpha)*torch.log(small/torch.abs(max_c*norms[:, start])))/angstrom2bohr
+    return torch.nan_to_num(cutoffs, nan=-1.0)
+
+
+def gau2grid_density_torch(points, data, ml_y, Rs, small=1e-5, chunk_size=4096, dtype=None):
+    import math
+    import torch
+    # torch counterpart of gau2grid_density_kdtree: returns the target and ML
+    # densities at points [P, 3] (angstrom) on the device of ml_y, and keeps
+    # the graph back to ml_y so the density can be used in a loss
+    # set small=None to skip screening and evaluate every shell everywhere
+    if dtype is None:
+        dtype = ml_y.dtype
+    device = ml_y.device
+    norm = data.norm.to(device=device, dtype=dtype)
+    ml_full_c = ml_y.to(dtype) * norm / (2 * math.sqrt(2)) + data.iso_c.to(device=device, dtype=dtype)
+    full_c = data.full_c.to(device=device, dtype=dtype)
+    pos = data.pos_orig.to(device=device, dtype=dtype)
+    exp = data.exp.to(device=device, dtype=dtype)
+
+    cutoffs = None
+    if small is not None:
+        cutoffs = get_density_cutoffs(data, ml_full_c, Rs, small=small)
+
+    target_density = gaussian_density_torch(points, full_c, exp, norm, pos, Rs, cutoffs=cutoffs, chunk_size=chunk_size)
+    ml_density = gaussian_density_torch(points, ml_full_c, exp, norm, pos, Rs, cutoffs=cutoffs, chunk_size=chunk_size)
+
+    return target_density, ml_density
+
+
+# cartesian monomials of the moments, up to second order
+MOMENT_POWERS = [(0,0,0), (1,0,0), (0,1,0), (0,0,1), (2,0,0), (0,2,0), (0,0,2), (1,1,0), (1,0,1), (0,1,1)]
+
+
+@lru_cache(maxsize=None)
+def get_moment_tables(Rs):
+    import numpy as np
+    from math import gamma
+    # integral of every basis function (e3nn order, unit coefficient and norm)
+    # times u^q over all space, with u relative to the center of the function
+    # int S_lm(u) u^q exp(-a u^2) du = K[col, q] * a**P[col, q]
+    # Rs is a tuple of (mul, l) tuples
+    starts, ls = get_shell_layout(Rs)
+    ncol = int(starts[-1] + 2*ls[-1] + 1)
+    K = np.zeros((ncol, len(MOMENT_POWERS)))
+    P = np.zeros((ncol, len(MOMENT_POWERS)))
+    col_l = np.zeros(ncol, dtype=np.int64)
+    for start, l in zip(starts, ls):
+        powers, coeffs = get_solid_harmonic_coeffs(int(l))
+        col_l[start:start + 2*l + 1] = l
+        for q, power in enumerate(MOMENT_POWERS):
+            n = powers + np.array(power)[None, :]
+            # 1D gaussian integrals vanish for odd powers
+            even = np.all(n % 2 == 0, axis=1)
+            integrals = np.array([np.prod([gamma((k + 1)/2) for k in row]) if ok else 0.0 for row, ok in zip(n, even)])
+            K[start:start + 2*l + 1, q] = coeffs @ integrals
+            P[start:start + 2*l + 1, q] = -(l + sum(power) + 3)/2
+    return K, P, col_l
+
+
+def get_density_moments(coeffs, exps, norms, positions, batch, Rs, num_graphs=None, origin=None):
+    import torch
+    # analytic moments of densities given as full coefficients (e3nn order,
+    # like data.full_c) on a batch of molecules, without any grid
+    # positions [N, 3] are in angstrom in the original frame (data.pos_orig)
+    # and batch [N] gives the graph of each atom
+    # returns per graph, in atomic units about origin (bohr, default 0):
+    # - electrons [G] = int rho
+    # - dipole [G, 3] = int rho r
+    # - quadrupole [G, 3, 3] = int rho r r (second moment, not traceless)
+    # and the contributions of each l as electrons_per_l [G, nl] etc
+    # these are moments of the electron density only, with no nuclei
+    angstrom2bohr = 1.8897259886
+    if num_graphs is None:
+        num_graphs = int(batch.max()) + 1 if batch.numel() else 0
+    K, P, col_l = get_moment_tables(tuple(map(tuple, Rs)))
+    device, dtype = coeffs.device, coeffs.dtype
+    K = torch.as_tensor(K, device=device, dtype=dtype)
+    P = torch.as_tensor(P, device=device, dtype=dtype)
+    col_l = torch.as_tensor(col_l, device=device)
+    nl = max(5, int(col_l.max()) + 1)
+
+    # local moments of every column, [N, ncol, nq]
+    present = (norms != 0)
+    safe_exps = torch.where(present, exps, torch.ones_like(exps))
+    weights = K[None] * safe_exps[:, :, None].pow(P[None])
+    terms = (coeffs * norms * present)[:, :, None] * weights
+
+    # [N, nl, nq]
+    local = torch.zeros(coeffs.shape[0], nl, len(MOMENT_POWERS), device=device, dtype=dtype).index_add_(1, col_l, terms)
+
+    A = positions.to(dtype) * angstrom2bohr
+    if origin is not None:
+        A = A - torch.as_tensor(origin, device=device, dtype=dtype)
+    A = A[:, None, :]
+
+    m0 = local[:, :, 0]
+    m1 = local[:, :, 1:4]
+    m2 = torch.zeros(coeffs.shape[0], nl, 3, 3, device=device, dtype=dtype)
+    for q, power in enumerate(MOMENT_POWERS[4:], start=4):
+        i, j = [k for k in range(3) for _ in range(power[k])]
+        m2[:, :, i, j] = local[:, :, q]
+        m2[:, :, j, i] = local[:, :, q]
+
+    # shift from the atom centers to the origin
+    dipole = m1 + A * m0[:, :, None]
+    quadrupole = m2 + A[..., :, None] * m1[..., None, :] + m1[..., :, None] * A[..., None, :] + A[..., :, None] * A[..., None, :] * m0[:, :, None, None]
+
+    def per_graph(x):
+        return torch.zeros((num_graphs,) + x.shape[1:], device=device, dtype=dtype).index_add_(0, batch, x)
+
+    electrons_per_l = per_graph(m0)
+    dipole_per_l = per_graph(dipole)
+    quadrupole_per_l = per_graph(quadrupole)
+    return {
+        'electrons': electrons_per_l.sum(dim=1),
+        'dipole': dipole_per_l.sum(dim=1),
+        'quadrupole': quadrupole_per_l.sum(dim=1),
+        'electrons_per_l': electrons_per_l,
+        'dipole_per_l': dipole_per_l,
+        'quadrupole_per_l': quadrupole_per_l,
+    }
+
+
+def get_moment_comparisons(data, y_ml, Rs):
+    import math
+    import torch
+    # analytic moments of the target density and of the ml prediction y_ml
+    # (populations, like data.y) for a batch, on the device of y_ml
+    device = y_ml.device
+    norm = data.norm.to(device)
+    ml_full_c = y_ml * norm / (2 * math.sqrt(2)) + data.iso_c.to(device)
+    batch = data.batch.to(device) if data.batch is not None else torch.zeros(y_ml.shape[0], dtype=torch.long, device=device)
+    num_graphs = data.num_graphs if data.batch is not None else 1
+    target = get_density_moments(data.full_c.to(device), data.exp.to(device), norm, data.pos_orig.to(device), batch, Rs, num_graphs)
+    ml = get_density_moments(ml_full_c, data.exp.to(device), norm, data.pos_orig.to(device), batch, Rs, num_graphs)
+    return target, ml
+
+
+
+@lru_cache(maxsize=None)
+def get_boys_table(nmax, step=0.05, tmax=40.0):
+    import numpy as np
+    from scipy.special import gamma, gammainc
+    # F_n(T) for n = 0..nmax on T = 0, step, ..., tmax
+    T = step*np.arange(int(round(tmax/step)) + 1)
+    n = np.arange(nmax + 1)[:,None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        table = gamma(n + 0.5)*gammainc(n + 0.5, T[None,:])/(2*T[None,:]**(n + 0.5))
+    table[:,0] = 1/(2*n[:,0] + 1)
+    return T, table
+
+
+def boys_function(nmax, T, terms=6):
+    import numpy as np
+    from math import pi
+    # boys function F_n(T) = int_0^1 t^2n exp(-T t^2) dt for n = 0..nmax,
+    # returned as [nmax + 1, *T.shape]
+    # below tmax, F_nmax is a taylor expansion about the nearest point of a
+    # table (using dF_n/dT = -F_n+1) and the lower orders follow from the
+    # downward recursion. above it, F_0 = sqrt(pi/T)/2 to double precision
+    # and the higher orders follow from the upward recursion
+    step, tmax = 0.05, 40.0
+    grid, table = get_boys_table(nmax + terms, step, tmax)
+    T = np.asarray(T, dtype=np.float64)
+    F = np.empty((nmax + 1,) + T.shape)
+    exp_T = np.exp(-T)
+
+    near = T < tmax
+    k = np.rint(T[near]/step).astype(np.int64)
+    d = grid[k] - T[near]
+    top = np.zeros(len(k))
+    term = np.ones(len(k))
+    for j in range(terms + 1):
+        top += table[nmax + j, k]*term
+        term = term*d/(j + 1)
+    F[nmax][near] = top
+    for n in range(nmax - 1, -1, -1):
+        F[n][near] = (2*T[near]*F[n + 1][near] + exp_T[near])/(2*n + 1)
+
+    far = ~near
+    F[0][far] = 0.5*np.sqrt(pi/T[far])
+    for n in range(nmax):
+        F[n + 1][far] = ((2*n + 1)*F[n][far] - exp_T[far])/(2*T[far])
+    return F
+
+
+@lru_cache(maxsize=None)
+def get_hermite_tables(l):
+    import numpy as np
+    # hermite expansion of the solid harmonics of get_solid_harmonic_coeffs
+    # (e3nn row order): S_lm(r) exp(-a r^2) = sum_tuv M[m, tuv] (2a)^-(l + t + u + v)/2
+    #     d^t/dAx^t d^u/dAy^u d^v/dAz^v exp(-a r^2)
+    # with the single center mcmurchie-davidson coefficients
+    # returns tuv [ntuv, 3] and M [2l + 1, ntuv]
+    e = np.zeros((l + 1, l + 2))
+    e[0,0] = 1.0
+    for i in range(l):
+        for t in range(i + 2):
+            e[i + 1,t] = (e[i,t - 1] if t > 0 else 0.0) + (t + 1)*e[i,t + 1]
+    powers, coeffs = get_solid_harmonic_coeffs(l)
+    tuv = [(t, u, v) for t in range(l + 1) for u in range(l + 1 - t) for v in range(l + 1 - t - u)]
+    index = {key: k for k, key in enumerate(tuv)}
+    M = np.zeros((2*l + 1, len(tuv)))
+    for c, (i, j, k) in enumerate(powers):
+        for t in range(i + 1):
+            for u in range(j + 1):
+                for v in range(k + 1):
+                    M[:, index[(t, u, v)]] += coeffs[:, c]*e[i,t]*e[j,u]*e[k,v]
+    return np.array(tuv), M
+
+
+def get_hermite_coulomb(alpha, X, Y, Z, L):
+    import numpy as np
+    # hermite coulomb integrals R_tuv for t + u + v <= L, from the gaussian
+    # centers minus the points X, Y, Z [S, P] (bohr) and exponents alpha [S]
+    # with alpha None, the point limit d^t/dXt d^u/dYu d^v/dZv 1/r instead
+    # (R_tuv -> sqrt(pi/alpha)/2 times this for large alpha r^2), for any
+    # shape of X, Y, Z
+    R = {}
+    if alpha is None:
+        r2 = X**2 + Y**2 + Z**2
+        inv_r = 1/np.sqrt(r2)
+        for n in range(L + 1):
+            R[(n, 0, 0, 0)] = (-1)**n*np.prod(np.arange(2*n - 1, 0, -2, dtype=np.float64))*inv_r/r2**n
+    else:
+        alpha = alpha[:,None]
+        F = boys_function(L, alpha*(X**2 + Y**2 + Z**2))
+        for n in range(L + 1):
+            R[(n, 0, 0, 0)] = (-2*alpha)**n*F[n]
+    for total in range(1, L + 1):
+        for n in range(L - total + 1):
+            for t in range(total + 1):
+                for u in range(total + 1 - t):
+                    v = total - t - u
+                    if t > 0:
+                        value = X*R[(n + 1, t - 1, u, v)]
+                        if t > 1:
+                            value = value + (t - 1)*R[(n + 1, t - 2, u, v)]
+                    elif u > 0:
+                        value = Y*R[(n + 1, t, u - 1, v)]
+                        if u > 1:
+                            value = value + (u - 1)*R[(n + 1, t, u - 2, v)]
+                    else:
+                        value = Z*R[(n + 1, t, u, v - 1)]
+                        if v > 1:
+                            value = value + (v - 1)*R[(n + 1, t, u, v - 2)]
+                    R[(n, t, u, v)] = value
+    return {key[1:]: value for key, value in R.items() if key[0] == 0}
+
+
+def get_potential_field_boys(points, coeff_list, exps, norms, positions, Rs, ele_mask=None, field=True, far_tol=None, far_radius=None, max_block=2**14):
+    import numpy as np
+    from math import pi
+    from scipy import spatial
+    # electronic potential and field of densities given as full coefficients
+    # (e3nn order, like data.full_c) at points [P, 3], without psi4
+    # points and positions [N, 3] are in angstrom, exps and norms as in data
+    # the nuclear attraction integrals of every (single primitive) shell use
+    # the hermite expansion of get_hermite_tables and the boys function, and
+    # the field is their derivative with respect to the point
+    # ele_mask [P, N] optionally leaves atoms out at some points
+    # with far_tol or far_radius (angstrom), atoms further than that from a
+    # point are replaced by their multipoles (all the shells of an atom
+    # summed into one hermite expansion about the atom, exact outside the
+    # gaussians). far_tol sets the radius of each atom from its most diffuse
+    # shell, exp(-a r^2) = far_tol, which bounds the error of the gaussian
+    # tails beyond it
+    # returns one [P, 4] array (potential, field x, y, z in atomic units)
+    # per coefficient array, with the sign of electrons, as in
+    # get_ele_potential_field
+    angstrom2bohr = 1.8897259886
+
+    def as_numpy(x):
+        if hasattr(x, 'detach'):
+            x = x.detach().cpu().numpy()
+        return np.asarray(x, dtype=np.float64)
+
+    points = as_numpy(points).reshape(-1, 3)*angstrom2bohr
+    positions = as_numpy(positions)*angstrom2bohr
+    exps = as_numpy(exps)
+    norms = as_numpy(norms)
+    coeff_list = [as_numpy(coeffs) for coeffs in coeff_list]
+    out = [np.zeros((len(points), 4)) for coeffs in coeff_list]
+    natom = positions.shape[0]
+
+    # atoms done with multipoles at each point, [P, N]
+    far = None
+    if far_tol is not None or far_radius is not None:
+        if far_radius is not None:
+            radius = np.full(natom, far_radius*angstrom2bohr)
+        else:
+            alpha_min = np.array([np.amin(row[row_norms != 0]) if np.any(row_norms != 0) else np.inf for row, row_norms in zip(exps, norms)])
+            radius = np.sqrt(-np.log(far_tol)/alpha_min)
+        # atoms within their radius of each point, from a kd tree of the
+        # points rather than every point to atom distance
+        within = np.zeros((len(points), natom), dtype=bool)
+        tree = spatial.cKDTree(points)
+        for atom, neighbors in enumerate(tree.query_ball_point(positions, radius)):
+            within[neighbors, atom] = True
+        far = ~within
+        if ele_mask is not None:
+            far = far & ele_mask
+    near = ele_mask
+    if far is not None:
+        near = ~far if ele_mask is None else ele_mask & ~far
+
+    starts, ls = get_shell_layout(Rs)
+    lmax = int(ls.max())
+    L_all = lmax + 1 if field else lmax
+    all_tuv = [(t, u, v) for t in range(L_all + 1) for u in range(L_all + 1 - t) for v in range(L_all + 1 - t - u)]
+    all_index = {key: k for k, key in enumerate(all_tuv)}
+    # hermite multipoles of every atom, [N, ntuv]
+    multipoles = [np.zeros((natom, len(all_tuv))) for coeffs in coeff_list]
+
+    for l in sorted(set(ls.tolist())):
+        tuv, M = get_hermite_tables(l)
+        L = l + 1 if field else l
+        atom_idx, shell_idx = np.nonzero(norms[:, starts[ls == l]] != 0)
+        cols = starts[ls == l][shell_idx]
+        if len(cols) == 0:
+            continue
+        alpha = exps[atom_idx, cols]
+        # everything that depends only on the shell, [S, ntuv]
+        prefactor = norms[atom_idx, cols]*(2*pi/alpha)*(2*alpha)**(-l/2)
+        scale = (2*alpha[:,None])**(-tuv.sum(1)[None,:]/2)
+        comp = cols[:,None] + np.arange(2*l + 1)[None,:]
+        weights = [prefactor[:,None]*(coeffs[atom_idx[:,None], comp] @ M)*scale for coeffs in coeff_list]
+
+        if far is not None:
+            columns = [all_index[tuple(key)] for key in tuv]
+            for w, Q in zip(weights, multipoles):
+                np.add.at(Q, (atom_idx[:,None], np.array(columns)[None,:]), w*np.sqrt(pi/alpha)[:,None]/2)
+
+        # blocks of shells with about max_block (shell, point) pairs; with a
+        # mask, whole atoms at a time, counting only the points near them
+        begin = 0
+        while begin < len(cols):
+            if near is None:
+                end = begin + max(1, max_block//max(1, len(points)))
+                index = slice(None)
+            else:
+                end = begin
+                union = np.zeros(len(points), dtype=bool)
+                while end < len(cols):
+                    atom_end = np.searchsorted(atom_idx, atom_idx[end], side='right')
+                    grown = union | near[:, atom_idx[end]]
+                    if end > begin and np.count_nonzero(grown)*(atom_end - begin) > max_block:
+                        break
+                    union, end = grown, atom_end
+                index = np.nonzero(union)[0]
+            shells = slice(begin, end)
+            begin = end
+            mask = None
+            if near is not None:
+                if len(index) == 0:
+                    continue
+                mask = near[index][:, atom_idx[shells]].T
+                if np.all(mask):
+                    mask = None
+            center = positions[atom_idx[shells]]
+            X = center[:,None,0] - points[None,index,0]
+            Y = center[:,None,1] - points[None,index,1]
+            Z = center[:,None,2] - points[None,index,2]
+            R = get_hermite_coulomb(alpha[shells], X, Y, Z, L)
+            for w, total in zip(weights, out):
+                w = w[shells]
+                terms = [sum(w[:,k,None]*R[tuple(key)] for k, key in enumerate(tuv))]
+                if field:
+                    for axis in range(3):
+                        shift = np.eye(3, dtype=np.int64)[axis]
+                        # d/dC = -d/dA
+                        terms.append(-sum(w[:,k,None]*R[tuple(key + shift)] for k, key in enumerate(tuv)))
+                for i, term in enumerate(terms):
+                    if mask is not None:
+                        term = term*mask
+                    total[index,i] += term.sum(0)
+
+    if far is not None:
+        # multipoles of the far atoms, blocks of points against all atoms
+        # the multipoles are laid out so that one product with the point
+        # terms R [B, N*ntuv] gives the potential and field of every array,
+        # [N, ntuv, 4*len(coeff_list)]
+        nterm = 4 if field else 1
+        expanded = np.zeros((natom, len(all_tuv), nterm, len(coeff_list)))
+        for key in all_tuv:
+            if sum(key) > lmax:
+                continue
+            for c, Q in enumerate(multipoles):
+                expanded[:, all_index[key], 0, c] = Q[:, all_index[key]]
+                for i in range(1, nterm):
+                    # d/dC = -d/dA
+                    shifted = tuple(np.array(key) + np.eye(3, dtype=np.int64)[i - 1])
+                    expanded[:, all_index[shifted], i, c] = -Q[:, all_index[key]]
+        expanded = expanded.reshape(natom, len(all_tuv), -1)
+        block = max(1, max_block//natom)
+        for begin in range(0, len(points), block):
+            index = np.nonzero(np.any(far[begin:begin + block], axis=1))[0] + begin
+            if len(index) == 0:
+                continue
+            atoms = np.nonzero(np.any(far[index], axis=0))[0]
+            diff = positions[None,atoms,:] - points[index,None,:]
+            R = get_hermite_coulomb(None, diff[...,0], diff[...,1], diff[...,2], L_all)
+            mask = far[index][:,atoms]
+            terms = np.empty((len(index), len(atoms), len(all_tuv)))
+            for key, k in all_index.items():
+                terms[:,:,k] = R[key]*mask
+            terms = terms.reshape(len(index), -1) @ expanded[atoms].reshape(len(atoms)*len(all_tuv), -1)
+            for c, total in enumerate(out):
+                total[index,:nterm] += terms.reshape(len(index), nterm, -1)[:,:,c]
+
+    # electrons: V = -int rho/|r - C| and E = int rho (r - C)/|r - C|^3
+    for total in out:
+        total[:,0] *= -1
+    return out
+
 from concurrent import futures
 import itertools
 
@@ -802,22 +1765,76 @@ def get_dens(coords, full_coeffs, delta_coeffs, ml_coeffs, alpha, norm, xyz, rs,
     return atom_target_density, atom_ml_density
 
 
-def compute_potential_field(xs,ys,zs,data,y_ml,Rs,interatomic=False,intermolecular=False, rad=3.0):
-    import psi4
+def compute_potential_field(xs,ys,zs,data,y_ml,Rs,interatomic=False,intermolecular=False, rad=3.0, workers=1, block_size=256, integrals='psi4', far_tol=None, far_radius=None):
     import numpy as np
-    # xs,ys,zs are the vertices of the isosurface
-    
-    # define molecule
+    # xs,ys,zs are the vertices of the isosurface, in angstrom
+    # returns the target potential [P] and field [P, 3] and the same for the
+    # ml density, nuclei plus electrons, in atomic units
+    # - interatomic: the points are the atoms, and each point leaves out the
+    #   electrons of its own atom
+    # - intermolecular: each point leaves out the nuclei and electrons of the
+    #   atoms within rad (bohr)
+    # the points are taken block_size at a time on workers processes, and
+    # the nuclear terms and the atoms each point leaves out are computed per
+    # block with the electronic terms, so memory is O(block_size*N)
+    # integrals='boys' uses get_potential_field_boys in place of psi4, and
+    # with far_tol or far_radius there the atoms far from a point are taken
+    # as multipoles (see get_potential_field_boys)
+    if (far_tol is not None or far_radius is not None) and integrals != 'boys':
+        raise ValueError("far_tol and far_radius need integrals='boys'")
+    if integrals == 'psi4':
+        import psi4
+        bohr2angstroms = psi4.constants.bohr2angstroms
+    elif integrals == 'boys':
+        bohr2angstroms = 1/1.8897259886
+    else:
+        raise ValueError("unknown integrals " + str(integrals))
+    points = np.stack([np.asarray(xs), np.asarray(ys), np.asarray(zs)], axis=1).astype(np.float64)/bohr2angstroms
+    coords = data.pos_orig.cpu().detach().numpy().astype(np.float64)/bohr2angstroms
+    Zs = data.z.cpu().detach().numpy().astype(np.float64).reshape(-1)
+    nuclei = {'coords': coords, 'Zs': Zs, 'interatomic': interatomic, 'intermolecular': intermolecular, 'rad': rad}
+
+    target_terms, ml_terms = get_potential_field_batched(points, data, y_ml, Rs, nuclei, workers=workers, block_size=block_size, integrals=integrals, far_tol=far_tol, far_radius=far_radius)
+    return target_terms[:,0], target_terms[:,1:], ml_terms[:,0], ml_terms[:,1:]
+
+
+def get_nuclear_potential_field(points, first, coords, Zs, interatomic=False, intermolecular=False, rad=3.0):
+    import numpy as np
+    # nuclear potential and field [B, 4] at a block of points (bohr) that
+    # starts at point first of compute_potential_field, and the atoms the
+    # electronic terms of each point see, [B, N]
+    diff = points[:,None,:] - coords[None,:,:]
+    r_nuc = np.sqrt(np.sum(diff**2, axis=2))
+    # rad only sets the nuclei with intermolecular, and interatomic takes
+    # precedence for the electronic terms (each point leaves out its atom)
+    nuc_mask = r_nuc > rad if intermolecular else r_nuc > 0.00001
+    if interatomic:
+        ele_mask = np.ones_like(nuc_mask)
+        ele_mask[np.arange(len(points)), first + np.arange(len(points))] = False
+    elif intermolecular:
+        ele_mask = nuc_mask
+    else:
+        ele_mask = np.ones_like(nuc_mask)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inv_r = np.where(nuc_mask, 1/r_nuc, 0.0)
+    nuc = np.zeros((len(points), 4))
+    nuc[:,0] = inv_r @ Zs
+    nuc[:,1:] = np.einsum('pa,pax->px', Zs[None,:]*inv_r**3, diff)
+    return nuc, ele_mask
+
+
+def get_potential_integrals(data):
+    import psi4
+    import periodictable as pt
+    # psi4 multipole potential integrals (custom ao_multipole_potential) of
+    # the auxiliary basis of the molecule, with result matrices to fill
     coords = data.pos_orig.tolist()
-    atomic_nums = data.z.tolist()
+    atomic_nums = data.z.view(-1).tolist()
     string_coords = []
     for item, anum in zip(coords, atomic_nums):
         string = ' '.join([str(elem) for elem in item])
-        if anum[0] == 1.0:
-            line = ' H  ' + string
-        if anum[0] == 8.0:
-            line = ' O  ' + string
-        string_coords.append(line)
+        string_coords.append(' ' + pt.elements[int(anum)].symbol + '  ' + string)
     molstr = """
     {}
      symmetry c1
@@ -825,99 +1842,115 @@ def compute_potential_field(xs,ys,zs,data,y_ml,Rs,interatomic=False,intermolecul
      units angstrom
      no_com
     """.format("\n".join(string_coords))
-    #print(molstr)
     mol = psi4.geometry(molstr)
-    
-    # now build the auxiliary basis set
+
     auxbasis = "def2-universal-jfit-decontract"
     psi4.core.set_global_option('df_basis_scf', auxbasis)
     aux_basis = psi4.core.BasisSet.build(mol, "DF_BASIS_SCF", "", "JFIT", auxbasis, quiet=True)
     zero_basis = psi4.core.BasisSet.zero_ao_basis_set()
-    
-    # now build the integrals
+
     factory = psi4.core.IntegralFactory(aux_basis, zero_basis, zero_basis, zero_basis)
-    nbf = aux_basis.nbf() 
+    nbf = aux_basis.nbf()
     ints = factory.ao_multipole_potential(1)
     results = [psi4.core.Matrix(nbf,1) for i in range(4)]
-    
-    # get nuclear coordinates and charges
-    # these coordinates are in bohr!
-    natom = mol.natom()
-    Zs = []
-    coords = []
-    for atom in range(natom):
-        coords.append(np.array([mol.x(atom), mol.y(atom), mol.z(atom)]))
-        Zs.append(mol.Z(atom))
-    
-    # now loop through the points
-    target_potential = []
-    ml_potential = []
-    target_field = []
-    ml_field = []
-    
-    counter = 0
-    # this assumes that the points here are given in angstroms
-    for x_pt, y_pt, z_pt in zip(xs,ys,zs):
-        x_bohr = x_pt/psi4.constants.bohr2angstroms
-        y_bohr = y_pt/psi4.constants.bohr2angstroms
-        z_bohr = z_pt/psi4.constants.bohr2angstroms
-        
-        # get nuclear potential
-        nuc_potential = 0.0
-        nuc_field = np.array([0.0, 0.0, 0.0])
-        # these nuclear coords are in bohr
-        nuc_counter = 0
-        skip_atoms = []
-        for center, charge in zip(coords, Zs):
-            x_nuc = x_bohr - center[0]
-            y_nuc = y_bohr - center[1]
-            z_nuc = z_bohr - center[2]
-            r_nuc = np.sqrt(x_nuc**2 + y_nuc**2 + z_nuc**2)
+    return ints, results, nbf
 
-            if intermolecular == True:
-                #rad = 6.61404 # 3.5 ang
-                #rad = 2.26767 # 1.2 ang
-                #rad = 3
-                if r_nuc > rad:
-                    nuc_potential += (charge/r_nuc).squeeze()
-                    nuc_field[0] += (charge*x_nuc/(r_nuc**3)).squeeze()
-                    nuc_field[1] += (charge*y_nuc/(r_nuc**3)).squeeze()
-                    nuc_field[2] += (charge*z_nuc/(r_nuc**3)).squeeze()
-                else:
-                    # add it to the list
-                    skip_atoms.append(nuc_counter)
-                nuc_counter += 1
-            else:
-                if r_nuc > 0.00001:
-                    nuc_potential += (charge/r_nuc).squeeze()
-                    nuc_field[0] += (charge*x_nuc/(r_nuc**3)).squeeze()
-                    nuc_field[1] += (charge*y_nuc/(r_nuc**3)).squeeze()
-                    nuc_field[2] += (charge*z_nuc/(r_nuc**3)).squeeze()
-            
-                
-        position = np.array([x_bohr,y_bohr,z_bohr])
-        
-        if interatomic == True:
-            target_ele_potential, target_ele_field, ml_ele_potential, ml_ele_field = get_ele_potential_field(position,ints,results,nbf,data,y_ml,Rs,zero_atom=counter)
-        elif intermolecular == True:
-            target_ele_potential, target_ele_field, ml_ele_potential, ml_ele_field = get_ele_potential_field(position,ints,results,nbf,data,y_ml,Rs,zero_atom=skip_atoms)
-        else: 
-            target_ele_potential, target_ele_field, ml_ele_potential, ml_ele_field = get_ele_potential_field(position,ints,results,nbf,data,y_ml,Rs)
-        
-        
-        #print("nuc", nuc_potential, nuc_field)
-        #print("target",target_ele_potential,target_ele_field)
-        #print("    ml",ml_ele_potential,ml_ele_field)
-        
-        target_potential.append(nuc_potential + np.array(target_ele_potential))
-        ml_potential.append(nuc_potential + np.array(ml_ele_potential))
-    
-        target_field.append(nuc_field + np.array(target_ele_field))
-        ml_field.append(nuc_field + np.array(ml_ele_field))
-        
-        counter += 1
-    
-    return np.array(target_potential), np.array(target_field), np.array(ml_potential), np.array(ml_field)
+
+def get_potential_coeffs(data, y_ml, Rs):
+    import numpy as np
+    # target and ml full coefficients of every basis function in psi4
+    # ordering, [nbf, 2], and the atom of every basis function [nbf]
+    norms = data.norm.cpu().detach().numpy()
+    target_coeffs = e3nn_2_psi4_ordering(data.full_c.cpu().detach().numpy(), Rs)
+    ml_full_coeffs = e3nn_2_psi4_ordering(get_ml_full_coeffs(data, y_ml), Rs)
+    present = norms != 0
+    bf_atom = np.nonzero(present)[0]
+    return np.stack([target_coeffs[present], ml_full_coeffs[present]], axis=1), bf_atom
+
+
+# integrals and coefficients of a worker of get_potential_field_batched
+potential_worker = {}
+
+def init_potential_worker(data, y_ml, Rs, integrals='psi4', far_tol=None, far_radius=None, nuclei=None):
+    import numpy as np
+    potential_worker.clear()
+    potential_worker['integrals'] = integrals
+    potential_worker['nuclei'] = nuclei
+    if integrals == 'boys':
+        potential_worker.update(Rs=Rs, coeffs=[data.full_c.cpu().detach().numpy(), get_ml_full_coeffs(data, y_ml)],
+            exps=data.exp.cpu().detach().numpy(), norms=data.norm.cpu().detach().numpy(), positions=data.pos_orig.cpu().detach().numpy(), far_tol=far_tol, far_radius=far_radius)
+        return
+    ints, results, nbf = get_potential_integrals(data)
+    coeffs, bf_atom = get_potential_coeffs(data, y_ml, Rs)
+    natom = data.pos_orig.shape[0]
+    # coefficients split by atom, [nbf, natom*2], so one product gives the
+    # terms of every atom and points can leave out atoms
+    per_atom = np.zeros((nbf, natom, 2))
+    per_atom[np.arange(nbf), bf_atom] = coeffs
+    potential_worker.update(ints=ints, results=results, nbf=nbf, coeffs=coeffs, per_atom=per_atom.reshape(nbf, -1), natom=natom)
+
+
+def get_ele_potential_field_block(points, ele_mask):
+    import numpy as np
+    # electronic potential and field [B, 4] of the target and ml densities at
+    # a block of points (bohr), with the atoms in ele_mask [B, N]
+    if potential_worker['integrals'] == 'boys':
+        w = potential_worker
+        angstrom2bohr = 1.8897259886
+        target, ml = get_potential_field_boys(points/angstrom2bohr, w['coeffs'], w['exps'], w['norms'], w['positions'], w['Rs'], ele_mask=None if np.all(ele_mask) else ele_mask,
+            far_tol=w['far_tol'], far_radius=w['far_radius'])
+        return target, ml
+
+    import psi4
+    ints = potential_worker['ints']
+    results = potential_worker['results']
+    terms = np.zeros((len(points), 4, potential_worker['nbf']))
+    for k, position in enumerate(points):
+        ints.origin = psi4.core.Vector3(*position)
+        for mat in results:
+            mat.zero()
+        ints.compute(results)
+        for i in range(4):
+            terms[k,i] = results[i].np[:,0]
+
+    if np.all(ele_mask):
+        ele = terms @ potential_worker['coeffs']
+    else:
+        ele = terms @ potential_worker['per_atom']
+        ele = ele.reshape(len(points), 4, potential_worker['natom'], 2)
+        ele = np.einsum('bkac,ba->bkc', ele, ele_mask.astype(ele.dtype))
+
+    sign_change = np.array([-1,1,1,1])[None,:]
+    return ele[:,:,0]*sign_change, ele[:,:,1]*sign_change
+
+
+def get_potential_field_block(points, first):
+    # potential and field [B, 4] of the target and ml densities, nuclei plus
+    # electrons, at a block of points (bohr) that starts at point first
+    w = potential_worker['nuclei']
+    nuc, ele_mask = get_nuclear_potential_field(points, first, w['coords'], w['Zs'], w['interatomic'], w['intermolecular'], w['rad'])
+    target, ml = get_ele_potential_field_block(points, ele_mask)
+    return nuc + target, nuc + ml
+
+
+def get_potential_field_batched(points, data, y_ml, Rs, nuclei, workers=1, block_size=256, integrals='psi4', far_tol=None, far_radius=None):
+    import numpy as np
+    from concurrent import futures
+    # terms of compute_potential_field for all points (bohr), with nuclei
+    # the coords (bohr), charges and options of get_nuclear_potential_field
+    # every worker builds its own psi4 integrals once and then takes blocks
+    # of points, in place of one set of einsums per point
+    blocks = [(points[i:i+block_size], i) for i in range(0, len(points), block_size)]
+    if workers == 1:
+        init_potential_worker(data, y_ml, Rs, integrals, far_tol, far_radius, nuclei)
+        out = [get_potential_field_block(*block) for block in blocks]
+    else:
+        data = data.cpu().detach() if hasattr(data, 'cpu') else data
+        with futures.ProcessPoolExecutor(max_workers=workers, initializer=init_potential_worker, initargs=(data, y_ml.cpu().detach(), Rs, integrals, far_tol, far_radius, nuclei)) as pool:
+            out = list(pool.map(get_potential_field_block, *zip(*blocks)))
+    if not out:
+        return np.zeros((0, 4)), np.zeros((0, 4))
+    return np.concatenate([o[0] for o in out]), np.concatenate([o[1] for o in out])
 
 
 def get_ele_potential_field(position, ints, results, nbf, data, ml_delta_pop, Rs, zero_atom=None): 
@@ -982,52 +2015,53 @@ def get_ele_potential_field(position, ints, results, nbf, data, ml_delta_pop, Rs
     return target_ele_potential, target_ele_field, ml_ele_potential, ml_ele_field
     
     
+@lru_cache(maxsize=None)
+def get_psi4_permutation(Rs):
+    import numpy as np
+    # flat column indices between the e3nn (m = -l..l) and psi4 (m = 0, +1,
+    # -1, +2, -2, ...) orderings of an Rs layout, built once per Rs
+    # coeffs_psi4 = coeffs_e3nn[..., e3nn_2_psi4]
+    # coeffs_e3nn = coeffs_psi4[..., psi4_2_e3nn]
+    # Rs is a tuple of (mul, l) tuples
+    starts, ls = get_shell_layout(Rs)
+    e3nn_2_psi4 = np.zeros(int(starts[-1] + 2*ls[-1] + 1) if len(starts) else 0, dtype=np.int64)
+    for start, l in zip(starts, ls):
+        m = [0] + [sign*k for k in range(1, l + 1) for sign in (1, -1)]
+        e3nn_2_psi4[start:start + 2*l + 1] = start + l + np.array(m)
+    psi4_2_e3nn = np.argsort(e3nn_2_psi4)
+    e3nn_2_psi4.flags.writeable = False
+    psi4_2_e3nn.flags.writeable = False
+    return e3nn_2_psi4, psi4_2_e3nn
+
+
+# get_psi4_permutation indices as tensors, by (Rs, direction, device)
+psi4_permutation_tensors = {}
+
+def permute_coeffs(coeffs, Rs, to='psi4'):
+    import numpy as np
+    # reorder the last axis of coeffs [..., ncoeff] from e3nn to psi4
+    # ordering (to='psi4') or back (to='e3nn'), in one indexing call
+    # works on numpy arrays and on torch tensors on any device
+    if to not in ('psi4', 'e3nn'):
+        raise ValueError("unknown ordering " + str(to))
+    Rs = tuple(map(tuple, Rs))
+    e3nn_2_psi4, psi4_2_e3nn = get_psi4_permutation(Rs)
+    index = e3nn_2_psi4 if to == 'psi4' else psi4_2_e3nn
+    if hasattr(coeffs, 'index_select'):
+        import torch
+        key = (Rs, to, coeffs.device)
+        if key not in psi4_permutation_tensors:
+            psi4_permutation_tensors[key] = torch.from_numpy(np.array(index)).to(coeffs.device)
+        return torch.index_select(coeffs, -1, psi4_permutation_tensors[key])
+    return np.asarray(coeffs)[..., index]
+
+
 def e3nn_2_psi4_ordering(coeffs,Rs):
     import numpy as np
-    
-    list_coeffs = []
-    for atom in coeffs:
-        coeffs_list = []
-        counter = 0
-        for mul, l in Rs:
-            for i in range(mul):
-                step = 2*l + 1
-                coeffs_list.append(atom[counter:counter+step].tolist())
-                counter += step
-        list_coeffs.append(coeffs_list)
-        
-    ##              s     p         d             f                 g                      h                           i
-    psi4_2_e3nn = [[0],[2,0,1],[4,2,0,1,3],[6,4,2,0,1,3,5],[8,6,4,2,0,1,3,5,7],[10,8,6,4,2,0,1,3,5,7,9],[12,10,8,6,4,2,0,1,3,5,7,9,11]]
-    e3nn_2_psi4 = [[0],[1,2,0],[2,3,1,4,0],[3,4,2,5,1,6,0],[4,5,3,6,2,7,1,8,0],[5,6,4,7,3,8,2,9,1,10,0],[6,7,5,8,4,9,3,10,2,11,1,12,0]]
-    
-    '''
-    test = [[0],[-1, 0, +1],[-2, -1, 0, +1, +2],[-3, -2, -1, 0, +1, +2, +3],[-4, -3, -2, -1, 0, +1, +2, +3, +4]]
-
-    e3nn_2_psi4 = [[0],[1,2,0],[2,3,1,4,0],[3,4,2,5,1,6,0],[4,5,3,6,2,7,1,8,0]]
-    for j, item in enumerate(test):
-        l = (len(item)-1)//2
-        if l > 4:
-            raise ValueError('L is too high. Currently only supports L<5')
-        test[j] = [item[k] for k in e3nn_2_psi4[l]]
-    print(test)
-    '''
-        
-    for i, atom in enumerate(list_coeffs):
-        for j, item in enumerate(atom):
-            #print(item)
-            l = (len(item)-1)//2
-            if l > 6:
-                raise ValueError('L is too high. Currently only supports L<7')
-            list_coeffs[i][j] = [item[k] for k in e3nn_2_psi4[l]]
-        
-    rect_coeffs = []
-    for atom in list_coeffs:
-        flat_atom = list(flatten_list(atom))
-        rect_coeffs.append(flat_atom)
-    
-    new_coeffs = np.array(rect_coeffs)
-    
-    return new_coeffs
+    # coefficient rows [atoms, ncoeff] in psi4 ordering, as float64 numpy
+    if hasattr(coeffs, 'detach'):
+        coeffs = coeffs.detach().cpu().numpy()
+    return permute_coeffs(np.asarray(coeffs, dtype=np.float64), Rs, to='psi4')
 
 def compute_amber_potential(xs,ys,zs,data,y_ml,Rs):
     # xs,ys,zs are the vertices of the isosurface
@@ -1109,102 +2143,28 @@ def compute_amber_potential(xs,ys,zs,data,y_ml,Rs):
     return np.array(target_potential)
 
 def get_standardization_parms(data, Rs):
-
-    means = np.zeros((len(data[0].x[1]),len(data[0].y[1])))
-    stds = np.zeros((len(data[0].x[1]),len(data[0].y[1])))
-
-    # loop through atom types
-    for x_ind in range(len(data[0].x[1])):
-
-        y_array = []
-
-        # loop through samples
-        for sample_num in range(len(data)):
-
-            # loop through atoms
-            for atm_num in range(len(data[sample_num].x)):
-                # find correct atom
-                if data[sample_num].x[atm_num][x_ind]==1:
-
-                    y_array.append(data[sample_num].y[atm_num])
-
-        # put data into numpy array
-        y_array_np = np.zeros((len(y_array),len(y_array[0])))
-        for ii in range(len(y_array)):
-            for jj in range(len(y_array[0])):
-                y_array_np[ii,jj]=y_array[ii][jj]
-
-        # take means and stds from L-corresponding coefficients
-        n_start = 0
-
-        mean_per_l = []
-        std_per_l = []
-
-        for mul, l in Rs:
-            #print("mul, l", mul, l)
-            for i_mul in range(mul):
-                mult = 2*l+1
-                n_end = n_start+mult
-                #print(n_start, n_end)
-                means[x_ind,n_start:n_end] = np.mean(y_array_np[:, n_start:n_end])
-                stds[x_ind,n_start:n_end] = np.std(y_array_np[:, n_start:n_end])
-                #mean_per_l.append(np.mean(y_array_np[:, n_start:n_end]))
-                #std_per_l.append(np.std(y_array_np[:, n_start:n_end]))
-
-                n_start = n_end
-
-        # fill in means and stds data
-
-    return(means, stds)
+    from density_dataset import get_standardization_stats
+    # per element, per shell means and stds [num_elements, num_coeffs] of
+    # the targets y of a dataset, see get_standardization_stats
+    means, stds = get_standardization_stats(data, Rs)
+    return(means.numpy(), stds.numpy())
 
 def standardize_data(data, means, stds):
-
-    # loop through atom types
-    for x_ind in range(len(data.x[1])):
-
-        # loop through atoms in data
-        for atm_num in range(len(data.y)):
-
-            #check atom type
-            if data.x[atm_num][x_ind]==1:
-
-                for i_coeff in range(len(data.y[atm_num])):
-                    if stds[x_ind, i_coeff]==0:
-                        data.y[atm_num][i_coeff] = 0
-                    else:
-                        data.y[atm_num][i_coeff] = (data.y[atm_num][i_coeff]-means[x_ind,i_coeff])/stds[x_ind,i_coeff]
-
+    from density_dataset import Standardizer
+    # data.y in place, columns with a zero std become zero
+    data.y[:] = Standardizer(means, stds)(data.y, data.x)
     return
 
 def unstandardize_data(data, means, stds):
-
-    # loop through atom types
-    for x_ind in range(len(data.x[1])):
-
-        # loop through atoms in data
-        for atm_num in range(len(data.y)):
-
-            #check atom type
-            if data.x[atm_num][x_ind]==1:
-
-                for i_coeff in range(len(data.y[atm_num])):
-                    data.y[atm_num][i_coeff] = (data.y[atm_num][i_coeff]*stds[x_ind,i_coeff])+means[x_ind,i_coeff]
-
+    from density_dataset import Standardizer
+    # data.y in place
+    data.y[:] = Standardizer(means, stds).inverse(data.y, data.x)
     return
 
 def unstandardize_yml(y_ml, data, means, stds):
-
-    # loop through atoms in data
-    for atm_num in range(len(data.y)):
-
-        for x_ind in range(len(data.x[atm_num])):
-
-            if data.x[atm_num][x_ind]==1:
-                atm_type = x_ind
-
-        for i_coeff in range(len(data.y[atm_num])):
-            y_ml[atm_num][i_coeff] = (y_ml[atm_num][i_coeff]*stds[atm_type,i_coeff])+means[atm_type,i_coeff]
-
+    from density_dataset import Standardizer
+    # y_ml in place, with the elements of data
+    y_ml[:] = Standardizer(means, stds).inverse(y_ml, data.x)
     return
 
 